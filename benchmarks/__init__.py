@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Benchmarks for tbviewer map loading & creation functions.
+
+Usage::
+
+    python -m benchmarks generate <dir> [options]
+    python -m benchmarks run [-o results.json] [options]
+    python -m benchmarks compare <baseline.json> <results.json>
+    python -m benchmarks loadtest [--url URL] [-n 10000 -c 32]
+"""
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Benchmarks command line interface."""
+
+import optparse
+import os.path
+import sys
+import tempfile
+
+from . import bench
+from . import synth
+
+
+def _add_data_options(optp):
+    group = optparse.OptionGroup(optp, "Synthetic data options")
+    group.add_option("--layers", type="int",
+                     default=bench.DEFAULT_PARAMS['layers'])
+    group.add_option("--maps", type="int",
+                     default=bench.DEFAULT_PARAMS['maps'],
+                     help="maps per layer")
+    group.add_option("--tiles", default="16x16",
+                     help="tiles per map (COLSxROWS)")
+    group.add_option("--tile-size", type="int",
+                     default=bench.DEFAULT_PARAMS['tile_size'])
+    group.add_option("--format", choices=("JPEG", "PNG"),
+                     default=bench.DEFAULT_PARAMS['format'])
+    group.add_option("--no-tar", action="store_true", default=False,
+                     help="create untarred maps")
+    group.add_option("--cut-size", type="int",
+                     default=bench.DEFAULT_PARAMS['cut_size'],
+                     help="size of image for cut_map benchmark")
+    optp.add_option_group(group)
+
+
+def _data_params(options):
+    tiles_x, tiles_y = map(int, options.tiles.lower().split('x'))
+    return {
+        'layers': options.layers,
+        'maps': options.maps,
+        'tiles_x': tiles_x,
+        'tiles_y': tiles_y,
+        'tile_size': options.tile_size,
+        'format': options.format,
+        'tar': not options.no_tar,
+        'cut_size': options.cut_size,
+    }
+
+
+def _cmd_generate(argv):
+    optp = optparse.OptionParser(
+        usage="%prog generate [options] <destination dir>")
+    optp.add_option("--force", action="store_true", default=False,
+                    help="replace atlas in not empty destination directory "
+                    "(only generated files are removed)")
+    _add_data_options(optp)
+    options, args = optp.parse_args(argv)
+    if len(args) != 1:
+        optp.error("missing destination directory")
+    par = _data_params(options)
+    try:
+        path = synth.make_atlas(args[0], par['layers'], par['maps'],
+                                par['tiles_x'], par['tiles_y'],
+                                par['tile_size'], par['format'],
+                                par['tar'], pack=True, force=options.force)
+    except FileExistsError as err:
+        print(f"error: {err}; use --force to replace atlas",
+              file=sys.stderr)
+        return 1
+    print(path)
+    return 0
+
+
+def _cmd_run(argv):
+    optp = optparse.OptionParser(usage="%prog run [options] [names...]")
+    optp.add_option("--output", "-o", help="save results to json file")
+    optp.add_option("--workdir", help="directory for test data")
+    _add_data_options(optp)
+    options, args = optp.parse_args(argv)
+    results = bench.run(_data_params(options), args, options.workdir,
+                        log=print)
+    if options.output:
+        bench.save(results, options.output)
+    return 0
+
+
+def _cmd_compare(argv):
+    optp = optparse.OptionParser(
+        usage="%prog compare [options] <baseline.json> <results.json>")
+    optp.add_option("--threshold", type="float", default=0.1,
+                    help="allowed slowdown (0.1 = 10%%)")
+    options, args = optp.parse_args(argv)
+    if len(args) != 2:
+        optp.error("baseline and results files required")
+    rows = bench.compare(bench.load(args[0]), bench.load(args[1]),
+                         options.threshold)
+    regressions = 0
+    for name, base, cur, ratio, regression in rows:
+        mark = "REGRESSION" if regression else ""
+        regressions += regression
+        print(f"{name:<32} {base * 1000:>10.3f} {cur * 1000:>10.3f} ms "
+              f"{ratio:>6.2f}x {mark}")
+    return 1 if regressions else 0
+
+
+def _cmd_loadtest(argv):
+    optp = optparse.OptionParser(
+        usage="%prog loadtest [options] [--url URL | <atlas or map file>]")
+    optp.add_option("--url", help="url of running tbserve; when not given "
+                    "local server is started for atlas (or synthetic atlas)")
+    optp.add_option("--requests", "-n", type="int", default=10000)
+    optp.add_option("--concurrency", "-c", type="int", default=32)
+    optp.add_option("--hot", type="int", default=0,
+                    help="request only given percent of tiles")
+    optp.add_option("--workdir", help="directory for synthetic atlas")
+    _add_data_options(optp)
+    options, args = optp.parse_args(argv)
+
+    from . import loadtest
+
+    url = options.url
+    if not url:
+        if args:
+            path = args[0]
+        else:
+            par = _data_params(options)
+            workdir = options.workdir or tempfile.mkdtemp(
+                prefix="tbviewer_bench_")
+            path = synth.make_atlas(
+                os.path.join(workdir, "atlas"), par['layers'], par['maps'],
+                par['tiles_x'], par['tiles_y'], par['tile_size'],
+                par['format'], par['tar'], force=True)
+        url = loadtest.start_local_server(path)
+        print(f"started server {url} for {path}")
+
+    res = loadtest.run(url, options.requests, options.concurrency,
+                       options.hot)
+    print(loadtest.format_results(res))
+    return 1 if res['errors'] else 0
+
+
+_COMMANDS = {
+    'generate': _cmd_generate,
+    'run': _cmd_run,
+    'compare': _cmd_compare,
+    'loadtest': _cmd_loadtest,
+}
+
+
+def main(argv):
+    if not argv or argv[0] not in _COMMANDS:
+        print(__doc__.strip())
+        print("commands: " + ", ".join(sorted(_COMMANDS)))
+        return 2
+    return _COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,838 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Benchmarks definitions, runner and results comparison."""
+
+import asyncio
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tbviewer import atlas_scan
+from tbviewer import export
+from tbviewer import gpx
+from tbviewer import imgpyramid
+from tbviewer import layout
+from tbviewer import map_loader
+from tbviewer import mapfile
+from tbviewer import mapmaker
+from tbviewer import mbtiles
+from tbviewer import retile
+from tbviewer import tile_import
+from tbviewer import transcode
+from tbviewer import verify
+from tbviewer import xyz
+
+from . import synth
+
+# name -> function(context) returning callable to measure (or None when
+# benchmark can't be run)
+_BENCHMARKS = {}
+
+
+def benchmark(name, repeat=5, number=1):
+    """Register benchmark.
+
+    Decorated function get `Context` and should return function without
+    arguments that is measured; all preparation should be done before
+    return.
+    """
+    def wrapper(func):
+        _BENCHMARKS[name] = (func, repeat, number)
+        return func
+    return wrapper
+
+
+class Context:
+    """Benchmark environment - parameters and lazy created test data."""
+
+    def __init__(self, workdir, params):
+        self.workdir = workdir
+        self.params = params
+        self._atlas = None
+        self._map = None
+        self._mbtiles = None
+        self._tk_root = None
+
+    @property
+    def atlas_path(self):
+        """Path to synthetic atlas (.tba)."""
+        if not self._atlas:
+            par = self.params
+            synth.make_atlas(
+                os.path.join(self.workdir, "atlas"), par['layers'],
+                par['maps'], par['tiles_x'], par['tiles_y'],
+                par['tile_size'], par['format'], par['tar'], pack=True,
+                force=True)
+            self._atlas = os.path.join(self.workdir, "atlas", "atlas.tba")
+        return self._atlas
+
+    @property
+    def atlas_tar_path(self):
+        """Path to synthetic tar atlas."""
+        return os.path.join(os.path.dirname(self.atlas_path), "atlas.tar")
+
+    @property
+    def map_path(self):
+        """Path to first map in synthetic atlas."""
+        if not self._map:
+            map_dir = os.path.join(os.path.dirname(self.atlas_path),
+                                   "layer0", "map0_0")
+            ext = ".tar" if self.params['tar'] else ".map"
+            self._map = os.path.join(map_dir, "map0_0" + ext)
+        return self._map
+
+    @property
+    def mbtiles_path(self):
+        """Path to first map in synthetic atlas converted to MBTiles."""
+        if not self._mbtiles:
+            self._mbtiles = os.path.join(self.workdir, "map0_0.mbtiles")
+            with map_loader.Map(self.map_path) as tbmap:
+                mbtiles.export_map(tbmap, self._mbtiles)
+        return self._mbtiles
+
+    def tk_root(self):
+        """Tk root window required by `Map.get_tile`; None if no display."""
+        if self._tk_root is None:
+            try:
+                import tkinter
+                self._tk_root = tkinter.Tk()
+                self._tk_root.withdraw()
+            except Exception:  # pylint: disable=broad-except
+                self._tk_root = False
+        return self._tk_root or None
+
+    def close(self):
+        if self._tk_root:
+            self._tk_root.destroy()
+
+
+@benchmark("check_file_type.map", number=20)
+def _bench_check_file_type_map(ctx):
+    path = ctx.map_path
+    return lambda: map_loader.check_file_type(path)
+
+
+@benchmark("check_file_type.tar_atlas", number=5)
+def _bench_check_file_type_atlas(ctx):
+    path = ctx.atlas_tar_path
+    return lambda: map_loader.check_file_type(path)
+
+
+@benchmark("map.check_and_open", number=5)
+def _bench_map_check_and_open(ctx):
+    path = ctx.map_path
+
+    def bench():
+        map_loader.check_file_type(path)
+        map_loader.Map(path).close()
+
+    return bench
+
+
+@benchmark("map.sniff_and_open", number=5)
+def _bench_map_sniff_and_open(ctx):
+    path = ctx.map_path
+
+    def bench():
+        _file_type, fs = map_loader.sniff_file_type(path)
+        map_loader.Map(path, fs).close()
+
+    return bench
+
+
+@benchmark("atlas.open", number=5)
+def _bench_atlas_open(ctx):
+    path = ctx.atlas_path
+    return lambda: map_loader.Atlas(path).close()
+
+
+@benchmark("atlas.open_tar", number=5)
+def _bench_atlas_open_tar(ctx):
+    path = ctx.atlas_tar_path
+    return lambda: map_loader.Atlas(path).close()
+
+
+@benchmark("atlas.scan.cold", repeat=3)
+def _bench_atlas_scan_cold(ctx):
+    atlas = map_loader.Atlas(ctx.atlas_path)
+    layers = atlas.layers
+    atlas.close()
+    return lambda: atlas_scan.scan_atlas(layers, cache_file='')
+
+
+@benchmark("atlas.scan.warm", number=5)
+def _bench_atlas_scan_warm(ctx):
+    atlas = map_loader.Atlas(ctx.atlas_path)
+    layers = atlas.layers
+    atlas.close()
+    cache_file = os.path.join(ctx.workdir, "atlas_scan.sqlite")
+    # fill cache
+    atlas_scan.scan_atlas(layers, cache_file)
+    return lambda: atlas_scan.scan_atlas(layers, cache_file)
+
+
+@benchmark("map.open", number=5)
+def _bench_map_open(ctx):
+    path = ctx.map_path
+    return lambda: map_loader.Map(path).close()
+
+
+@benchmark("map.open.mbtiles", number=5)
+def _bench_map_open_mbtiles(ctx):
+    path = ctx.mbtiles_path
+    return lambda: map_loader.Map(path).close()
+
+
+@benchmark("mbtiles.export_map", repeat=3)
+def _bench_mbtiles_export(ctx):
+    tbmap = map_loader.Map(ctx.map_path)
+    fname = os.path.join(ctx.workdir, "export.mbtiles")
+    return lambda: mbtiles.export_map(tbmap, fname)
+
+
+def _get_tile_bench(ctx, shuffle, photo=False, path=None):
+    if photo and not ctx.tk_root():
+        return None
+    tbmap = map_loader.Map(path or ctx.map_path)
+    positions = sorted(tbmap.set_data, key=lambda pos: (pos[1], pos[0]))
+    if shuffle:
+        random.Random(0).shuffle(positions)
+    get_tile = tbmap.get_tile if photo else tbmap.get_tile_image
+
+    def func():
+        for x, y in positions:
+            get_tile(x, y)
+
+    return func
+
+
+@benchmark("map.get_tile.sequential")
+def _bench_get_tile_seq(ctx):
+    return _get_tile_bench(ctx, False)
+
+
+@benchmark("map.get_tile.random")
+def _bench_get_tile_random(ctx):
+    return _get_tile_bench(ctx, True)
+
+
+@benchmark("map.get_tile.random.mbtiles")
+def _bench_get_tile_random_mbtiles(ctx):
+    return _get_tile_bench(ctx, True, path=ctx.mbtiles_path)
+
+
+@benchmark("map.get_tile_photo.random")
+def _bench_get_tile_photo_random(ctx):
+    return _get_tile_bench(ctx, True, photo=True)
+
+
+@benchmark("map.get_region", repeat=3)
+def _bench_get_region(ctx):
+    tbmap = map_loader.Map(ctx.map_path)
+    # region not aligned to tiles
+    width, height = tbmap.width // 2, tbmap.height // 2
+    return lambda: tbmap.get_region(100, 100, width, height)
+
+
+def _export_bench(ctx, ext, scale):
+    tbmap = map_loader.Map(ctx.map_path)
+    fname = os.path.join(ctx.workdir, "export" + ext)
+    return lambda: export.export_region(tbmap, fname, scale=scale)
+
+
+@benchmark("export.png", repeat=3)
+def _bench_export_png(ctx):
+    return _export_bench(ctx, ".png", 1.0)
+
+
+@benchmark("export.tiff", repeat=3)
+def _bench_export_tiff(ctx):
+    return _export_bench(ctx, ".tif", 1.0)
+
+
+@benchmark("export.tiff.scale_0.3", repeat=3)
+def _bench_export_tiff_scaled(ctx):
+    return _export_bench(ctx, ".tif", 0.3)
+
+
+@benchmark("xyz.render_tile.native_16")
+def _bench_xyz_render_tile(ctx):
+    if mapfile.get_numpy() is None:
+        return None
+    tbmap = map_loader.Map(ctx.map_path)
+    zoom = xyz.native_zoom(tbmap.map_data)
+    x0, y0, x1, y1 = xyz.map_tiles(tbmap.map_data, zoom)
+    xc, yc = (x0 + x1) // 2, (y0 + y1) // 2
+    tiles = [(x, y) for x in range(xc - 2, xc + 2)
+             for y in range(yc - 2, yc + 2)]
+
+    def func():
+        # new reader - include reading source tiles
+        reader = xyz._SourceReader(tbmap)  # pylint: disable=protected-access
+        for x, y in tiles:
+            xyz.render_tile(tbmap, reader, zoom, x, y)
+
+    return func
+
+
+@benchmark("xyz.reproject_map", repeat=3)
+def _bench_xyz_reproject(ctx):
+    if mapfile.get_numpy() is None:
+        return None
+    path = ctx.map_path
+    with map_loader.Map(path) as tbmap:
+        zoom = xyz.native_zoom(tbmap.map_data)
+    dst_dir = os.path.join(ctx.workdir, "xyz")
+    return lambda: xyz.reproject_map(path, dst_dir, (zoom - 3, zoom - 1),
+                                     fmt='JPEG')
+
+
+def _xyz_source(ctx):
+    """Create xyz directory from tiles of map (as zoom 15)."""
+    dst_dir = os.path.join(ctx.workdir, "xyz_src")
+    if not os.path.isdir(dst_dir):
+        with map_loader.Map(ctx.map_path) as tbmap:
+            for (x, y), name in tbmap.set_data.items():
+                tile_dir = os.path.join(dst_dir, "15",
+                                        str(18000 + x // tbmap.tile_width))
+                os.makedirs(tile_dir, exist_ok=True)
+                ext = os.path.splitext(name)[1]
+                fname = os.path.join(
+                    tile_dir, str(11000 + y // tbmap.tile_height) + ext)
+                with open(fname, "wb") as tfile:
+                    tfile.write(tbmap.get_tile_bytes(x, y))
+    return dst_dir
+
+
+@benchmark("tile_import.copy", repeat=3)
+def _bench_tile_import_copy(ctx):
+    src = _xyz_source(ctx)
+    dst = os.path.join(ctx.workdir, "imported.tar")
+    return lambda: tile_import.import_tiles(src, dst, 15)
+
+
+@benchmark("tile_import.retile", repeat=3)
+def _bench_tile_import_retile(ctx):
+    src = _xyz_source(ctx)
+    dst = os.path.join(ctx.workdir, "imported.tar")
+    options = {'tile_size': (300, 300), 'format': 'JPEG'}
+    return lambda: tile_import.import_tiles(src, dst, 15, options=options)
+
+
+@benchmark("retile.512", repeat=3)
+def _bench_retile(ctx):
+    tbmap = map_loader.Map(ctx.map_path)
+    dst = os.path.join(ctx.workdir, "retiled.tar")
+    return lambda: retile.retile_map(tbmap, dst, (512, 512))
+
+
+@benchmark("transcode.map.jpeg_q50", repeat=3)
+def _bench_transcode_map(ctx):
+    src = ctx.map_path
+    if not src.endswith(".tar"):
+        return None
+    dst = os.path.join(ctx.workdir, "transcoded.tar")
+    return lambda: transcode.transcode(src, dst, {'jpeg_quality': 50})
+
+
+@benchmark("transcode.atlas_tar.jpeg_q50", repeat=3)
+def _bench_transcode_atlas(ctx):
+    src = ctx.atlas_tar_path
+    dst = os.path.join(ctx.workdir, "transcoded_atlas.tar")
+    return lambda: transcode.transcode(src, dst, {'jpeg_quality': 50})
+
+
+@benchmark("verify.atlas_tar", repeat=3)
+def _bench_verify_atlas(ctx):
+    return lambda: verify.verify(ctx.atlas_tar_path)
+
+
+# import api in new interpreter with tkinter blocked
+_IMPORT_API_CODE = """
+import sys, time
+
+class _Block:
+    def find_spec(self, name, path=None, target=None):
+        if name.split('.')[0] in ('tkinter', '_tkinter'):
+            raise ImportError('tkinter blocked')
+
+sys.meta_path.insert(0, _Block())
+tstart = time.perf_counter()
+import tbviewer.api
+print(time.perf_counter() - tstart)
+"""
+
+
+@benchmark("api.import_without_tk")
+def _bench_api_import(_ctx):
+    """Import time of tbviewer.api; fail when api require tkinter."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [root, env.get('PYTHONPATH')]))
+    # verify before measuring
+    subprocess.run([sys.executable, "-c", _IMPORT_API_CODE], env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+
+    def func():
+        subprocess.run([sys.executable, "-c", _IMPORT_API_CODE], env=env,
+                       check=True, stdout=subprocess.DEVNULL)
+
+    return func
+
+
+def _read_tile_bench(path):
+    tbmap = map_loader.Map(path)
+    names = list(tbmap.set_data.values())
+    random.Random(0).shuffle(names)
+    # pylint: disable=protected-access
+    get_file_binary = tbmap._fs.get_file_binary
+
+    def func():
+        for name in names:
+            get_file_binary(name)
+
+    return func
+
+
+@benchmark("map.read_tile.random")
+def _bench_read_tile_random(ctx):
+    return _read_tile_bench(ctx.map_path)
+
+
+@benchmark("map.read_tile.random.mbtiles")
+def _bench_read_tile_random_mbtiles(ctx):
+    return _read_tile_bench(ctx.mbtiles_path)
+
+
+def _aget_bench(ctx, images):
+    tbmap = map_loader.Map(ctx.map_path)
+    positions = list(tbmap.set_data)
+    random.Random(0).shuffle(positions)
+    # each tile requested twice; second request should be coalesced
+    positions = positions + positions[::-1]
+
+    async def get_all():
+        if images:
+            await asyncio.gather(*(tbmap.aget_tile_image(x, y)
+                                   for x, y in positions))
+        else:
+            await asyncio.gather(*(tbmap.aget_tile_bytes(x, y)
+                                   for x, y in positions))
+
+    return lambda: asyncio.run(get_all())
+
+
+@benchmark("map.aget_tile_bytes.concurrent")
+def _bench_aget_tile_bytes(ctx):
+    return _aget_bench(ctx, False)
+
+
+@benchmark("map.aget_tile_image.concurrent", repeat=3)
+def _bench_aget_tile_image(ctx):
+    return _aget_bench(ctx, True)
+
+
+def _map_content(ctx):
+    par = ctx.params
+    return synth.make_map_content(par['tiles_x'] * par['tile_size'],
+                                  par['tiles_y'] * par['tile_size'], "map")
+
+
+@benchmark("mapfile.parse_map", number=200)
+def _bench_parse_map(ctx):
+    content = _map_content(ctx)
+    return lambda: mapfile.MapFile().parse_map(content)
+
+
+def _map_corpus(ctx):
+    if not hasattr(ctx, 'map_corpus'):
+        ctx.map_corpus = synth.make_map_corpus(ctx.params['corpus_size'])
+    return ctx.map_corpus
+
+
+@benchmark("mapfile.parse_many.corpus", repeat=3)
+def _bench_parse_many(ctx):
+    corpus = _map_corpus(ctx)
+    return lambda: mapfile.parse_many(corpus)
+
+
+@benchmark("mapfile.parse_map.corpus", repeat=3)
+def _bench_parse_map_corpus(ctx):
+    corpus = _map_corpus(ctx)
+
+    def func():
+        for content in corpus:
+            mapfile.MapFile().parse_map(content)
+
+    return func
+
+
+@benchmark("mapfile.roundtrip.corpus", repeat=3)
+def _bench_roundtrip(ctx):
+    corpus = _map_corpus(ctx)
+
+    def func():
+        for content, mfile in zip(corpus, mapfile.parse_many(corpus)):
+            if mfile.to_str() != content:
+                raise ValueError("to_str result differ from parsed content")
+
+    return func
+
+
+def _random_points(mfile, count=10000):
+    rnd = random.Random(0)
+    return [(rnd.uniform(0, mfile.image_width),
+             rnd.uniform(0, mfile.image_height)) for _ in range(count)]
+
+
+@benchmark("mapfile.xy2lonlat")
+def _bench_xy2lonlat(ctx):
+    mfile = mapfile.MapFile()
+    mfile.parse_map(_map_content(ctx))
+    points = _random_points(mfile)
+    xy2lonlat = mfile.xy2lonlat
+
+    def func():
+        for x, y in points:
+            xy2lonlat(x, y)
+
+    return func
+
+
+@benchmark("mapfile.xy2lonlat.lines_intersection")
+def _bench_xy2lonlat_ref(ctx):
+    # pylint: disable=protected-access
+    mfile = mapfile.MapFile()
+    mfile.parse_map(_map_content(ctx))
+    points = _random_points(mfile)
+    map_xy_lonlat = mapfile._map_xy_lonlat
+    c0, c1, c2, c3 = mfile.mmpll
+    width, height = mfile.image_width, mfile.image_height
+
+    def func():
+        for x, y in points:
+            map_xy_lonlat(c0, c1, c2, c3, width, height, x, y)
+
+    return func
+
+
+@benchmark("mapfile.lonlat2xy")
+def _bench_lonlat2xy(ctx):
+    mfile = mapfile.MapFile()
+    mfile.parse_map(_map_content(ctx))
+    points = [mfile.xy2lonlat(x, y) for x, y in _random_points(mfile)]
+    lonlat2xy = mfile.lonlat2xy
+
+    def func():
+        for lon, lat in points:
+            lonlat2xy(lon, lat)
+
+    return func
+
+
+def _many_bench(ctx, inverse, python):
+    # pylint: disable=protected-access
+    mfile = mapfile.MapFile()
+    mfile.parse_map(_map_content(ctx))
+    xs, ys = zip(*_random_points(mfile, 200000))
+    transform = mfile.transform
+    if inverse:
+        xs, ys = transform._forward_many_py(xs, ys)
+        func = transform._inverse_many_py if python else \
+            mfile.lonlat2xy_many
+    else:
+        func = transform._forward_many_py if python else \
+            mfile.xy2lonlat_many
+    numpy = mapfile.get_numpy()
+    if not python and numpy is None:
+        return None
+    if not python:
+        xs, ys = numpy.array(xs), numpy.array(ys)
+    return lambda: func(xs, ys)
+
+
+@benchmark("mapfile.xy2lonlat_many.200k")
+def _bench_xy2lonlat_many(ctx):
+    return _many_bench(ctx, False, False)
+
+
+@benchmark("mapfile.xy2lonlat_many.200k_python", repeat=3)
+def _bench_xy2lonlat_many_py(ctx):
+    return _many_bench(ctx, False, True)
+
+
+@benchmark("mapfile.lonlat2xy_many.200k")
+def _bench_lonlat2xy_many(ctx):
+    return _many_bench(ctx, True, False)
+
+
+@benchmark("mapfile.lonlat2xy_many.200k_python", repeat=3)
+def _bench_lonlat2xy_many_py(ctx):
+    return _many_bench(ctx, True, True)
+
+
+@benchmark("mapmaker.cut_map", repeat=3)
+def _bench_cut_map(ctx):
+    size = ctx.params['cut_size']
+    src = os.path.join(ctx.workdir, "cut_src.png")
+    synth.make_image(size, size).save(src)
+    dst_dir = os.path.join(ctx.workdir, "cut")
+    options = {'tile_size': (256, 256), 'force': True,
+               'format': ctx.params['format'], 'png_palette': 'RGB',
+               'png_compression': '6'}
+    return lambda: mapmaker.cut_map(src, dst_dir, "cut.map", options)
+
+
+def _layout_pan_bench(scale, map_size=1000000, steps=100):
+    tlayout = layout.TileLayout(map_size, map_size, 256, 256)
+    # pan diagonally 1/3 of screen by step
+    viewports = [(step * 640, step * 360, 1920, 1080)
+                 for step in range(steps)]
+
+    def func():
+        tlayout.clear()
+        for vp in viewports:
+            tlayout.update(scale, *vp)
+
+    return func
+
+
+@benchmark("layout.pan.zoom_1")
+def _bench_layout_pan(_ctx):
+    return _layout_pan_bench(1.0)
+
+
+@benchmark("layout.pan.zoom_max")
+def _bench_layout_pan_zoom_max(_ctx):
+    return _layout_pan_bench(32.0)
+
+
+@benchmark("layout.pan.zoom_min", repeat=3)
+def _bench_layout_pan_zoom_min(_ctx):
+    return _layout_pan_bench(1 / 32.0, steps=10)
+
+
+def _track(ctx):
+    fname = os.path.join(ctx.workdir, "track.gpx")
+    if not os.path.isfile(fname):
+        synth.make_gpx(fname, ctx.params['track_points'])
+    return fname
+
+
+def _track_map(ctx):
+    mfile = mapfile.MapFile()
+    mfile.parse_map(synth.make_map_content(40000, 40000, "map"))
+    return mfile
+
+
+@benchmark("gpx.load", repeat=3)
+def _bench_gpx_load(ctx):
+    fname = _track(ctx)
+    return lambda: gpx.load_gpx(fname)
+
+
+@benchmark("gpx.overlay", repeat=3)
+def _bench_gpx_overlay(ctx):
+    segments = gpx.load_gpx(_track(ctx))
+    mfile = _track_map(ctx)
+    return lambda: gpx.TrackOverlay(segments, mfile)
+
+
+def _gpx_visible_bench(ctx, zoom):
+    overlay = gpx.TrackOverlay(gpx.load_gpx(_track(ctx)), _track_map(ctx))
+    scale = 2.0 ** zoom
+    width, height = 1920 / scale, 1080 / scale
+    viewports = [(x, y, x + width, y + height)
+                 for x in range(0, 40000, int(width))
+                 for y in range(0, 40000, int(height))]
+
+    def func():
+        for vp in viewports:
+            for _ in overlay.visible(zoom, *vp):
+                pass
+
+    return func
+
+
+@benchmark("gpx.visible.zoom_0")
+def _bench_gpx_visible(ctx):
+    return _gpx_visible_bench(ctx, 0)
+
+
+@benchmark("gpx.visible.zoom_min")
+def _bench_gpx_visible_min(ctx):
+    return _gpx_visible_bench(ctx, -5)
+
+
+def _scan_image(ctx):
+    if not hasattr(ctx, 'scan_image'):
+        size = ctx.params['scan_size']
+        ctx.scan_image = synth.make_image(size, size)
+    return ctx.scan_image
+
+
+def _pyramid_view_bench(ctx, zooms):
+    image = _scan_image(ctx)
+
+    def func():
+        pyramid = imgpyramid.ImagePyramid(image)
+        for zoom in zooms:
+            width, height = pyramid.size(zoom)
+            tlayout = layout.TileLayout(width, height, pyramid.tile_size,
+                                        pyramid.tile_size)
+            # viewport in the middle of image
+            add, _, _ = tlayout.update(1, width // 2, height // 2, 1920,
+                                       1080)
+            for x, y in add:
+                pyramid.get_tile(zoom, x, y)
+
+    return func
+
+
+@benchmark("imgpyramid.view.zoom_0")
+def _bench_pyramid_view(ctx):
+    return _pyramid_view_bench(ctx, [0])
+
+
+@benchmark("imgpyramid.view.zoom_out", repeat=3)
+def _bench_pyramid_zoom_out(ctx):
+    return _pyramid_view_bench(ctx, [0, -1, -2, -3, -4, -5])
+
+
+@benchmark("imgpyramid.view.zoom_in")
+def _bench_pyramid_zoom_in(ctx):
+    return _pyramid_view_bench(ctx, [1, 2])
+
+
+@benchmark("imgpyramid.magnify")
+def _bench_pyramid_magnify(ctx):
+    image = _scan_image(ctx)
+    pyramid = imgpyramid.ImagePyramid(image)
+    rnd = random.Random(0)
+    points = [(rnd.uniform(0, image.width), rnd.uniform(0, image.height))
+              for _ in range(1000)]
+
+    def func():
+        for x, y in points:
+            pyramid.magnify(x, y, 8, 200)
+
+    return func
+
+
+def _measure(func, repeat, number):
+    times = []
+    for _ in range(repeat):
+        tstart = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - tstart) / number)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+DEFAULT_PARAMS = {
+    'layers': 2,
+    'maps': 4,
+    'tiles_x': 16,
+    'tiles_y': 16,
+    'tile_size': 256,
+    'format': 'JPEG',
+    'tar': True,
+    'cut_size': 2048,
+    'track_points': 100000,
+    'corpus_size': 1000,
+    'scan_size': 8192,
+}
+
+
+def run(params=None, names=None, workdir=None, log=None):
+    """Run benchmarks.
+
+    :param params: synthetic data parameters (see DEFAULT_PARAMS)
+    :param names: run only benchmarks which name starts with one of names
+    :param workdir: directory for test data; default: temporary directory
+        (removed after run)
+    :param log: function called with progress messages
+    :return: results dict (meta + results)
+    """
+    par = DEFAULT_PARAMS.copy()
+    par.update(params or {})
+    tmp_dir = None if workdir else tempfile.mkdtemp(prefix="tbviewer_bench_")
+    ctx = Context(workdir or tmp_dir, par)
+    results = {}
+    try:
+        for name, (func, repeat, number) in sorted(_BENCHMARKS.items()):
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            bench = func(ctx)
+            if bench is None:
+                results[name] = {'skipped': True}
+                if log:
+                    log(f"{name}: skipped")
+                continue
+            res = results[name] = _measure(bench, repeat, number)
+            if log:
+                log(f"{name}: median {res['median'] * 1000:0.3f} ms")
+    finally:
+        ctx.close()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'params': par,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare results with baseline.
+
+    :param threshold: allowed relative slowdown of median time
+    :return: list of (name, baseline median, current median, ratio,
+        is regression)
+    """
+    rows = []
+    base_res = baseline['results']
+    for name, cur in sorted(current['results'].items()):
+        base = base_res.get(name)
+        if not base or base.get('skipped') or cur.get('skipped'):
+            continue
+        ratio = cur['median'] / base['median'] if base['median'] else 1.0
+        rows.append((name, base['median'], cur['median'], ratio,
+                     ratio > 1.0 + threshold))
+    return rows
+
+
+def save(results, filename):
+    with open(filename, "w") as ofile:
+        json.dump(results, ofile, indent=2, sort_keys=True)
+
+
+def load(filename):
+    with open(filename) as ifile:
+        return json.load(ifile)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Load test of tiles server (tbviewer.server).
+
+Clients use keep-alive connections; tiles are requested randomly from all
+maps listed by server.
+"""
+
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.parse
+
+
+class _Client:
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._reader = None
+        self._writer = None
+
+    async def get(self, path):
+        """Make GET request; return (status, body)."""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self._host, self._port)
+        self._writer.write(f"GET {path} HTTP/1.1\r\nHost: {self._host}\r\n"
+                           "\r\n".encode('latin1'))
+        head = await self._reader.readuntil(b"\r\n\r\n")
+        lines = head.decode('latin1').split("\r\n")
+        status = int(lines[0].split(' ')[1])
+        length = 0
+        close = False
+        for line in lines[1:]:
+            key, _, val = line.partition(':')
+            key = key.strip().lower()
+            if key == 'content-length':
+                length = int(val)
+            elif key == 'connection' and val.strip().lower() == 'close':
+                close = True
+        body = await self._reader.readexactly(length)
+        if close:
+            self.close()
+        return status, body
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+
+async def _tiles_urls(client):
+    status, body = await client.get("/layers")
+    if status != 200:
+        raise RuntimeError(f"/layers error: {status}")
+    urls = []
+    for layer in json.loads(body):
+        for mapi in layer['maps']:
+            status, body = await client.get(mapi['url'] + "/info")
+            if status != 200:
+                continue
+            info = json.loads(body)
+            urls.extend(
+                f"{mapi['url']}/tiles/{x}/{y}"
+                for x in range(0, info['width'], info['tile_width'])
+                for y in range(0, info['height'], info['tile_height']))
+    return urls
+
+
+async def _run(host, port, requests, concurrency, hot, seed):
+    client = _Client(host, port)
+    urls = await _tiles_urls(client)
+    client.close()
+    if not urls:
+        raise RuntimeError("no tiles")
+
+    rnd = random.Random(seed)
+    if hot:
+        # requests concentrated on small part of tiles
+        hot_urls = rnd.sample(urls, max(len(urls) * hot // 100, 1))
+        paths = [rnd.choice(hot_urls) for _ in range(requests)]
+    else:
+        paths = [rnd.choice(urls) for _ in range(requests)]
+
+    latencies = []
+    errors = 0
+    nbytes = 0
+    queue = iter(paths)
+
+    async def worker():
+        nonlocal errors, nbytes
+        wclient = _Client(host, port)
+        try:
+            for path in queue:
+                tstart = time.perf_counter()
+                try:
+                    status, body = await wclient.get(path)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    wclient.close()
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - tstart)
+                if status != 200:
+                    errors += 1
+                nbytes += len(body)
+        finally:
+            wclient.close()
+
+    tstart = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    total = time.perf_counter() - tstart
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'time': total,
+        'rps': len(latencies) / total,
+        'mbps': nbytes / total / 1024 / 1024,
+        'p50': statistics.median(latencies),
+        'p99': latencies[min(int(len(latencies) * 0.99),
+                             len(latencies) - 1)],
+        'max': latencies[-1],
+    }
+
+
+def run(url, requests=10000, concurrency=32, hot=0, seed=0):
+    """Run load test against server on `url`.
+
+    :param hot: when > 0 - percent of tiles requested (hot tiles)
+    :return: dict with results
+    """
+    parsed = urllib.parse.urlsplit(url)
+    return asyncio.run(_run(parsed.hostname, parsed.port or 80, requests,
+                            concurrency, hot, seed))
+
+
+def start_local_server(path, cache_size=64 * 1024 * 1024):
+    """Start server in background thread on random port; return its url."""
+    from tbviewer import server
+
+    srv = server.TileServer(path, cache_size)
+    started = threading.Event()
+    address = []
+
+    def thread():
+        async def serve():
+            await srv.start('127.0.0.1', 0)
+            address.append(srv.sockets[0].getsockname()[:2])
+            started.set()
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+
+    threading.Thread(target=thread, daemon=True).start()
+    started.wait()
+    host, port = address[0]
+    return f"http://{host}:{port}/"
+
+
+def format_results(res):
+    return (f"requests: {res['requests']}  errors: {res['errors']}  "
+            f"time: {res['time']:0.2f}s\n"
+            f"req/s: {res['rps']:0.1f}  MB/s: {res['mbps']:0.1f}\n"
+            f"latency p50: {res['p50'] * 1000:0.2f}ms  "
+            f"p99: {res['p99'] * 1000:0.2f}ms  "
+            f"max: {res['max'] * 1000:0.2f}ms")
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Synthetic maps & atlases generator."""
+
+import io
+import math
+import os
+import os.path
+import random
+import re
+import shutil
+import tarfile
+
+from PIL import Image
+
+from tbviewer import mapfile
+
+
+def make_image(width, height, seed=0):
+    """Create rgb image with some not-trivial content."""
+    rnd = random.Random(seed)
+    x0 = rnd.uniform(-2.0, -1.0)
+    y0 = rnd.uniform(-1.5, -0.5)
+    bands = (
+        Image.effect_mandelbrot((width, height), (x0, y0, x0 + 2, y0 + 2),
+                                50 + seed % 50),
+        Image.linear_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 32 + seed % 32),
+    )
+    return Image.merge('RGB', bands)
+
+
+def make_map_content(width, height, name, lon=19.0, lat=50.0, size=0.5):
+    """Create content of .map file for `width`x`height` image.
+
+    Map covers `size` degrees from (lon, lat) north-west corner.
+    """
+    mfile = mapfile.MapFile()
+    mfile.img_filename = name + ".png"
+    mfile.image_width = width
+    mfile.image_height = height
+    corners = [(0, 0, lon, lat), (width, 0, lon + size, lat),
+               (width, height, lon + size, lat - size),
+               (0, height, lon, lat - size)]
+    mfile.set_points([mapfile.Point(x, y, plon, plat, idx)
+                      for idx, (x, y, plon, plat) in enumerate(corners)])
+    mfile.calibrate()
+    return mfile.to_str()
+
+
+def make_map_corpus(count=1000, seed=0):
+    """Create list of .map files content for maps in random locations."""
+    rnd = random.Random(seed)
+    corpus = []
+    for idx in range(count):
+        width = rnd.randrange(256, 20000)
+        height = rnd.randrange(256, 20000)
+        size = rnd.uniform(0.01, 2.0)
+        corpus.append(make_map_content(
+            width, height, f"map{idx}", rnd.uniform(-179.0, 177.0),
+            rnd.uniform(-88.0, 89.0), size))
+    return corpus
+
+
+def _tile_bytes(tile, fmt):
+    buf = io.BytesIO()
+    if fmt == 'PNG':
+        tile.save(buf, 'PNG')
+    else:
+        tile.save(buf, 'JPEG', quality=80)
+    return buf.getvalue()
+
+
+def make_map(dst_dir, name, tiles_x=8, tiles_y=8, tile_size=256,
+             fmt='JPEG', tar=True, lon=19.0, lat=50.0, seed=0):
+    """Create synthetic trekbuddy map in `dst_dir`/`name`.
+
+    Tiles are cropped from few generated images to avoid cost of
+    creating big image.
+
+    :return: path to created map (.tar or .map file)
+    """
+    map_dir = os.path.join(dst_dir, name)
+    os.makedirs(map_dir, exist_ok=True)
+    ext = 'png' if fmt == 'PNG' else 'jpg'
+    width, height = tiles_x * tile_size, tiles_y * tile_size
+    pattern = make_image(tile_size * 4, tile_size * 4, seed)
+
+    files = []
+    map_fname = name + ".map"
+    files.append((map_fname, make_map_content(
+        width, height, name, lon, lat).encode('cp1250')))
+    tile_names = []
+    for tyi in range(tiles_y):
+        for txi in range(tiles_x):
+            tx, ty = txi * tile_size, tyi * tile_size
+            px = (txi % 4) * tile_size
+            py = (tyi % 4) * tile_size
+            tile = pattern.crop((px, py, px + tile_size, py + tile_size))
+            tname = f"{name}_{tx}_{ty}.{ext}"
+            tile_names.append(tname)
+            files.append(("set/" + tname, _tile_bytes(tile, fmt)))
+    files.insert(1, (name + ".set", "\n".join(tile_names).encode()))
+
+    if tar:
+        tar_fname = os.path.join(map_dir, name + ".tar")
+        with tarfile.open(tar_fname, "w") as tfile:
+            for fname, content in files:
+                tinfo = tarfile.TarInfo(fname)
+                tinfo.size = len(content)
+                tfile.addfile(tinfo, io.BytesIO(content))
+        return tar_fname
+
+    os.makedirs(os.path.join(map_dir, "set"), exist_ok=True)
+    for fname, content in files:
+        with open(os.path.join(map_dir, fname), "wb") as ofile:
+            ofile.write(content)
+    return os.path.join(map_dir, map_fname)
+
+
+def _clear_atlas_dir(dst_dir, force):
+    """Remove files created by `make_atlas`; other files are kept."""
+    names = os.listdir(dst_dir)
+    if not names:
+        return
+    if not force:
+        raise FileExistsError(f"destination {dst_dir} is not empty")
+    for name in names:
+        path = os.path.join(dst_dir, name)
+        if name in ("atlas.tba", "atlas.tar") and os.path.isfile(path):
+            os.unlink(path)
+        elif re.fullmatch(r"layer\d+", name) and os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def make_atlas(dst_dir, layers=2, maps=4, tiles_x=8, tiles_y=8,
+               tile_size=256, fmt='JPEG', tar=True, pack=False,
+               force=False):
+    """Create synthetic atlas in `dst_dir`.
+
+    :param layers: number of layers
+    :param maps: number of maps in each layer
+    :param tar: create tarred maps
+    :param pack: create also tar-atlas (atlas.tar) with whole atlas
+    :param force: replace atlas in not empty `dst_dir`; only files created
+        by generator are removed
+    :return: path to atlas .tba file (or .tar file when `pack`)
+    """
+    if os.path.isdir(dst_dir):
+        _clear_atlas_dir(dst_dir, force)
+    else:
+        os.makedirs(dst_dir)
+    tba_fname = os.path.join(dst_dir, "atlas.tba")
+    with open(tba_fname, "w") as tba:
+        tba.write("Atlas 1.0\n")
+
+    seed = 0
+    for lidx in range(layers):
+        layer_dir = os.path.join(dst_dir, f"layer{lidx}")
+        for midx in range(maps):
+            make_map(layer_dir, f"map{lidx}_{midx}", tiles_x, tiles_y,
+                     tile_size, fmt, tar, lon=19.0 + midx * 0.5,
+                     lat=50.0 - lidx * 0.1, seed=seed)
+            seed += 1
+
+    if not pack:
+        return tba_fname
+
+    tar_fname = os.path.join(dst_dir, "atlas.tar")
+    with tarfile.open(tar_fname, "w") as tfile:
+        for name in sorted(os.listdir(dst_dir)):
+            if name != "atlas.tar":
+                tfile.add(os.path.join(dst_dir, name), name)
+    return tar_fname
+
+
+def make_gpx(filename, points=100000, lon=19.1, lat=49.9, step=2e-5,
+             seed=0):
+    """Create gpx file with one random-walk track."""
+    rnd = random.Random(seed)
+    angle = 0.0
+    with open(filename, "w") as gpx:
+        gpx.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<gpx version="1.1" '
+                  'xmlns="http://www.topografix.com/GPX/1/1">\n'
+                  '<trk><trkseg>\n')
+        for _ in range(points):
+            angle += rnd.uniform(-0.2, 0.2)
+            lon += math.cos(angle) * step
+            lat += math.sin(angle) * step
+            gpx.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}">'
+                      '<ele>100</ele></trkpt>\n')
+        gpx.write('</trkseg></trk></gpx>\n')
+    return filename
@@ -31,7 +31,7 @@ setup(
     download_url='',
     license='GPL v3',
     py_modules=[],
-    packages=find_packages('.'),
+    packages=find_packages('.', exclude=['benchmarks']),
     package_dir={'': '.'},
     include_package_data=True,
     install_requires=REQUIRES,
@@ -39,6 +39,15 @@ setup(
        [console_scripts]
        tbviewer = tbviewer.main:run_viewer
        tbcalibrate = tbviewer.main:run_calibrate
+       tbbatch = tbviewer.main:run_batch
+       tbserve = tbviewer.main:run_serve
+       tbexport = tbviewer.main:run_export
+       tbmbtiles = tbviewer.main:run_mbtiles
+       tbxyz = tbviewer.main:run_xyz
+       tbimport = tbviewer.main:run_import
+       tbretile = tbviewer.main:run_retile
+       tbtranscode = tbviewer.main:run_transcode
+       tbverify = tbviewer.main:run_verify
     """,
     zip_safe=True,
 )
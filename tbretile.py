@@ -0,0 +1,19 @@
+#!/usr/bin/python3 -OO
+# -*- coding: utf-8 -*-
+#
+# Copyright © Karol Będkowski, 2015-2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Start re-tiling map."""
+
+__author__ = "Karol Będkowski"
+__copyright__ = "Copyright (c) Karol Będkowski, 2015-2020"
+__version__ = "2015-05-10"
+
+
+from tbviewer import main
+
+if __name__ == "__main__":
+    main.run_retile()
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Public API for programmatic access to atlases and maps.
+
+This module (and modules it use) don't import tkinter, so it can be used
+in batch jobs and servers without gui libraries.
+
+Example::
+
+    from tbviewer import api
+
+    with api.open_atlas("atlas.tar") as atlas:
+        for layer, name, path in api.iter_maps(atlas):
+            with api.open_map(path, atlas) as tbmap:
+                img = api.read_region(tbmap, 0, 0, 1024, 1024)
+"""
+
+from . import map_loader
+from .errors import InvalidFileException
+from .mapfile import MapFile
+
+__all__ = (
+    'InvalidFileException', 'MapFile',
+    'open_atlas', 'open_map', 'iter_maps', 'read_tile', 'decode_tile',
+    'read_region',
+)
+
+
+def open_atlas(path):
+    """Open atlas (.tba, tar atlas) or single map (.map, .tar, .mbtiles).
+
+    Single map is represented as atlas with one layer.
+    Result can be used as context manager.
+
+    :return: `map_loader.Atlas` or `map_loader.FakeAlbum`
+    """
+    file_type, fs = map_loader.sniff_file_type(path)
+    if file_type in ('atlas', 'tar-atlas'):
+        return map_loader.Atlas(path, fs)
+    if file_type in ('map', 'tar-map', 'mbtiles-map'):
+        return map_loader.FakeAlbum(path, fs)
+    raise InvalidFileException(
+        "Invalid file - should be .map or .tar or .tba")
+
+
+def open_map(path, atlas=None):
+    """Open map; path as returned by `iter_maps`.
+
+    Result can be used as context manager.
+
+    :param atlas: atlas containing map; allow reuse already opened file
+    :return: `map_loader.Map`
+    """
+    if atlas is not None:
+        return atlas.open_map(path)
+    return map_loader.Map(path)
+
+
+def iter_maps(atlas):
+    """Iterate over maps in atlas.
+
+    :return: iterator of (layer name, map name, map path)
+    """
+    for layer, maps in atlas.layers:
+        for name, path in maps:
+            yield layer, name, path
+
+
+def read_tile(tbmap, x, y):
+    """Read raw (encoded) tile; None when tile not exists.
+
+    :param x, y: position of tile top-left corner in map pixels
+    """
+    return tbmap.get_tile_bytes(x, y)
+
+
+def decode_tile(tbmap, x, y, scale=1):
+    """Read tile and decode it to PIL image; None when tile not exists."""
+    return tbmap.get_tile_image(x, y, scale)
+
+
+def read_region(tbmap, x, y, width, height, mode='RGB'):
+    """Read rectangular region of map as PIL image."""
+    return tbmap.get_region(x, y, width, height, mode)
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Parallel scanning atlas maps metadata with persistent cache."""
+
+import logging
+import multiprocessing
+import os
+import os.path
+import sqlite3
+import time
+from concurrent import futures
+
+from . import mapfile
+from . import map_loader
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# scan maps in process pool only when there are more maps to scan
+_MIN_MAPS_FOR_POOL = 8
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    map_content TEXT,
+    tiles INTEGER,
+    tile_width INTEGER,
+    tile_height INTEGER,
+    error TEXT
+)
+"""
+
+
+class MapInfo:
+    """Metadata of one map in atlas."""
+
+    __slots__ = ('layer', 'name', 'path', 'map_content', 'tiles',
+                 'tile_width', 'tile_height', 'error', '_map_file')
+
+    def __init__(self, layer, name, path, map_content=None, tiles=0,
+                 tile_width=None, tile_height=None, error=None):
+        self.layer = layer
+        self.name = name
+        self.path = path
+        self.map_content = map_content
+        self.tiles = tiles
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.error = error
+        self._map_file = None
+
+    def __repr__(self):
+        return f"<MapInfo {self.layer}/{self.name} tiles={self.tiles} " \
+            f"error={self.error}>"
+
+    @property
+    def map_file(self):
+        """Parsed .map file; None when missing or invalid."""
+        if self._map_file is None and self.map_content:
+            map_file = mapfile.MapFile()
+            try:
+                map_file.parse_map(self.map_content)
+            except InvalidFileException as err:
+                _LOG.warning("invalid map file %s: %s", self.path, err)
+                return None
+            self._map_file = map_file
+        return self._map_file
+
+
+def default_cache_file():
+    """Default location of cache database."""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "tbviewer", "atlas.sqlite")
+
+
+def _map_source_file(path):
+    """Find file that contains map data; used as cache key."""
+    if os.path.isfile(path):
+        return path
+    # pylint: disable=protected-access
+    return map_loader._find_file_in_dir(path, ".tar") or \
+        map_loader._find_file_in_dir(path, ".mbtiles") or \
+        map_loader._find_file_in_dir(path, ".map")
+
+
+def _file_stat(path):
+    """Get (size, mtime) of map used to detect changes.
+
+    Tiles of untarred maps may change without changing .map file, so for
+    them also .set file and set/ directory are checked.
+    """
+    try:
+        source = _map_source_file(path)
+        if not source:
+            return None, None
+        stat = os.stat(source)
+        size, mtime = stat.st_size, stat.st_mtime
+        if source.endswith(".map"):
+            map_dir = os.path.dirname(source)
+            # pylint: disable=protected-access
+            set_file = map_loader._find_file_in_dir(map_dir, ".set")
+            if set_file:
+                stat = os.stat(set_file)
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+            set_dir = os.path.join(map_dir, "set")
+            if os.path.isdir(set_dir):
+                mtime = max(mtime, os.stat(set_dir).st_mtime)
+        return size, mtime
+    except OSError:
+        pass
+    return None, None
+
+
+def scan_map(path):
+    """Read map metadata; run in worker process.
+
+    :return: (map content, number of tiles, tile width, tile height,
+        error message)
+    """
+    # pylint: disable=protected-access
+    try:
+        fs = map_loader._open_map_fs(path)
+    except (IOError, OSError) as err:
+        return None, 0, None, None, str(err)
+    if fs is None:
+        return None, 0, None, None, "map not found"
+
+    try:
+        map_filename = map_loader._find_map_file(fs)
+        content = fs.get_file_content(map_filename) if map_filename \
+            else None
+        positions = [pos for pos, _ in map_loader._load_set(fs)]
+        tile_width, tile_height = map_loader._find_tile_size(positions)
+        return content, len(positions), tile_width, tile_height, None
+    except Exception as err:  # pylint: disable=broad-except
+        return None, 0, None, None, str(err)
+    finally:
+        fs.close()
+
+
+class _Cache:
+    def __init__(self, filename):
+        self._conn = None
+        if not filename:
+            return
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            self._conn = sqlite3.connect(filename)
+            self._conn.execute(_SCHEMA)
+        except (sqlite3.Error, OSError) as err:
+            _LOG.warning("can't open cache %s: %s", filename, err)
+            self._conn = None
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+
+    def get(self, path, size, mtime):
+        if not self._conn:
+            return None
+        row = self._conn.execute(
+            "SELECT map_content, tiles, tile_width, tile_height, error "
+            "FROM maps WHERE path=? AND size=? AND mtime=?",
+            (path, size, mtime)).fetchone()
+        return row
+
+    def put_many(self, rows):
+        if not self._conn or not rows:
+            return
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO maps (path, size, mtime, "
+                "map_content, tiles, tile_width, tile_height, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def scan_atlas(layers, cache_file=None, workers=None):
+    """Get metadata for all maps in atlas.
+
+    Maps not found in cache (or changed) are scanned in process pool and
+    results are stored in cache.
+
+    :param layers: atlas layers (list of (layer, list of (name, path)))
+    :param cache_file: sqlite cache file name; default:
+        `default_cache_file()`; use empty string to disable cache
+    :param workers: number of worker processes
+    :return: list of MapInfo
+    """
+    tstart = time.time()
+    if cache_file is None:
+        cache_file = default_cache_file()
+    cache = _Cache(cache_file)
+    infos = []
+    to_scan = []
+    try:
+        for layer, maps in layers:
+            for name, path in maps:
+                size, mtime = _file_stat(path)
+                row = cache.get(os.path.abspath(path), size, mtime) \
+                    if size is not None else None
+                if row:
+                    infos.append(MapInfo(layer, name, path, *row))
+                else:
+                    info = MapInfo(layer, name, path)
+                    infos.append(info)
+                    to_scan.append((info, size, mtime))
+
+        if to_scan:
+            paths = [info.path for info, _, _ in to_scan]
+            if len(paths) < _MIN_MAPS_FOR_POOL or workers == 1:
+                results = list(map(scan_map, paths))
+            else:
+                # scan may be called from gui; forking process with
+                # running tk is not safe
+                mp_context = multiprocessing.get_context("spawn")
+                with futures.ProcessPoolExecutor(workers, mp_context) \
+                        as executor:
+                    results = list(executor.map(scan_map, paths,
+                                                chunksize=16))
+            rows = []
+            for (info, size, mtime), res in zip(to_scan, results):
+                (info.map_content, info.tiles, info.tile_width,
+                 info.tile_height, info.error) = res
+                if size is not None:
+                    rows.append((os.path.abspath(info.path), size, mtime) +
+                                tuple(res))
+            cache.put_many(rows)
+    finally:
+        cache.close()
+
+    _LOG.debug("scan_atlas: maps=%d scanned=%d in %0.3fs", len(infos),
+               len(to_scan), time.time() - tstart)
+    return infos
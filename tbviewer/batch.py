@@ -0,0 +1,279 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Batch (non-gui) Trekbuddy maps creation."""
+
+import optparse
+import logging
+import os
+import os.path
+import shlex
+import time
+from concurrent import futures
+
+from . import version
+from . import mapmaker
+
+_LOG = logging.getLogger(__name__)
+
+
+class Job:
+    """One map to create: source image + .map file -> trekbuddy map."""
+
+    def __init__(self, img_filename, map_filename, dst_file):
+        self.img_filename = img_filename
+        self.map_filename = map_filename
+        self.dst_file = dst_file
+
+    def __repr__(self):
+        return f"<Job {self.img_filename} {self.map_filename} " \
+            f"-> {self.dst_file}>"
+
+    @property
+    def name(self):
+        return os.path.splitext(os.path.basename(self.dst_file))[0]
+
+
+def _default_dst_file(map_filename, output_dir, used):
+    # each map require own directory (for set/ and tar); maps with the same
+    # name (from different directories) get numeric suffix
+    base = os.path.splitext(os.path.basename(map_filename))[0]
+    name = base
+    idx = 1
+    while name in used:
+        idx += 1
+        name = f"{base}_{idx}"
+    used.add(name)
+    return os.path.join(output_dir, name, name + ".map")
+
+
+def _check_dst_dirs(jobs):
+    """Check that each job has own destination directory."""
+    dirs = {}
+    for job in jobs:
+        dst_dir = os.path.dirname(os.path.abspath(job.dst_file))
+        other = dirs.setdefault(dst_dir, job)
+        if other is not job:
+            raise ValueError(
+                f"{job.map_filename} and {other.map_filename} have the same "
+                f"destination directory {dst_dir}")
+
+
+def load_jobs_file(filename, output_dir):
+    """Load jobs from file.
+
+    Each not empty line (except comments starting with #) contains image
+    file name, .map file name and optionally destination .map file name;
+    names are separated by whitespace and may be quoted.
+
+    :param filename: jobs file name
+    :param output_dir: base directory for maps without destination
+    :return: list of Job
+    """
+    jobs = []
+    used = set()
+    with open(filename) as jfile:
+        for lineno, line in enumerate(jfile, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = shlex.split(line)
+            if len(fields) not in (2, 3):
+                raise ValueError(f"{filename}:{lineno}: invalid job line")
+            img_filename, map_filename = fields[:2]
+            dst_file = fields[2] if len(fields) == 3 else \
+                _default_dst_file(map_filename, output_dir, used)
+            jobs.append(Job(img_filename, map_filename, dst_file))
+    return jobs
+
+
+def jobs_from_args(args, output_dir):
+    """Create jobs from list of image and .map files pairs."""
+    if len(args) % 2:
+        raise ValueError("expected pairs of image and .map files")
+    used = set()
+    return [Job(img_filename, map_filename,
+                _default_dst_file(map_filename, output_dir, used))
+            for img_filename, map_filename in zip(args[::2], args[1::2])]
+
+
+class _State:
+    """Persistent list of finished jobs (append-only file)."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._done = set()
+        if filename and os.path.isfile(filename):
+            with open(filename) as sfile:
+                self._done = set(line.rstrip("\n") for line in sfile)
+
+    def is_done(self, job):
+        return os.path.abspath(job.dst_file) in self._done
+
+    def mark_done(self, job):
+        dst_file = os.path.abspath(job.dst_file)
+        self._done.add(dst_file)
+        if self._filename:
+            with open(self._filename, "a") as sfile:
+                sfile.write(dst_file + "\n")
+
+
+def _run_job(job, options):
+    """Create one map; run in worker process.
+
+    :return: (number of created tiles, size of created tiles in bytes,
+        time)
+    """
+    tstart = time.time()
+    with open(job.map_filename) as mfile:
+        map_content = mfile.read()
+
+    dst_dir = os.path.dirname(job.dst_file)
+    if dst_dir:
+        os.makedirs(dst_dir, exist_ok=True)
+    tiles, size = mapmaker.create_map(job.img_filename, map_content,
+                                      job.dst_file, options)
+    return tiles, size, time.time() - tstart
+
+
+def run_jobs(jobs, options, workers=None, state_file=None, force=False):
+    """Create maps for `jobs` in process pool.
+
+    :param jobs: list of Job
+    :param options: options for `mapmaker.create_map`
+    :param workers: number of worker processes; default: number of cpus
+    :param state_file: file with list of finished jobs; used to resume
+        interrupted work
+    :param force: create maps also for finished jobs
+    :return: summary dict
+    :raise ValueError: when jobs have the same destination directory
+    """
+    _check_dst_dirs(jobs)
+    state = _State(state_file)
+    summary = {
+        'jobs': len(jobs), 'done': 0, 'failed': 0, 'skipped': 0,
+        'tiles': 0, 'bytes': 0, 'time': 0.0,
+    }
+    todo = []
+    for job in jobs:
+        if not force and state.is_done(job):
+            _LOG.info("skipping finished %s", job.dst_file)
+            summary['skipped'] += 1
+        else:
+            todo.append(job)
+
+    tstart = time.time()
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_run_job, job, options): job
+                   for job in todo}
+        for num, fut in enumerate(futures.as_completed(pending), 1):
+            job = pending[fut]
+            try:
+                tiles, size, jtime = fut.result()
+            except Exception as err:  # pylint: disable=broad-except
+                _LOG.error("[%d/%d] %s failed: %s", num, len(todo),
+                           job.name, err)
+                summary['failed'] += 1
+                continue
+
+            state.mark_done(job)
+            summary['done'] += 1
+            summary['tiles'] += tiles
+            summary['bytes'] += size
+            _LOG.info("[%d/%d] %s: %d tiles, %0.1f MB in %0.1fs",
+                      num, len(todo), job.name, tiles, size / 1048576.,
+                      jtime)
+
+    summary['time'] = ttime = time.time() - tstart
+    summary['tiles_per_sec'] = summary['tiles'] / ttime if ttime else 0.
+    summary['mb_per_sec'] = \
+        summary['bytes'] / 1048576. / ttime if ttime else 0.
+    return summary
+
+
+def format_summary(summary):
+    """Format summary returned by `run_jobs`."""
+    return ("jobs: {jobs} (done: {done}, failed: {failed}, skipped: "
+            "{skipped}); tiles: {tiles}; size: {mb:0.1f} MB; time: "
+            "{time:0.1f}s; {tiles_per_sec:0.1f} tiles/s; "
+            "{mb_per_sec:0.2f} MB/s").format(
+                mb=summary['bytes'] / 1048576., **summary)
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] [<image file> <map file>]...")
+    optp.add_option("--jobs-file", "-j",
+                    help="load jobs from file (lines: image map [dst map])")
+    optp.add_option("--output-dir", "-o", default=".",
+                    help="base directory for created maps")
+    optp.add_option("--workers", "-w", type="int",
+                    help="number of worker processes")
+    optp.add_option("--state",
+                    help="file with finished jobs used for resume; "
+                    "default: <output dir>/.tbbatch-state")
+    optp.add_option("--force", action="store_true", default=False,
+                    help="recreate finished maps and all tiles")
+
+    group = optparse.OptionGroup(optp, "Map options")
+    group.add_option("--tile-size", default="256x256",
+                     help="tile size (WIDTHxHEIGHT)")
+    group.add_option("--format", choices=("JPEG", "PNG"), default="JPEG",
+                     help="tiles format (JPEG, PNG)")
+    group.add_option("--jpeg-quality", type="int", default=80)
+    group.add_option("--png-compression", default="optimized",
+                     help="0-9 or optimized")
+    group.add_option("--png-palette", default="RGB",
+                     choices=("RGB", "256c", "256c global"))
+    group.add_option("--no-tar", action="store_true", default=False,
+                     help="don't create tar file")
+    optp.add_option_group(group)
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run batch map creation for parsed cli options."""
+    # progress messages should be visible also in non-debug mode
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+
+    try:
+        if options.jobs_file:
+            jobs = load_jobs_file(options.jobs_file, options.output_dir)
+        else:
+            jobs = jobs_from_args(args, options.output_dir)
+        _check_dst_dirs(jobs)
+        tile_w, tile_h = map(int, options.tile_size.lower().split('x'))
+    except (IOError, ValueError) as err:
+        _LOG.error("%s", err)
+        return 1
+
+    map_options = {
+        'tile_size': (tile_w, tile_h),
+        'create_tar': not options.no_tar,
+        'force': options.force,
+        'format': options.format,
+        'jpeg_quality': options.jpeg_quality,
+        'png_compression': options.png_compression,
+        'png_palette': options.png_palette,
+    }
+    state_file = options.state or \
+        os.path.join(options.output_dir, ".tbbatch-state")
+    _LOG.info("starting %d jobs", len(jobs))
+    summary = run_jobs(jobs, map_options, options.workers, state_file,
+                       options.force)
+    _LOG.info("finished; %s", format_summary(summary))
+    return 1 if summary['failed'] else 0
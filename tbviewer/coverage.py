@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Spatial index of area covered by maps in atlas."""
+
+import logging
+import math
+
+_LOG = logging.getLogger(__name__)
+
+# index cell size in degrees
+_CELL_SIZE = 0.25
+
+
+class MapCoverage:
+    """Area covered by one map."""
+
+    __slots__ = ('layer', 'name', 'path', 'polygon', 'bbox', 'resolution')
+
+    def __init__(self, layer, name, path, polygon, resolution):
+        """Create map coverage.
+
+        :param polygon: map corners (lon, lat) - nw, ne, se, sw
+        :param resolution: meters per pixel
+        """
+        self.layer = layer
+        self.name = name
+        self.path = path
+        self.polygon = [tuple(point) for point in polygon]
+        self.resolution = resolution
+        lons = [point[0] for point in self.polygon]
+        lats = [point[1] for point in self.polygon]
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+
+    def __repr__(self):
+        return f"<MapCoverage {self.layer}/{self.name} {self.bbox} " \
+            f"{self.resolution}>"
+
+    @classmethod
+    def from_map_file(cls, layer, name, path, map_file):
+        """Create coverage from calibration in `mapfile.MapFile`."""
+        if not map_file or len(map_file.mmpll) < 4:
+            return None
+        resolution = map_file.mm1b
+        if not resolution:
+            resolution = _estimate_resolution(map_file)
+        return cls(layer, name, path, map_file.mmpll[:4], resolution)
+
+    def contains(self, lon, lat):
+        """Check is point inside map polygon."""
+        lon0, lat0, lon1, lat1 = self.bbox
+        if not (lon0 <= lon <= lon1 and lat0 <= lat <= lat1):
+            return False
+        return _point_in_polygon(lon, lat, self.polygon)
+
+
+def _estimate_resolution(map_file):
+    (lon0, lat0), (lon1, _lat1) = map_file.mmpll[:2]
+    dist = abs((lon1 - lon0) * math.pi / 180.0 * 6378137.0 *
+               math.cos(math.radians(lat0)))
+    return dist / map_file.image_width if map_file.image_width else 0.0
+
+
+def _point_in_polygon(x, y, polygon):
+    inside = False
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        if (y2 > y) != (y1 > y) and \
+                x < (x1 - x2) * (y - y2) / (y1 - y2) + x2:
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def _cells(lon0, lat0, lon1, lat1):
+    for cx in range(math.floor(lon0 / _CELL_SIZE),
+                    math.floor(lon1 / _CELL_SIZE) + 1):
+        for cy in range(math.floor(lat0 / _CELL_SIZE),
+                        math.floor(lat1 / _CELL_SIZE) + 1):
+            yield cx, cy
+
+
+class CoverageIndex:
+    """Spatial index of maps coverage."""
+
+    def __init__(self, maps=()):
+        self.maps = []
+        # (cell x, cell y) -> list of maps indexes
+        self._cells = {}
+        for cov in maps:
+            self.add(cov)
+
+    def __len__(self):
+        return len(self.maps)
+
+    def add(self, cov):
+        """Add `MapCoverage` to index."""
+        idx = len(self.maps)
+        self.maps.append(cov)
+        for cell in _cells(*cov.bbox):
+            self._cells.setdefault(cell, []).append(idx)
+
+    def maps_at(self, lon, lat):
+        """Find maps covering point; best resolution first."""
+        cell = (math.floor(lon / _CELL_SIZE), math.floor(lat / _CELL_SIZE))
+        found = [self.maps[idx] for idx in self._cells.get(cell, ())
+                 if self.maps[idx].contains(lon, lat)]
+        found.sort(key=lambda cov: cov.resolution)
+        return found
+
+    def maps_in_bbox(self, lon0, lat0, lon1, lat1):
+        """Find maps which bounding box intersect given bbox."""
+        found = set()
+        for cell in _cells(lon0, lat0, lon1, lat1):
+            found.update(self._cells.get(cell, ()))
+        res = []
+        for idx in sorted(found):
+            cov = self.maps[idx]
+            blon0, blat0, blon1, blat1 = cov.bbox
+            if blon0 <= lon1 and blon1 >= lon0 and blat0 <= lat1 and \
+                    blat1 >= lat0:
+                res.append(cov)
+        res.sort(key=lambda cov: cov.resolution)
+        return res
+
+
+def build_index(layers, load_map_file):
+    """Build index for maps in atlas layers.
+
+    :param layers: list of (layer name, list of (map name, map path))
+    :param load_map_file: function returning `mapfile.MapFile` for map path
+    """
+    index = CoverageIndex()
+    for layer, maps in layers:
+        for name, path in maps:
+            try:
+                map_file = load_map_file(path)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOG.warning("loading %s error: %s", path, err)
+                continue
+            cov = MapCoverage.from_map_file(layer, name, path, map_file)
+            if cov:
+                index.add(cov)
+            else:
+                _LOG.info("map %s not calibrated", path)
+    _LOG.debug("build_index: %d maps", len(index))
+    return index
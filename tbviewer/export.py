@@ -0,0 +1,413 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Export region of tiled map to one image.
+
+Image is rendered in bands of rows; PNG and TIFF files are written band by
+band so memory usage don't depend on size of exported image. Other
+formats (i.e. JPEG) are saved by PIL and require whole image in memory, so
+they are limited to `MAX_BUFFERED_PIXELS`.
+"""
+
+import logging
+import math
+import optparse
+import os.path
+import struct
+import time
+import zlib
+
+from PIL import Image
+
+from . import map_loader
+from . import profiling
+from . import version
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# extra source pixels around band required by LANCZOS filter
+_FILTER_SUPPORT = 3
+# max size of images in formats that are not written band by band
+MAX_BUFFERED_PIXELS = 64 * 1024 * 1024
+# formats written band by band
+_STREAMED_FORMATS = ('PNG', 'TIFF')
+
+_FORMATS = {
+    '.png': 'PNG',
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+}
+
+
+class _PngWriter:
+    """Write PNG file row by row."""
+
+    _COLOR_TYPES = {'L': 0, 'RGB': 2, 'RGBA': 6}
+
+    def __init__(self, ofile, width, height, mode, compress_level=6):
+        self._ofile = ofile
+        self._compressor = zlib.compressobj(compress_level)
+        self._buf = []
+        self._buf_size = 0
+        ofile.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, 8, self._COLOR_TYPES[mode], 0, 0, 0))
+
+    def _chunk(self, ctype, data):
+        self._ofile.write(struct.pack('>I', len(data)) + ctype + data +
+                          struct.pack('>I', zlib.crc32(ctype + data)))
+
+    def _flush(self, force=False):
+        if self._buf_size >= 65536 or (force and self._buf):
+            self._chunk(b'IDAT', b''.join(self._buf))
+            self._buf = []
+            self._buf_size = 0
+
+    def write_band(self, band):
+        data = band.tobytes()
+        stride = len(data) // band.height
+        # each row prefixed by filter type (0 - none)
+        raw = b''.join(b'\x00' + data[idx:idx + stride]
+                       for idx in range(0, len(data), stride))
+        compressed = self._compressor.compress(raw)
+        if compressed:
+            self._buf.append(compressed)
+            self._buf_size += len(compressed)
+            self._flush()
+
+    def close(self):
+        self._buf.append(self._compressor.flush())
+        self._flush(True)
+        self._chunk(b'IEND', b'')
+
+
+class _TiffWriter:
+    """Write uncompressed TIFF; each band is one strip, IFD is written at
+    the end of file."""
+
+    _SHORT, _LONG, _RATIONAL = 3, 4, 5
+
+    def __init__(self, ofile, width, height, mode, band_height):
+        samples = len(mode)
+        if width * height * samples >= 2 ** 32 - 65536:
+            raise ValueError("Image too big for TIFF file; use PNG")
+        self._ofile = ofile
+        self._width = width
+        self._height = height
+        self._mode = mode
+        self._band_height = band_height
+        self._strips = []
+        ofile.write(b'II*\x00\x00\x00\x00\x00')
+
+    def write_band(self, band):
+        data = band.tobytes()
+        self._strips.append((self._ofile.tell(), len(data)))
+        self._ofile.write(data)
+
+    def close(self):
+        ofile = self._ofile
+        if ofile.tell() % 2:
+            ofile.write(b'\x00')
+        samples = len(self._mode)
+        entries = [
+            (256, self._LONG, [self._width]),
+            (257, self._LONG, [self._height]),
+            (258, self._SHORT, [8] * samples),
+            (259, self._SHORT, [1]),
+            (262, self._SHORT, [1 if self._mode == 'L' else 2]),
+            (273, self._LONG, [offset for offset, _ in self._strips]),
+            (277, self._SHORT, [samples]),
+            (278, self._LONG, [self._band_height]),
+            (279, self._LONG, [size for _, size in self._strips]),
+            (282, self._RATIONAL, [72, 1]),
+            (283, self._RATIONAL, [72, 1]),
+            (284, self._SHORT, [1]),
+            (296, self._SHORT, [2]),
+        ]
+        if self._mode == 'RGBA':
+            # unassociated alpha
+            entries.append((338, self._SHORT, [2]))
+
+        ifd_offset = ofile.tell()
+        # values that don't fit in entry are stored after IFD
+        extra_offset = ifd_offset + 2 + len(entries) * 12 + 4
+        ifd = [struct.pack('<H', len(entries))]
+        extra = []
+        for tag, vtype, values in entries:
+            fmt = 'H' if vtype == self._SHORT else 'I'
+            data = struct.pack('<%d%s' % (len(values), fmt), *values)
+            count = len(values) // 2 if vtype == self._RATIONAL \
+                else len(values)
+            if len(data) <= 4:
+                ifd.append(struct.pack('<HHI', tag, vtype, count) +
+                           data.ljust(4, b'\x00'))
+            else:
+                ifd.append(struct.pack('<HHII', tag, vtype, count,
+                                       extra_offset))
+                extra.append(data)
+                extra_offset += len(data)
+        ifd.append(struct.pack('<I', 0))
+        ofile.write(b''.join(ifd) + b''.join(extra))
+        ofile.seek(4)
+        ofile.write(struct.pack('<I', ifd_offset))
+
+
+class _PilWriter:
+    """Collect bands in one image and save it by PIL."""
+
+    def __init__(self, ofile, width, height, mode, fmt, options):
+        self._ofile = ofile
+        self._fmt = fmt
+        self._options = options
+        self._image = Image.new(mode, (width, height))
+        self._y = 0
+
+    def write_band(self, band):
+        self._image.paste(band, (0, self._y))
+        self._y += band.height
+
+    def close(self):
+        image = self._image
+        if self._fmt == 'JPEG' and image.mode == 'RGBA':
+            image = image.convert('RGB')
+        image.save(self._ofile, self._fmt, **self._options)
+
+
+class _BandReader:
+    """Read map regions keeping decoded tiles for next bands."""
+
+    def __init__(self, tbmap, mode):
+        self._map = tbmap
+        self._mode = mode
+        # (x, y) -> decoded tile
+        self._tiles = {}
+        self.tiles_read = 0
+
+    def read(self, x0, y0, x1, y1):
+        tbmap = self._map
+        tile_width, tile_height = tbmap.tile_width, tbmap.tile_height
+        tiles = self._tiles
+        # drop tiles above current band; bands are read top to bottom
+        for key in [key for key in tiles if key[1] + tile_height <= y0]:
+            del tiles[key]
+
+        region = Image.new(self._mode, (x1 - x0, y1 - y0))
+        for ty in range(y0 - y0 % tile_height, y1, tile_height):
+            for tx in range(x0 - x0 % tile_width, x1, tile_width):
+                tile = tiles.get((tx, ty))
+                if tile is None:
+                    if (tx, ty) not in tbmap.set_data:
+                        continue
+                    tile = tbmap.get_tile_image(tx, ty)
+                    if tile.mode != self._mode:
+                        tile = tile.convert(self._mode)
+                    tiles[(tx, ty)] = tile
+                    self.tiles_read += 1
+                region.paste(tile, (tx - x0, ty - y0))
+        return region
+
+
+def geo_to_pixel_bbox(tbmap, lon0, lat0, lon1, lat1):
+    """Convert geo bbox to map pixels bbox containing it.
+
+    :return: (x0, y0, x1, y1) clipped to map
+    """
+    map_data = tbmap.map_data
+    if not map_data or not map_data.transform:
+        raise InvalidFileException("Map is not calibrated")
+    corners = [map_data.lonlat2xy(lon, lat)
+               for lon in (lon0, lon1) for lat in (lat0, lat1)]
+    return _clip_bbox(tbmap, (min(x for x, _ in corners),
+                              min(y for _, y in corners),
+                              max(x for x, _ in corners),
+                              max(y for _, y in corners)))
+
+
+def _clip_bbox(tbmap, bbox):
+    x0, y0, x1, y1 = bbox
+    x0, x1 = max(x0, 0), min(x1, tbmap.width)
+    y0, y1 = max(y0, 0), min(y1, tbmap.height)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError("Region outside map")
+    return x0, y0, x1, y1
+
+
+def _create_writer(ofile, fmt, width, height, mode, band_height, options):
+    if fmt == 'PNG':
+        return _PngWriter(ofile, width, height, mode,
+                          options.get('compress_level', 6))
+    if fmt == 'TIFF':
+        return _TiffWriter(ofile, width, height, mode, band_height)
+    return _PilWriter(ofile, width, height, mode, fmt, options)
+
+
+def export_region(tbmap, filename, bbox=None, scale=1.0, fmt=None,
+                  band_height=256, mode='RGB', options=None,
+                  progress=None):
+    """Render region of map to image file.
+
+    :param tbmap: `map_loader.Map`
+    :param filename: output file name
+    :param bbox: (x0, y0, x1, y1) region in map pixels; default whole map
+    :param scale: scale of output image
+    :param fmt: PNG, TIFF, JPEG...; default: by file name extension;
+        formats other than PNG and TIFF are limited to
+        `MAX_BUFFERED_PIXELS`
+    :param band_height: number of output rows rendered at once
+    :param mode: output image mode (RGB, RGBA, L)
+    :param options: options for writer (compress_level for PNG, options
+        for PIL.Image.save for other formats)
+    :param progress: function called with (rows done, all rows)
+    :return: dict with statistics
+    """
+    tstart = time.time()
+    fmt = fmt or _FORMATS.get(os.path.splitext(filename)[1].lower())
+    if not fmt:
+        raise ValueError("Unknown output format")
+    bbox = _clip_bbox(tbmap, bbox or (0, 0, tbmap.width, tbmap.height))
+    x0, y0, x1, y1 = bbox
+    width = max(int(round((x1 - x0) * scale)), 1)
+    height = max(int(round((y1 - y0) * scale)), 1)
+    if fmt not in _STREAMED_FORMATS and \
+            width * height > MAX_BUFFERED_PIXELS:
+        raise ValueError(
+            f"{fmt} export is limited to {MAX_BUFFERED_PIXELS // 1048576} "
+            f"Mpx ({width}x{height} requested); use PNG or TIFF")
+    # source pixels per output pixel
+    step_x = (x1 - x0) / width
+    step_y = (y1 - y0) / height
+    resize = not (step_x == step_y == 1 and
+                  all(float(val).is_integer() for val in bbox))
+    margin_x = math.ceil(_FILTER_SUPPORT * max(step_x, 1)) + 1 \
+        if resize else 0
+    margin_y = math.ceil(_FILTER_SUPPORT * max(step_y, 1)) + 1 \
+        if resize else 0
+    rx0 = max(math.floor(x0) - margin_x, 0)
+    rx1 = min(math.ceil(x1) + margin_x, tbmap.width)
+
+    _LOG.info("exporting region %r scale %r to %s (%dx%d, %s)", bbox,
+              scale, filename, width, height, fmt)
+    reader = _BandReader(tbmap, mode)
+    bytes_read = tbmap.bytes_read
+    with open(filename, 'wb') as ofile:
+        writer = _create_writer(ofile, fmt, width, height, mode,
+                                band_height, options or {})
+        for oy0 in range(0, height, band_height):
+            oy1 = min(oy0 + band_height, height)
+            sy0 = y0 + oy0 * step_y
+            sy1 = y0 + oy1 * step_y
+            ry0 = max(math.floor(sy0) - margin_y, 0)
+            ry1 = min(math.ceil(sy1) + margin_y, tbmap.height)
+            with profiling.timer("export.read"):
+                src = reader.read(rx0, ry0, rx1, ry1)
+            with profiling.timer("export.render"):
+                if resize:
+                    band = src.resize(
+                        (width, oy1 - oy0), Image.LANCZOS,
+                        box=(x0 - rx0, sy0 - ry0, x1 - rx0, sy1 - ry0))
+                else:
+                    band = src.crop((x0 - rx0, sy0 - ry0, x1 - rx0,
+                                     sy1 - ry0))
+            with profiling.timer("export.write"):
+                writer.write_band(band)
+            if progress:
+                progress(oy1, height)
+        writer.close()
+
+    elapsed = time.time() - tstart
+    stats = {
+        'width': width,
+        'height': height,
+        'tiles_read': reader.tiles_read,
+        'bytes_read': tbmap.bytes_read - bytes_read,
+        'bytes_written': os.path.getsize(filename),
+        'time': elapsed,
+        'mpix_per_s': width * height / 1e6 / elapsed if elapsed else 0,
+    }
+    _LOG.debug("export_region stats: %r", stats)
+    return stats
+
+
+def format_stats(stats):
+    return ("{width}x{height} px; tiles read: {tiles_read} "
+            "({mb_read:0.1f} MB); written {mb_written:0.1f} MB; "
+            "time: {time:0.2f}s; {mpix_per_s:0.2f} Mpx/s".format(
+                mb_read=stats['bytes_read'] / 1048576,
+                mb_written=stats['bytes_written'] / 1048576, **stats))
+
+
+def _parse_bbox(value):
+    vals = [float(val) for val in value.split(',')]
+    if len(vals) != 4:
+        raise ValueError("bbox require 4 values")
+    return vals
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <map file> <output image>")
+    optp.add_option("--bbox", help="region in map pixels: X0,Y0,X1,Y1")
+    optp.add_option("--geo-bbox",
+                    help="region in degrees: LON0,LAT0,LON1,LAT1")
+    optp.add_option("--scale", type="float", default=1.0,
+                    help="output scale (default: 1.0)")
+    optp.add_option("--format", choices=("PNG", "TIFF", "JPEG"),
+                    help="output format; default: by file extension")
+    optp.add_option("--band-height", type="int", default=256,
+                    help="number of rows rendered at once")
+    optp.add_option("--jpeg-quality", type="int", default=90)
+    optp.add_option("--png-compression", type="int", default=6,
+                    help="0-9")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run export for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("map file and output file required")
+        return 1
+
+    try:
+        bbox = _parse_bbox(options.bbox) if options.bbox else None
+        geo_bbox = _parse_bbox(options.geo_bbox) if options.geo_bbox \
+            else None
+    except ValueError as err:
+        _LOG.error("invalid bbox: %s", err)
+        return 1
+
+    fmt = options.format or \
+        _FORMATS.get(os.path.splitext(args[1])[1].lower())
+    fmt_options = {
+        'PNG': {'compress_level': options.png_compression},
+        'JPEG': {'quality': options.jpeg_quality},
+    }.get(fmt)
+    try:
+        with map_loader.Map(args[0]) as tbmap:
+            if geo_bbox:
+                bbox = geo_to_pixel_bbox(tbmap, *geo_bbox)
+            stats = export_region(tbmap, args[1], bbox, options.scale, fmt,
+                                  options.band_height, options=fmt_options)
+    except (IOError, ValueError, InvalidFileException) as err:
+        _LOG.error("export error: %s", err)
+        return 1
+
+    _LOG.info("finished; %s", format_stats(stats))
+    return 0
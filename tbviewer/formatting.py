@@ -14,7 +14,7 @@ import locale
 
 
 def format_pos(degree, latitude=True, short=True):
-    lit = ["EW", "NS"][0 if latitude else 1][0 if degree > 0 else 1]
+    lit = ["NS", "EW"][0 if latitude else 1][0 if degree > 0 else 1]
     degree = abs(degree)
     mint, stop = math.modf(degree)
     if short:
@@ -34,8 +34,8 @@ def format_pos_lat(degree, short=True):
 
 
 def format_pos_latlon(lat, lon, short=True):
-    return format_pos(lat, False, short) + "       " + \
-        format_pos(lon, True, short)
+    return format_pos(lat, True, short) + "       " + \
+        format_pos(lon, False, short)
 
 
 def prettydict(d):
@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""GPX tracks loading & preparing for display on map."""
+
+import logging
+import xml.etree.ElementTree as ET
+
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# number of points in one chunk of track
+_CHUNK_SIZE = 64
+# size of spatial index cell in map pixels
+_CELL_SIZE = 1024
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def load_gpx(filename):
+    """Load tracks from gpx file.
+
+    File is parsed incrementally and processed elements are released, so
+    memory usage depend only on number of points.
+
+    :return: list of segments; each segment is list of (lon, lat)
+    """
+    segments = []
+    current = None
+    try:
+        for event, elem in ET.iterparse(filename, events=("start", "end")):
+            name = _local_name(elem.tag)
+            if event == "start":
+                if name in ('trkseg', 'rte'):
+                    current = []
+                continue
+
+            if name in ('trkpt', 'rtept'):
+                if current is not None:
+                    current.append((float(elem.get('lon')),
+                                    float(elem.get('lat'))))
+                elem.clear()
+            elif name in ('trkseg', 'rte'):
+                if current:
+                    segments.append(current)
+                current = None
+                elem.clear()
+            elif name in ('trk', 'wpt'):
+                elem.clear()
+    except (ET.ParseError, TypeError, ValueError) as err:
+        raise InvalidFileException(f"Invalid gpx file: {err}")
+
+    _LOG.debug("load_gpx: %s segments=%d points=%d", filename,
+               len(segments), sum(map(len, segments)))
+    return segments
+
+
+def simplify(points, tolerance):
+    """Simplify polyline by Douglas-Peucker algorithm.
+
+    :param points: list of (x, y)
+    :param tolerance: max distance of removed points from result line
+    :return: list of simplified points
+    """
+    count = len(points)
+    if count < 3:
+        return list(points)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance2 = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        len2 = dx * dx + dy * dy
+        max_dist = 0.0
+        max_idx = first
+        for idx in range(first + 1, last):
+            px, py = points[idx]
+            if len2:
+                # squared distance from line * len2
+                cross = dx * (y1 - py) - dy * (x1 - px)
+                dist = cross * cross / len2
+            else:
+                dist = (px - x1) ** 2 + (py - y1) ** 2
+            if dist > max_dist:
+                max_dist = dist
+                max_idx = idx
+        if max_dist > tolerance2:
+            keep[max_idx] = True
+            stack.append((first, max_idx))
+            stack.append((max_idx, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class _Chunk:
+    """Part of track with bounding box."""
+
+    __slots__ = ('points', 'bbox')
+
+    def __init__(self, points):
+        self.points = points
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        self.bbox = (min(xs), min(ys), max(xs), max(ys))
+
+
+class _Level:
+    """Track simplified for one zoom level with spatial index."""
+
+    def __init__(self, segments):
+        self.chunks = []
+        # (cell x, cell y) -> list of chunks indexes
+        self.cells = {}
+        for segment in segments:
+            # chunks overlap by one point to keep line continuous
+            for start in range(0, max(len(segment) - 1, 1), _CHUNK_SIZE):
+                points = segment[start:start + _CHUNK_SIZE + 1]
+                if len(points) > 1:
+                    self._add_chunk(_Chunk(points))
+
+    def _add_chunk(self, chunk):
+        idx = len(self.chunks)
+        self.chunks.append(chunk)
+        x0, y0, x1, y1 = chunk.bbox
+        for cx in range(int(x0 // _CELL_SIZE), int(x1 // _CELL_SIZE) + 1):
+            for cy in range(int(y0 // _CELL_SIZE),
+                            int(y1 // _CELL_SIZE) + 1):
+                self.cells.setdefault((cx, cy), []).append(idx)
+
+    def find(self, x0, y0, x1, y1):
+        """Find chunks intersecting given rect (map pixels)."""
+        found = set()
+        cells = self.cells
+        for cx in range(int(x0 // _CELL_SIZE), int(x1 // _CELL_SIZE) + 1):
+            for cy in range(int(y0 // _CELL_SIZE),
+                            int(y1 // _CELL_SIZE) + 1):
+                found.update(cells.get((cx, cy), ()))
+
+        chunks = self.chunks
+        for idx in sorted(found):
+            bx0, by0, bx1, by1 = chunks[idx].bbox
+            if bx0 <= x1 and bx1 >= x0 and by0 <= y1 and by1 >= y0:
+                yield idx, chunks[idx]
+
+
+class TrackOverlay:
+    """Tracks converted to map pixels; simplified for each zoom level."""
+
+    def __init__(self, segments, map_data, zooms=range(-5, 6)):
+        """Create overlay.
+
+        :param segments: list of segments with (lon, lat) points
+        :param map_data: `mapfile.MapFile` of map
+        :param zooms: zoom levels (scale = 2^zoom)
+        """
+        xy_segments = []
+        for segment in segments:
+            lons = [p[0] for p in segment]
+            lats = [p[1] for p in segment]
+            xs, ys = map_data.lonlat2xy_many(lons, lats)
+            xy_segments.append(list(zip(map(float, xs), map(float, ys))))
+
+        self.levels = {}
+        # each level is simplified from previous (more detailed) one
+        for zoom in sorted(zooms, reverse=True):
+            # one screen pixel tolerance
+            tolerance = 1.0 / (2.0 ** zoom)
+            xy_segments = [simplify(segment, tolerance)
+                           for segment in xy_segments]
+            self.levels[zoom] = _Level(xy_segments)
+        _LOG.debug("TrackOverlay: levels=%r", {
+            zoom: len(level.chunks) for zoom, level in self.levels.items()})
+
+    def visible(self, zoom, x0, y0, x1, y1):
+        """Get chunks of track visible in given rect of map (unscaled).
+
+        :return: iterable of (chunk id, list of points in map pixels)
+        """
+        level = self.levels.get(zoom)
+        if level is None:
+            return ()
+        return ((idx, chunk.points)
+                for idx, chunk in level.find(x0, y0, x1, y1))
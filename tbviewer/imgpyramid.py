@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Multi-resolution, tiled access to big images; independent of tk."""
+
+import collections
+import logging
+
+from PIL import Image
+
+from . import profiling
+
+_LOG = logging.getLogger(__name__)
+
+# default size of tiles (in scaled pixels)
+TILE_SIZE = 256
+
+
+class ImagePyramid:
+    """Image decoded once with lazy created reduced levels.
+
+    Zoom levels are powers of 2: scale = 2 ** zoom. For zoom < 0 tiles are
+    cut from reduced copy of image (each level is created from previous
+    one); for zoom > 0 tiles are enlarged from small crop of original image.
+    Tiles are identified by position of top-left corner in scaled pixels.
+    """
+
+    def __init__(self, image, tile_size=TILE_SIZE, cache_size=256):
+        """Create pyramid.
+
+        :param image: decoded PIL image
+        :param tile_size: tiles size in scaled pixels
+        :param cache_size: max number of cached tiles
+        """
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        self.image = image
+        self.width, self.height = image.size
+        self.tile_size = tile_size
+        self._levels = {0: image}
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    @classmethod
+    def open(cls, filename, **kwargs):
+        """Load and decode image file."""
+        with profiling.timer("imgpyramid.open"):
+            image = Image.open(filename)
+            image.load()
+            return cls(image, **kwargs)
+
+    def size(self, zoom):
+        """Image size on given zoom level."""
+        if zoom >= 0:
+            return self.width << zoom, self.height << zoom
+        return self.level(zoom).size
+
+    def level(self, zoom):
+        """Get whole image reduced for zoom <= 0; created on first use."""
+        zoom = min(zoom, 0)
+        img = self._levels.get(zoom)
+        if img is None:
+            with profiling.timer("imgpyramid.level"):
+                img = self.level(zoom + 1).reduce(2)
+            self._levels[zoom] = img
+            _LOG.debug("level %d created: %r", zoom, img.size)
+        return img
+
+    def get_tile(self, zoom, x, y):
+        """Get tile (PIL image) of image scaled by 2 ** zoom.
+
+        :param x, y: top-left corner of tile in scaled pixels
+        :return: image; tiles on right/bottom edge may be smaller
+        """
+        key = (zoom, x, y)
+        tile = self._cache.get(key)
+        if tile is not None:
+            self._cache.move_to_end(key)
+            return tile
+
+        with profiling.timer("imgpyramid.get_tile"):
+            tile = self._create_tile(zoom, x, y)
+        self._cache[key] = tile
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return tile
+
+    def _create_tile(self, zoom, x, y):
+        size = self.tile_size
+        width, height = self.size(zoom)
+        x1 = min(x + size, width)
+        y1 = min(y + size, height)
+        if zoom <= 0:
+            return self.level(zoom).crop((x, y, x1, y1))
+
+        # crop source region and enlarge it
+        scale = 1 << zoom
+        src = self.image.crop((x // scale, y // scale, -(-x1 // scale),
+                               -(-y1 // scale)))
+        tile = src.resize((src.width * scale, src.height * scale),
+                          Image.NEAREST)
+        ox, oy = x % scale, y % scale
+        return tile.crop((ox, oy, ox + x1 - x, oy + y1 - y))
+
+    def magnify(self, x, y, factor, size):
+        """Get enlarged fragment of original image around (x, y).
+
+        Only small crop of image is resized (nearest neighbour), so cost
+        don't depend on image size.
+
+        :param x, y: position in original image pixels
+        :param factor: enlargement factor
+        :param size: max size of result
+        :return: (image, (x0, y0)); image is square with odd number of
+            source pixels and pixel (x, y) in the center; x0, y0 - position
+            of top-left source pixel
+        """
+        src = max(size // factor, 1)
+        if src % 2 == 0:
+            src -= 1
+        x0 = int(x) - src // 2
+        y0 = int(y) - src // 2
+        with profiling.timer("imgpyramid.magnify"):
+            crop = self.image.crop((x0, y0, x0 + src, y0 + src))
+            return crop.resize((src * factor, src * factor),
+                               Image.NEAREST), (x0, y0)
+
+    def clear_cache(self):
+        """Drop cached tiles and reduced levels."""
+        self._cache.clear()
+        self._levels = {0: self.image}
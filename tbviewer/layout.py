@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Tiles layout - which tiles are visible in viewport; independent of tk."""
+
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+class TileLayout:
+    """Track visible tiles of tiled map.
+
+    Tiles are identified by position of top-left corner in map (unscaled)
+    pixels, the same as in `map_loader.Map.get_tile`.
+    """
+
+    def __init__(self, map_width, map_height, tile_width, tile_height,
+                 margin=0):
+        """Create layout.
+
+        :param map_width: whole map width
+        :param map_height: whole map height
+        :param tile_width: tile width
+        :param tile_height: tile height
+        :param margin: number of additional tiles around viewport
+        """
+        self.map_width = map_width
+        self.map_height = map_height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.margin = margin
+        # currently displayed tiles
+        self.tiles = set()
+        # last visible range
+        self._range = None
+
+    def visible_range(self, scale, x0, y0, width, height):
+        """Get range of visible tiles indexes.
+
+        :param scale: map scale
+        :param x0, y0: top left corner of viewport (in scaled pixels)
+        :param width, height: viewport size
+        :return: (first col, first row, last col, last row); last col/row
+            are exclusive
+        """
+        stw = self.tile_width * scale
+        sth = self.tile_height * scale
+        margin = self.margin
+        cols = -(-self.map_width // self.tile_width)
+        rows = -(-self.map_height // self.tile_height)
+        col0 = max(int(x0 // stw) - margin, 0)
+        row0 = max(int(y0 // sth) - margin, 0)
+        col1 = min(int((x0 + width) // stw) + 1 + margin, cols)
+        row1 = min(int((y0 + height) // sth) + 1 + margin, rows)
+        return col0, row0, max(col1, col0), max(row1, row0)
+
+    def visible_tiles(self, scale, x0, y0, width, height):
+        """Get list of visible tiles; nearest viewport center first."""
+        col0, row0, col1, row1 = self.visible_range(
+            scale, x0, y0, width, height)
+        # viewport center in tiles units
+        ccol = (x0 + width / 2) / (self.tile_width * scale) - 0.5
+        crow = (y0 + height / 2) / (self.tile_height * scale) - 0.5
+        cells = [(col, row) for row in range(row0, row1)
+                 for col in range(col0, col1)]
+        cells.sort(key=lambda cr: (cr[0] - ccol) ** 2 + (cr[1] - crow) ** 2)
+        tile_width, tile_height = self.tile_width, self.tile_height
+        return [(col * tile_width, row * tile_height) for col, row in cells]
+
+    def update(self, scale, x0, y0, width, height):
+        """Update layout for new viewport.
+
+        Only difference between previous and current range of visible
+        tiles is calculated, so cost depend on number of changed tiles.
+
+        :return: (tiles to add - in priority order, tiles to keep, tiles
+            to drop)
+        """
+        rng = self.visible_range(scale, x0, y0, width, height)
+        old = self._range
+        tiles = self.tiles
+        if rng == old:
+            return [], list(tiles), []
+
+        tile_width, tile_height = self.tile_width, self.tile_height
+        drop = []
+        if old:
+            for col, row in _range_diff(old, rng):
+                pos = (col * tile_width, row * tile_height)
+                if pos in tiles:
+                    drop.append(pos)
+                    tiles.remove(pos)
+
+        keep = list(tiles)
+        ccol = (x0 + width / 2) / (tile_width * scale) - 0.5
+        crow = (y0 + height / 2) / (tile_height * scale) - 0.5
+        cells = list(_range_diff(rng, old))
+        cells.sort(key=lambda cr: (cr[0] - ccol) ** 2 + (cr[1] - crow) ** 2)
+        add = [(col * tile_width, row * tile_height) for col, row in cells]
+        tiles.update(add)
+        self._range = rng
+        return add, keep, drop
+
+    def forget(self, pos):
+        """Mark tile as not displayed (i.e. loading failed)."""
+        self.tiles.discard(pos)
+
+    def clear(self):
+        """Forget all displayed tiles."""
+        self.tiles = set()
+        self._range = None
+
+
+def _range_diff(rng, other):
+    """Generate (col, row) cells in `rng` that are not in `other` range."""
+    col0, row0, col1, row1 = rng
+    if not other:
+        for row in range(row0, row1):
+            for col in range(col0, col1):
+                yield col, row
+        return
+
+    ocol0, orow0, ocol1, orow1 = other
+    left = range(col0, min(col1, ocol0))
+    right = range(max(col0, ocol1), col1)
+    for row in range(row0, row1):
+        if orow0 <= row < orow1:
+            for col in left:
+                yield col, row
+            for col in right:
+                yield col, row
+        else:
+            for col in range(col0, col1):
+                yield col, row
@@ -13,6 +13,7 @@ import logging
 import tempfile
 import time
 import os
+import sys
 
 from . import version
 
@@ -27,19 +28,43 @@ def _parse_opt():
                      help="enable debug messages")
     group.add_option("--shell", action="store_true", default=False,
                      help="start shell")
+    group.add_option("--profile", action="store_true", default=False,
+                     help="run under profiler; save stats in log directory")
     optp.add_option_group(group)
     return optp.parse_args()
 
 
+def _setup_logging(debug):
+    """Configure logging to new temp directory; return its path."""
+    from .logging_setup import logging_setup
+    logdir = tempfile.mkdtemp("_log_" + str(int(time.time())), "tbviewer_")
+    logging_setup(os.path.join(logdir, "tbviewer.log"), debug)
+    return logdir
+
+
+def _run_window(create_window, options, logdir):
+    """Create window and run main loop; optionally under profiler."""
+    def run():
+        window = create_window()
+        window.mainloop()
+
+    if not options.profile:
+        run()
+        return
+
+    from . import profiling
+    stats_filename = os.path.join(logdir, "tbviewer.prof")
+    profiling.run_profiled(run, stats_filename)
+    sys.stderr.write("Profile stats saved to %s\n" % stats_filename)
+
+
 def run_viewer():
     """Run viewer application."""
     # parse options
     options, args = _parse_opt()
 
     # logowanie
-    from .logging_setup import logging_setup
-    logdir = tempfile.mkdtemp("_log_" + str(int(time.time())), "tbviewer_")
-    logging_setup(os.path.join(logdir, "tbviewer.log"), options.debug)
+    logdir = _setup_logging(options.debug)
 
     if options.shell:
         # starting interactive shell
@@ -53,8 +78,7 @@ def run_viewer():
 
     fname = args[0] if args and args[0] else None
 
-    window = wnd_viewer.WndViewer(fname)
-    window.mainloop()
+    _run_window(lambda: wnd_viewer.WndViewer(fname), options, logdir)
 
 
 def run_calibrate():
@@ -63,9 +87,7 @@ def run_calibrate():
     options, args = _parse_opt()
 
     # logowanie
-    from .logging_setup import logging_setup
-    logdir = tempfile.mkdtemp("_log_" + str(int(time.time())), "tbviewer_")
-    logging_setup(os.path.join(logdir, "tbviewer.log"), options.debug)
+    logdir = _setup_logging(options.debug)
 
     if options.shell:
         # starting interactive shell
@@ -80,5 +102,86 @@ def run_calibrate():
     fname = args[0] if args else None
     mapfname = args[1] if args and len(args) > 1 else None
 
-    window = wnd_calibrate.WndCalibrate(fname, mapfname)
-    window.mainloop()
+    _run_window(lambda: wnd_calibrate.WndCalibrate(fname, mapfname),
+                options, logdir)
+
+
+def run_batch():
+    """Run batch map creation."""
+    from . import batch
+
+    options, args = batch.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(batch.run(options, args))
+
+
+def run_serve():
+    """Run http tiles server."""
+    from . import server
+
+    options, args = server.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(server.run(options, args))
+
+
+def run_export():
+    """Run export map region to image."""
+    from . import export
+
+    options, args = export.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(export.run(options, args))
+
+
+def run_mbtiles():
+    """Run conversion maps to MBTiles."""
+    from . import mbtiles
+
+    options, args = mbtiles.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(mbtiles.run(options, args))
+
+
+def run_xyz():
+    """Run reprojection map to Web Mercator tiles."""
+    from . import xyz
+
+    options, args = xyz.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(xyz.run(options, args))
+
+
+def run_import():
+    """Run import tiles to Trekbuddy map."""
+    from . import tile_import
+
+    options, args = tile_import.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(tile_import.run(options, args))
+
+
+def run_retile():
+    """Run re-tiling map."""
+    from . import retile
+
+    options, args = retile.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(retile.run(options, args))
+
+
+def run_transcode():
+    """Run transcoding tiles of maps."""
+    from . import transcode
+
+    options, args = transcode.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(transcode.run(options, args))
+
+
+def run_verify():
+    """Run verification of atlas."""
+    from . import verify
+
+    options, args = verify.parse_opt()
+    _setup_logging(options.debug)
+    sys.exit(verify.run(options, args))
@@ -7,35 +7,82 @@
 
 """Map loader."""
 
+import os
 import os.path
 import collections
 import tarfile
+import threading
 import logging
 import io
 
-from PIL import ImageTk, Image
+from PIL import Image
 
+from . import coverage
 from . import mapfile
+from . import profiling
 from .errors import InvalidFileException
 
 _LOG = logging.getLogger(__name__)
 
 
 class _TarredFS:
-    def __init__(self, basefile):
-        self._tar = tarfile.open(basefile)
+    def __init__(self, basefile, tar=None):
+        # tar may be already opened (and partially read) by sniff_file_type
+        self._tar = tar or tarfile.open(basefile)
+        self._basefile = basefile
+        self._index = None
+        # tarfile is not thread-safe; files from not compressed archive are
+        # read by os.pread (without seek), other access require lock
+        self._lock = threading.Lock()
+        self._pread = hasattr(os, 'pread') and \
+            isinstance(self._tar.fileobj, io.BufferedReader)
 
     def close(self):
         self._tar.close()
 
+    def _members(self):
+        """Index of archive members; archive headers are read only once."""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    # getmembers continue reading headers from last read
+                    # position
+                    self._index = {member.name: member
+                                   for member in self._tar.getmembers()}
+        return self._index
+
+    def members(self):
+        """Get archive members (TarInfo) in archive order."""
+        return list(self._members().values())
+
     def get_file_content(self, path):
         path = path.replace('\\', '/')
         return self.get_file_binary(path).decode('cp1250')
 
     def get_file_binary(self, path):
         path = path.replace('\\', '/')
-        with self._tar.extractfile(path) as f:
-            return f.read()
+        member = self._members().get(path)
+        if member is None:
+            raise KeyError(f"file {path} not found")
+        if self._pread and member.isfile() and not member.sparse:
+            return os.pread(self._tar.fileobj.fileno(), member.size,
+                            member.offset_data)
+        with self._lock:
+            with self._tar.extractfile(member) as f:
+                return f.read()
+
+    def locate(self, path):
+        """Get location of file data in filesystem.
+
+        :return: (file name, offset, size) or None when file is not stored
+            as continuous block (i.e. compressed archive)
+        """
+        if not isinstance(self._tar.fileobj, io.BufferedReader):
+            return None
+        member = self._members().get(path.replace('\\', '/'))
+        if member is None or not member.isfile() or member.sparse:
+            return None
+        return self._basefile, member.offset_data, member.size
 
     def list(self, path):
         for fname in self._listdir(path):
@@ -58,7 +105,7 @@ class _TarredFS:
         if path and path[-1] != '/':
             path += '/'
 
-        for member in self._tar.getmembers():
+        for member in self._members().values():
             if not member.name.startswith(path):
                 continue
             stpath = member.name[len(path):]
@@ -81,9 +128,13 @@ class _RealFS:
 
     def get_file_binary(self, path):
         realpath = os.path.join(self._basepath, path)
-        with open(realpath, 'b') as f:
+        with open(realpath, 'rb') as f:
             return f.read()
 
+    def locate(self, path):
+        realpath = os.path.join(self._basepath, path)
+        return realpath, 0, os.path.getsize(realpath)
+
     def list(self, path):
         realpath = os.path.join(self._basepath, path)
         yield from os.listdir(realpath)
@@ -101,21 +152,148 @@ class _RealFS:
                 yield member
 
 
-class Atlas:
+class _MBTilesFS:
+    """Map stored in MBTiles file (see `mbtiles` module).
+
+    Files of map (.map file and set/ directory) are emulated from metadata
+    and tiles tables.
+    """
+
+    def __init__(self, basefile):
+        # sqlite3 is required only for mbtiles; load it when needed
+        import sqlite3
+
+        self._basefile = basefile
+        try:
+            # connection is shared by threads (async api, server); access
+            # is guarded by lock
+            self._conn = sqlite3.connect(sqlite_ro_uri(basefile), uri=True,
+                                         check_same_thread=False)
+            # tiles are read directly from mapped file; avoid copying
+            # pages to sqlite cache
+            self._conn.execute("PRAGMA mmap_size=1073741824")
+            meta = dict(self._conn.execute(
+                "SELECT name, value FROM metadata"))
+        except sqlite3.Error as err:
+            raise InvalidFileException(f"invalid mbtiles file: {err}")
+        self._lock = threading.Lock()
+        self._map_content = meta.get('tbviewer_map')
+        if not self._map_content or not meta.get('tbviewer_tile_size'):
+            self._conn.close()
+            raise InvalidFileException("mbtiles file is not trekbuddy map")
+        self._name = meta.get('name') or 'map'
+        self._ext = '.' + (meta.get('format') or 'jpg')
+        self._tile_width, self._tile_height = (
+            int(val) for val in meta['tbviewer_tile_size'].split(','))
+
+    def close(self):
+        self._conn.close()
+
+    def get_file_content(self, path):
+        if path == self._name + ".map":
+            return self._map_content
+        return self.get_file_binary(path).decode('cp1250')
+
+    def get_file_binary(self, path):
+        path = path.replace('\\', '/')
+        dirname, _, fname = path.partition('/')
+        name_parts = os.path.splitext(fname)[0].split('_')
+        if dirname != 'set' or len(name_parts) < 3:
+            raise KeyError(f"file {path} not found")
+        try:
+            x, y = int(name_parts[-2]), int(name_parts[-1])
+        except ValueError:
+            raise KeyError(f"file {path} not found")
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level=0 AND "
+                "tile_column=? AND tile_row=?",
+                (x // self._tile_width, y // self._tile_height)).fetchone()
+        if row is None:
+            raise KeyError(f"file {path} not found")
+        return row[0]
+
+    def locate(self, path):
+        """Tiles are stored in database; always None."""
+        return None
+
+    def list(self, path):
+        yield from self.list_dirs(path)
+        yield from self.list_files(path)
+
+    def list_dirs(self, path):
+        if not path.strip('/'):
+            yield 'set'
+
+    def list_files(self, path):
+        path = path.replace('\\', '/').strip('/')
+        if not path:
+            yield self._name + ".map"
+        elif path == 'set':
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT tile_column, tile_row FROM tiles "
+                    "WHERE zoom_level=0").fetchall()
+            name, ext = self._name, self._ext
+            tile_width, tile_height = self._tile_width, self._tile_height
+            for col, row in rows:
+                yield f"{name}_{col * tile_width}_{row * tile_height}{ext}"
+
+
+class _Closable:
+    """Base for objects that can be used as context manager."""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Atlas(_Closable):
     """Real Trekbuddy atlas representation."""
 
-    def __init__(self, path):
+    def __init__(self, path, fs=None):
         if path.endswith('.tba'):  # plain fs
             self._fs = _RealFS(os.path.dirname(path))
         elif path.endswith('.tar'):  # compressed fs
-            self._fs = _TarredFS(path)
+            self._fs = fs or _TarredFS(path)
 
         basedir = os.path.dirname(path)
         self.layers = sorted(self._load_layers(basedir))
+        self._maps_info = None
+        self._coverage = None
 
     def close(self):
         self._fs.close()
 
+    def scan(self, cache_file=None, workers=None):
+        """Get metadata of all maps in atlas; scanned on first use.
+
+        See `atlas_scan.scan_atlas`.
+        """
+        if self._maps_info is None:
+            from . import atlas_scan
+            self._maps_info = atlas_scan.scan_atlas(self.layers, cache_file,
+                                                    workers)
+        return self._maps_info
+
+    def coverage(self):
+        """Get spatial index of maps; built on first use."""
+        if self._coverage is None:
+            self._coverage = coverage.CoverageIndex(filter(None, (
+                coverage.MapCoverage.from_map_file(
+                    info.layer, info.name, info.path, info.map_file)
+                for info in self.scan())))
+        return self._coverage
+
+    def open_map(self, path):
+        """Open map from atlas."""
+        return Map(path)
+
     def _load_layers(self, path):
         for layer in self._fs.list_dirs(""):
             _LOG.debug("layer: %s", layer)
@@ -125,14 +303,44 @@ class Atlas:
             yield layer, maps
 
 
-class FakeAlbum:
+class FakeAlbum(_Closable):
     """Fake album representation, i.e. only one map."""
 
-    def __init__(self, path):
+    def __init__(self, path, fs=None):
         self.layers = [("base", [(os.path.basename(path), path)])]
+        self._path = path
+        # fs opened by sniff_file_type; passed to first opened map
+        self._fs = fs
+        self._coverage = None
 
     def close(self):
-        pass
+        if self._fs:
+            self._fs.close()
+            self._fs = None
+
+    def open_map(self, path):
+        """Open map; reuse already opened archive if available."""
+        fs = None
+        if path == self._path:
+            fs, self._fs = self._fs, None
+        return Map(path, fs)
+
+    def coverage(self):
+        """Get spatial index of maps; built on first use."""
+        if self._coverage is None:
+            self._coverage = coverage.build_index(self.layers,
+                                                  load_map_file)
+        return self._coverage
+
+
+def sqlite_ro_uri(path):
+    """Get URI for opening sqlite database read-only.
+
+    Path is quoted, so it may contain characters special in URI (#, ?, %).
+    """
+    import pathlib
+
+    return pathlib.Path(path).resolve().as_uri() + "?mode=ro"
 
 
 def _find_file_in_dir(path, ext):
@@ -142,34 +350,122 @@ def _find_file_in_dir(path, ext):
     return None
 
 
-class Map:
-    """Trekbuddy map representation."""
+def _open_map_fs(path):
+    if os.path.isfile(path):
+        if path.endswith(".tar"):
+            return _TarredFS(path)
+        if path.endswith(".mbtiles"):
+            return _MBTilesFS(path)
+        if path.endswith(".map"):
+            return _RealFS(os.path.dirname(path))
 
-    def __init__(self, path):
-        self._fs = self._find_fs(path)
-        self.map_data = self._load_map_meta()
-        self.set_data = dict(self._load_set())
-        self.tile_width, self.tile_height = self._find_tile_size()
-        _LOG.debug("map: deta=%s files=%r t-width=%r t-height=%r",
-                   self.map_data, len(self.set_data), self.tile_width,
-                   self.tile_height)
+    tar_file = _find_file_in_dir(path, ".tar")
+    if tar_file:
+        return _TarredFS(tar_file)
 
-    def _find_fs(self, path):
-        if os.path.isfile(path):
-            if path.endswith(".tar"):
-                return _TarredFS(path)
-            if path.endswith(".map"):
-                return _RealFS(os.path.dirname(path))
+    mbtiles_file = _find_file_in_dir(path, ".mbtiles")
+    if mbtiles_file:
+        return _MBTilesFS(mbtiles_file)
 
-        tar_file = _find_file_in_dir(path, ".tar")
-        if tar_file:
-            return _TarredFS(tar_file)
+    map_file = _find_file_in_dir(path, ".map")
+    if map_file:
+        return _RealFS(os.path.dirname(map_file))
 
-        map_file = _find_file_in_dir(path, ".map")
-        if map_file:
-            return _RealFS(os.path.dirname(map_file))
+    return None
+
+
+def _find_map_file(fs):
+    for name in fs.list(""):
+        if name.endswith(".map"):
+            _LOG.debug("found %s map file", name)
+            return name
+    _LOG.warn("no map file found")
+    return None
 
+
+def _read_map_file(fs):
+    map_filename = _find_map_file(fs)
+    if not map_filename:
         return None
+    map_conent = fs.get_file_content(map_filename)
+    map_file = mapfile.MapFile()
+    map_file.parse_map(map_conent)
+    return map_file
+
+
+def _load_set(fs):
+    for name in fs.list_files("set/"):
+        bname, ext = os.path.splitext(name)
+        if ext.lower() not in ('.jpg', '.png', '.jpeg'):
+            _LOG.warn("unknown file extension: %s", name)
+        name_parts = bname.split('_')
+        if len(name_parts) < 3:
+            _LOG.warn("wrong file name: %s", bname)
+            continue
+
+        x, y = int(name_parts[-2]), int(name_parts[-1])
+        yield (x, y), os.path.join('set', name)
+
+
+def _find_tile_size(positions):
+    tile_width = 9999999
+    tile_height = 9999999
+    for (x, y) in positions:
+        if y == 0 and tile_width > x and x > 0:
+            tile_width = x
+
+        if x == 0 and tile_height > y and y > 0:
+            tile_height = y
+
+    if tile_width == 9999999 or tile_height == 9999999:
+        raise InvalidFileException("Wrong set - missing files")
+
+    return tile_width, tile_height
+
+
+def load_map_file(path):
+    """Load only calibration (.map file) of map; don't scan tiles.
+
+    :param path: map path (as in atlas layers)
+    :return: MapFile or None when map file not found
+    """
+    fs = _open_map_fs(path)
+    if fs is None:
+        return None
+    try:
+        return _read_map_file(fs)
+    finally:
+        fs.close()
+
+
+class Map(_Closable):
+    """Trekbuddy map representation.
+
+    Tiles can be read from many threads; async methods run reads and
+    decoding in executor.
+    """
+
+    # max number of tiles read/decoded at once by async methods
+    max_inflight = 16
+    # executor for async methods; None = default loop executor
+    executor = None
+
+    def __init__(self, path, fs=None):
+        self._fs = fs or _open_map_fs(path)
+        self.map_data = _read_map_file(self._fs)
+        self.set_data = dict(_load_set(self._fs))
+        self.tile_width, self.tile_height = _find_tile_size(self.set_data)
+        # statistics
+        self.bytes_read = 0
+        self.tiles_read = 0
+        # pending async requests: key -> task
+        self._pending = {}
+        # semaphore limiting inflight requests and its event loop
+        self._semaphore = None
+        self._semaphore_loop = None
+        _LOG.debug("map: deta=%s files=%r t-width=%r t-height=%r",
+                   self.map_data, len(self.set_data), self.tile_width,
+                   self.tile_height)
 
     def close(self):
         """Close map."""
@@ -185,67 +481,123 @@ class Map:
         """Whole map height."""
         return self.map_data.image_height
 
-    def get_tile(self, x, y, scale=1):
-        """Get one tile from tar file."""
-        name = self.set_data.get((x, y))
-        if not name:
-            if x < self.width and y < self.height:
-                _LOG.error("wrong tile pos: %d, %d", x, y)
-            return None
-        data = self._fs.get_file_binary(name)
-        if scale == 1:
-            return ImageTk.PhotoImage(data=data)
-        image = Image.open(io.BytesIO(data))
-        image = image.resize(
-            (int(image.width * scale), int(image.height * scale)),
-            Image.ANTIALIAS)
-        return ImageTk.PhotoImage(image)
-
-    def _load_map_meta(self):
-        # find map file
-        map_filename = self._find_map_file()
+    def get_map_file_content(self):
+        """Get content of .map file; None when missing."""
+        map_filename = _find_map_file(self._fs)
         if not map_filename:
             return None
-        map_conent = self._fs.get_file_content(map_filename)
-        map_file = mapfile.MapFile()
-        map_file.parse_map(map_conent)
-        return map_file
-
-    def _find_map_file(self):
-        for name in self._fs.list(""):
-            if name.endswith(".map"):
-                _LOG.debug("found %s map file", name)
-                return name
-        _LOG.warn("no map file found")
-        return None
+        return self._fs.get_file_content(map_filename)
 
-    def _load_set(self):
-        for name in self._fs.list_files("set/"):
-            bname, ext = os.path.splitext(name)
-            if ext.lower() not in ('.jpg', '.png', '.jpeg'):
-                _LOG.warn("unknown file extension: %s", name)
-            name_parts = bname.split('_')
-            if len(name_parts) < 3:
-                _LOG.warn("wrong file name: %s", bname)
-                continue
+    def get_tile_location(self, x, y):
+        """Get location of tile data: (file name, offset, size).
 
-            x, y = int(name_parts[-2]), int(name_parts[-1])
-            yield (x, y), os.path.join('set', name)
+        :return: None if tile not exists or its data can't be read
+            directly from file
+        """
+        name = self.set_data.get((x, y))
+        if not name:
+            return None
+        return self._fs.locate(name)
 
-    def _find_tile_size(self):
-        tile_width = 9999999
-        tile_height = 9999999
-        for (x, y) in self.set_data:
-            if y == 0 and tile_width > x and x > 0:
-                tile_width = x
+    def get_tile_bytes(self, x, y):
+        """Get tile file content; None if tile not exists."""
+        name = self.set_data.get((x, y))
+        if not name:
+            return None
+        data = self._fs.get_file_binary(name)
+        self.bytes_read += len(data)
+        self.tiles_read += 1
+        return data
 
-            if x == 0 and tile_height > y and y > 0:
-                tile_height = y
+    def get_tile_image(self, x, y, scale=1):
+        """Get one tile as PIL image; None if tile not exists."""
+        name = self.set_data.get((x, y))
+        if not name:
+            if x < self.width and y < self.height:
+                _LOG.error("wrong tile pos: %d, %d", x, y)
+            return None
+        with profiling.timer("map.get_tile.read"):
+            data = self._fs.get_file_binary(name)
+        self.bytes_read += len(data)
+        self.tiles_read += 1
+        with profiling.timer("map.get_tile.decode"):
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        if scale != 1:
+            with profiling.timer("map.get_tile.resize"):
+                image = image.resize(
+                    (int(image.width * scale), int(image.height * scale)),
+                    Image.LANCZOS)
+        return image
 
-        if tile_width == 9999999 or tile_height == 9999999:
-            raise InvalidFileException("Wrong set - missing files")
+    def get_tile(self, x, y, scale=1):
+        """Get one tile as `ImageTk.PhotoImage`; require tk."""
+        # ImageTk import tkinter; load it only when used by gui
+        from PIL import ImageTk
 
-        return tile_width, tile_height
+        image = self.get_tile_image(x, y, scale)
+        if image is None:
+            return None
+        with profiling.timer("map.get_tile.photo"):
+            return ImageTk.PhotoImage(image)
+
+    def get_region(self, x, y, width, height, mode='RGB'):
+        """Get fragment of map as PIL image composed from tiles.
+
+        Areas without tiles are black.
+
+        :param x, y: top-left corner of region in map pixels
+        :param width, height: size of region
+        :param mode: mode of result image
+        """
+        region = Image.new(mode, (width, height))
+        tile_width, tile_height = self.tile_width, self.tile_height
+        tx0 = x - x % tile_width
+        ty0 = y - y % tile_height
+        with profiling.timer("map.get_region"):
+            for ty in range(ty0, y + height, tile_height):
+                for tx in range(tx0, x + width, tile_width):
+                    if (tx, ty) not in self.set_data:
+                        continue
+                    tile = self.get_tile_image(tx, ty)
+                    if tile.mode != mode:
+                        tile = tile.convert(mode)
+                    region.paste(tile, (tx - x, ty - y))
+        return region
+
+    async def aget_tile_bytes(self, x, y):
+        """Get tile file content; async version of `get_tile_bytes`."""
+        return await self._coalesce(('bytes', x, y), self.get_tile_bytes,
+                                    x, y)
+
+    async def aget_tile_image(self, x, y, scale=1):
+        """Get tile as PIL image; async version of `get_tile_image`."""
+        return await self._coalesce(('image', x, y, scale),
+                                    self.get_tile_image, x, y, scale)
+
+    async def _coalesce(self, key, func, *args):
+        """Run `func` in executor; concurrent requests with the same key
+        share one call."""
+        # asyncio is imported only when needed; its import is slow
+        import asyncio
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run_limited(func, *args))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # cancelling one of waiting requests don't cancel shared task
+        return await asyncio.shield(task)
+
+    async def _run_limited(self, func, *args):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+            self._semaphore_loop = loop
+        async with self._semaphore:
+            return await loop.run_in_executor(self.executor, func, *args)
 
 
 def _check_valid_atlas(tba_file):
@@ -266,36 +618,81 @@ def _check_valid_map_file(map_file):
     return content.startswith('OziExplorer Map Data File Version 2.2')
 
 
-def check_file_type(file_name):
-    """Check what type of atlas/map is given file."""
-    _LOG.debug("check_file_type: %s", file_name)
+def _sniff_tar(tfile):
+    """Find type of tar file reading only headers up to first decisive file.
+
+    .tba file or top-level .map file decide about file type; .map files in
+    subdirectories are used only when there is no .tba file.
+    """
+    nested_map = None
+    while True:
+        member = tfile.next()
+        if member is None:
+            break
+        name = member.name
+        if name.endswith('.tba'):
+            with tfile.extractfile(member) as tbafile:
+                if _check_valid_atlas(tbafile):
+                    return 'tar-atlas'
+        elif name.endswith('.map'):
+            if '/' not in name.strip('/'):
+                with tfile.extractfile(member) as map_file:
+                    if _check_valid_map_file(map_file):
+                        return 'tar-map'
+            elif nested_map is None:
+                nested_map = member
+
+    if nested_map is not None:
+        with tfile.extractfile(nested_map) as map_file:
+            if _check_valid_map_file(map_file):
+                return 'tar-map'
+    return None
+
+
+def sniff_file_type(file_name):
+    """Check what type of atlas/map is given file.
+
+    For tar files archive stay open and is returned for reuse by `Atlas`,
+    `FakeAlbum` or `Map`, so headers are not read again.
+
+    :return: (file type or None, opened fs or None)
+    """
+    _LOG.debug("sniff_file_type: %s", file_name)
 
     if file_name.endswith(".tba"):
         with open(file_name) as mfile:
             if _check_valid_atlas(mfile):
-                return 'atlas'
-        return None
+                return 'atlas', None
+        return None, None
 
     if file_name.endswith(".map"):
         with open(file_name) as mfile:
             if _check_valid_map_file(mfile):
-                return 'map'
+                return 'map', None
 
     if file_name.endswith(".tar"):
-        with tarfile.open(file_name) as tfile:
-            tar_content = tfile.getnames()
-            tba_files = [fname for fname in tar_content
-                         if fname.endswith('.tba')]
-            if tba_files:
-                with tfile.extractfile(tba_files[0]) as tbafile:
-                    if _check_valid_atlas(tbafile):
-                        return 'tar-atlas'
-
-            map_files = [fname for fname in tar_content
-                         if fname.endswith(".map")]
-            if map_files:
-                with tfile.extractfile(map_files[0]) as map_file:
-                    if _check_valid_map_file(map_file):
-                        return 'tar-map'
+        tfile = tarfile.open(file_name)
+        try:
+            file_type = _sniff_tar(tfile)
+        except BaseException:
+            tfile.close()
+            raise
+        if file_type:
+            return file_type, _TarredFS(file_name, tfile)
+        tfile.close()
 
-    return None
+    if file_name.endswith(".mbtiles"):
+        try:
+            return 'mbtiles-map', _MBTilesFS(file_name)
+        except InvalidFileException as err:
+            _LOG.debug("sniff_file_type: %s", err)
+
+    return None, None
+
+
+def check_file_type(file_name):
+    """Check what type of atlas/map is given file."""
+    file_type, fs = sniff_file_type(file_name)
+    if fs:
+        fs.close()
+    return file_type
@@ -13,14 +13,39 @@ import logging
 import math
 
 from . import formatting
+from . import profiling
 from .errors import InvalidFileException
 
 _LOG = logging.getLogger(__name__)
 
 
+_HEADER = 'OziExplorer Map Data File Version 2.2'
+_IWH_PREFIX = 'IWH,Map Image Width/Height,'
+
+# numpy module (or None when not available); False - not imported yet
+_NUMPY = False
+
+
+def get_numpy():
+    """Get NumPy module or None if not available.
+
+    NumPy is optional and imported on first use; importing it is slow.
+    """
+    global _NUMPY  # pylint: disable=global-statement
+    if _NUMPY is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY = numpy
+    return _NUMPY
+
+
 class Point:
     """Point on map."""
 
+    __slots__ = ('idx', 'x', 'y', 'lat', 'lon')
+
     def __init__(self, x, y, lon, lat, idx=None):
         self.idx = idx
         self.x = x
@@ -29,7 +54,9 @@ class Point:
         self.lon = lon
 
     def __repr__(self):
-        return formatting.prettydict(self.__dict__)
+        return formatting.prettydict({
+            'idx': self.idx, 'x': self.x, 'y': self.y, 'lat': self.lat,
+            'lon': self.lon})
 
 
 def _degree2minsec(d, lz='S', gz='N'):
@@ -38,7 +65,14 @@ def _degree2minsec(d, lz='S', gz='N'):
         d *= -1
         symb = lz
 
-    return int(d), (d - int(d)) * 60, symb
+    deg = int(d)
+    # round minutes to precision used in map file so 60 minutes are
+    # carried to degrees and parsed value give the same output
+    mins = round((d - deg) * 60, 7)
+    if mins >= 60:
+        deg += 1
+        mins -= 60
+    return deg, mins, symb
 
 
 class MapFile():
@@ -62,6 +96,7 @@ class MapFile():
         self.mm1b = None
         self.image_width = None
         self.image_height = None
+        self._transform = None
 
     def __str__(self):
         return "<MapMeta {}>".format(", ".join(
@@ -72,55 +107,65 @@ class MapFile():
 
     def parse_map(self, content):
         """Parse content of .map file."""
+        with profiling.timer("mapfile.parse_map"):
+            self._parse_map(content)
+
+    def _parse_map(self, content):
         self.clear()
-        content = [line.strip() for line in content.split("\n")]
-        if content[0] != 'OziExplorer Map Data File Version 2.2':
+        lines = content.split("\n")
+        if lines[0].strip() != _HEADER:
             raise InvalidFileException(
-                "Wrong .map file - wrong header %r" % content[0])
+                "Wrong .map file - wrong header %r" % lines[0].strip())
 
-        if len(content) < 10:
+        if len(lines) < 10:
             raise InvalidFileException("Wrong .map file - too short")
 
-        self.img_filename = content[1]
-        self.img_filepath = content[2]
+        self.img_filename = lines[1].strip()
+        self.img_filepath = lines[2].strip()
         # line 3 - skip
-        self.projection = content[4]
+        self.projection = lines[4].strip()
         # line 5-6 - reserverd
         # line 7 - Magnetic variation
-        self.map_projection = content[8]
-
-        for line in content[9:]:
+        self.map_projection = lines[8].strip()
+
+        points = self.points
+        mmpll = self.mmpll
+        mmpxy = self.mmpxy
+        for line in lines[9:]:
+            # dispatch by line prefix; values are parsed only for known
+            # lines
+            line = line.lstrip()
+            key = line[:5]
             try:
-                if line.startswith("Point"):
+                if key == 'Point':
                     point = _parse_point(line)
                     if point:
-                        self.points.append(point)
-                elif line.startswith('IWH,Map Image Width/Height,'):
-                    self.image_width, self.image_height = \
-                        map(int, line[27:].split(','))
-                elif line.startswith('MMPNUM,'):
-                    self.mmpnum = int(line[7:])
-                elif line.startswith('MMPLL'):
+                        points.append(point)
+                elif key == 'MMPLL':
                     point_id, lon, lat = _parse_mmpll(line)
-                    if point_id - 1 != len(self.mmpll):
+                    if point_id - 1 != len(mmpll):
                         raise InvalidFileException("Invalid MMPLL point id")
-                    self.mmpll.append((lon, lat))
-                elif line.startswith('MMPXY'):
+                    mmpll.append((lon, lat))
+                elif key == 'MMPXY':
                     point_id, x, y = _parse_mmpxy(line)
-                    if point_id - 1 != len(self.mmpxy):
-                        _LOG.warn("parse mmpxy error: %r", line)
+                    if point_id - 1 != len(mmpxy):
+                        _LOG.warning("parse mmpxy error: %r", line)
                         raise InvalidFileException("Invalid MMPXY point index")
-                    self.mmpxy.append((x, y))
-                elif line.startswith('MM1B,'):
+                    mmpxy.append((x, y))
+                elif key == 'IWH,M' and line.startswith(_IWH_PREFIX):
+                    self.image_width, self.image_height = \
+                        map(int, line[27:].split(','))
+                elif key == 'MMPNU' and line.startswith('MMPNUM,'):
+                    self.mmpnum = int(line[7:])
+                elif key == 'MM1B,':
                     self.mm1b = float(line[5:])
-            except ValueError as err:
+            except (ValueError, IndexError) as err:
                 raise InvalidFileException(
-                    f"Error loading line '{line}': {err}")
+                    f"Error loading line '{line.strip()}': {err}")
 
     def to_str(self):
         points = []
         for idx, p in enumerate(self.points):
-            _LOG.debug("Point %r", p)
             lat_m, lat_s, lat_d = _degree2minsec(p.lat, 'S', 'N')
             lon_m, lon_s, lon_d = _degree2minsec(p.lon, 'W', 'E')
             points.append(_MAP_POINT_TEMPLATE.format(
@@ -175,38 +220,200 @@ class MapFile():
                          math.cos(math.radians(lat_avg)))
 
         self.mm1b = d_lon_dist / self.image_width
+        self._transform = None
 
     def validate(self):
         """Check is mapfile is valid."""
         _LOG.debug("mapfile: %s", self)
         return self.mmpnum == len(self.mmpxy) == len(self.mmpll) == 4
 
-    def xy2latlon(self, x, y):
-        """Get geo location for given pixel coordinates."""
-        if not self.mmpll:
+    @property
+    def transform(self):
+        """Transform object for map calibration; None if not calibrated.
+
+        Transform is created on first use and reset by `calibrate` and
+        `parse_map`.
+        """
+        if self._transform is None and len(self.mmpll) >= 4:
+            self._transform = Transform(self.mmpll, self.image_width,
+                                        self.image_height)
+        return self._transform
+
+    def xy2lonlat(self, x, y):
+        """Get geo location (lon, lat) for given pixel coordinates."""
+        transform = self.transform
+        if transform is None:
+            return None
+        return transform.forward(x, y)
+
+    # compatibility; result is (lon, lat)
+    xy2latlon = xy2lonlat
+
+    def lonlat2xy(self, lon, lat):
+        """Get pixel coordinates for geo location; inverse of `xy2lonlat`.
+        """
+        transform = self.transform
+        if transform is None:
+            return None
+        return transform.inverse(lon, lat)
+
+    def xy2lonlat_many(self, xs, ys):
+        """Convert many pixel coordinates to geo location.
+
+        :param xs, ys: sequences (or NumPy arrays) of coordinates
+        :return: (lons, lats) as NumPy arrays, or lists when NumPy is not
+            available
+        """
+        transform = self.transform
+        if transform is None:
+            return None
+        return transform.forward_many(xs, ys)
+
+    def lonlat2xy_many(self, lons, lats):
+        """Convert many geo locations to pixel coordinates.
+
+        :return: (xs, ys) as NumPy arrays, or lists when NumPy is not
+            available
+        """
+        transform = self.transform
+        if transform is None:
             return None
-        return _map_xy_lonlat(
-            self.mmpll[0], self.mmpll[1], self.mmpll[2], self.mmpll[3],
-            self.image_width, self.image_height,
-            x, y)
+        return transform.inverse_many(lons, lats)
+
+
+class Transform:
+    """Bilinear pixel <-> geo coordinates transformation.
+
+    Map corners (nw, ne, se, sw) are interpolated bilinear; this is the
+    same as intersection of lines between interpolated edges points
+    (`_map_xy_lonlat`), but coefficients are computed only once.
+    Geo coordinates are in `mmpll` order (lon, lat).
+    """
+
+    __slots__ = ('width', 'height', '_lon', '_lat', '_xy')
+
+    def __init__(self, corners, width, height):
+        """Create transformation.
+
+        :param corners: (lon, lat) for nw, ne, se, sw corners
+        :param width, height: image size
+        """
+        (x0, y0), (x1, y1), (x2, y2), (x3, y3) = corners[:4]
+        self.width = width
+        self.height = height
+        # coefficients for normalized image coordinates (0-1)
+        self._lon = (x0, x1 - x0, x3 - x0, x0 - x1 + x2 - x3)
+        self._lat = (y0, y1 - y0, y3 - y0, y0 - y1 + y2 - y3)
+        # coefficients for pixel coordinates
+        self._xy = (
+            x0, self._lon[1] / width, self._lon[2] / height,
+            self._lon[3] / width / height,
+            y0, self._lat[1] / width, self._lat[2] / height,
+            self._lat[3] / width / height,
+        )
+
+    def forward(self, x, y):
+        """Convert pixel coordinates to (lon, lat)."""
+        a0, a1, a2, a3, b0, b1, b2, b3 = self._xy
+        xy = x * y
+        return (a0 + a1 * x + a2 * y + a3 * xy,
+                b0 + b1 * x + b2 * y + b3 * xy)
+
+    def inverse(self, lon, lat):
+        """Convert (lon, lat) to pixel coordinates."""
+        a0, a1, a2, a3 = self._lon
+        b0, b1, b2, b3 = self._lat
+        e = lon - a0
+        f = lat - b0
+        # quadratic equation for normalized y (t)
+        qa = a3 * b2 - a2 * b3
+        qb = e * b3 - f * a3 + a1 * b2 - a2 * b1
+        qc = e * b1 - f * a1
+        if abs(qa) <= 1e-12 * abs(qb):
+            t = -qc / qb
+        else:
+            delta = math.sqrt(max(qb * qb - 4 * qa * qc, 0.0))
+            q = -0.5 * (qb + math.copysign(delta, qb))
+            t1 = q / qa
+            t2 = qc / q if q else t1
+            # select solution nearest map
+            t = t1 if abs(t1 - 0.5) < abs(t2 - 0.5) else t2
+
+        denom_a = a1 + a3 * t
+        denom_b = b1 + b3 * t
+        if abs(denom_a) >= abs(denom_b):
+            s = (e - a2 * t) / denom_a
+        else:
+            s = (f - b2 * t) / denom_b
+        return s * self.width, t * self.height
+
+    def forward_many(self, xs, ys):
+        """Convert many pixel coordinates; see `forward`."""
+        numpy = get_numpy()
+        if numpy is None:
+            return self._forward_many_py(xs, ys)
+
+        a0, a1, a2, a3, b0, b1, b2, b3 = self._xy
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        xy = xs * ys
+        return (a0 + a1 * xs + a2 * ys + a3 * xy,
+                b0 + b1 * xs + b2 * ys + b3 * xy)
+
+    def _forward_many_py(self, xs, ys):
+        forward = self.forward
+        res = [forward(x, y) for x, y in zip(xs, ys)]
+        return [r[0] for r in res], [r[1] for r in res]
+
+    def inverse_many(self, lons, lats):
+        """Convert many geo coordinates; see `inverse`."""
+        numpy = get_numpy()
+        if numpy is None:
+            return self._inverse_many_py(lons, lats)
+
+        a0, a1, a2, a3 = self._lon
+        b0, b1, b2, b3 = self._lat
+        e = numpy.asarray(lons, dtype=float) - a0
+        f = numpy.asarray(lats, dtype=float) - b0
+        qa = a3 * b2 - a2 * b3
+        qb = e * b3 - f * a3 + a1 * b2 - a2 * b1
+        qc = e * b1 - f * a1
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            linear = numpy.abs(qa) <= 1e-12 * numpy.abs(qb)
+            delta = numpy.sqrt(numpy.maximum(qb * qb - 4 * qa * qc, 0.0))
+            q = -0.5 * (qb + numpy.copysign(delta, qb))
+            t1 = q / qa
+            t2 = numpy.where(q != 0, qc / q, t1)
+            t = numpy.where(
+                linear, -qc / qb,
+                numpy.where(numpy.abs(t1 - 0.5) < numpy.abs(t2 - 0.5),
+                            t1, t2))
+            denom_a = a1 + a3 * t
+            denom_b = b1 + b3 * t
+            s = numpy.where(numpy.abs(denom_a) >= numpy.abs(denom_b),
+                            (e - a2 * t) / denom_a,
+                            (f - b2 * t) / denom_b)
+        return s * self.width, t * self.height
+
+    def _inverse_many_py(self, lons, lats):
+        inverse = self.inverse
+        res = [inverse(lon, lat) for lon, lat in zip(lons, lats)]
+        return [r[0] for r in res], [r[1] for r in res]
 
 
 def _parse_point(line):
-    _LOG.debug("_parse_point %r", line)
-    fields = line.split(',')
-    if fields[2].strip() == "":
+    # most points in map files are empty; check x before splitting all
+    if line.split(',', 3)[2].strip() == "":
         return None
-    point = Point(
-        x=int(fields[2]),
-        y=int(fields[3]),
-        lat=int(fields[6]) + float(fields[7]) / 60.,
-        lon=int(fields[9]) + float(fields[10]) / 60.)
-    point.idx = int(fields[0][5:])
-    if fields[8] == 'E':
-        point.lon *= -1
-    if fields[11] == 'S':
-        point.lat *= -1
-    return point
+    fields = line.split(',')
+    lat = int(fields[6]) + float(fields[7]) / 60.
+    if fields[8].strip() == 'S':
+        lat = -lat
+    lon = int(fields[9]) + float(fields[10]) / 60.
+    if fields[11].strip() == 'W':
+        lon = -lon
+    return Point(int(fields[2]), int(fields[3]), lon, lat,
+                 int(fields[0][5:]))
 
 
 def _parse_mmpxy(line):
@@ -214,16 +421,12 @@ def _parse_mmpxy(line):
     if len(fields) != 4:
         raise InvalidFileException(
             "Wrong .map file - wrong number of fields in MMPXY field %r"
-            % line)
-    _, point_id, x, y = [field.strip() for field in fields]
+            % line.strip())
     try:
-        point_id = int(point_id)
-        x = int(x)
-        y = int(y)
+        return int(fields[1]), int(fields[2]), int(fields[3])
     except ValueError as err:
         raise InvalidFileException(
-            "Wrong .map file - wrong MMPXY field %r; %s" % (line, err))
-    return point_id, x, y
+            "Wrong .map file - wrong MMPXY field %r; %s" % (line.strip(), err))
 
 
 def _parse_mmpll(line):
@@ -231,16 +434,35 @@ def _parse_mmpll(line):
     if len(fields) != 4:
         raise InvalidFileException(
             "Wrong .map file - wrong number of fields in MMPLL field %r"
-            % line)
-    _, point_id, lon, lat = [field.strip() for field in fields]
+            % line.strip())
     try:
-        point_id = int(point_id)
-        lon = float(lon)
-        lat = float(lat)
+        return int(fields[1]), float(fields[2]), float(fields[3])
     except ValueError as err:
         raise InvalidFileException(
-            "Wrong .map file - wrong MMPLL field %r; %s" % (line, err))
-    return point_id, lon, lat
+            "Wrong .map file - wrong MMPLL field %r; %s" % (line.strip(), err))
+
+
+def parse_many(contents, ignore_errors=False):
+    """Parse many .map files content.
+
+    :param contents: iterable of .map files content
+    :param ignore_errors: return None for invalid files instead of raising
+        InvalidFileException
+    :return: list of MapFile
+    """
+    result = []
+    with profiling.timer("mapfile.parse_many"):
+        for content in contents:
+            map_file = MapFile()
+            try:
+                map_file._parse_map(content)  # pylint: disable=W0212
+            except InvalidFileException as err:
+                if not ignore_errors:
+                    raise
+                _LOG.debug("parse_many: invalid file: %s", err)
+                map_file = None
+            result.append(map_file)
+    return result
 
 
 def _sort_points(positions, width, height):
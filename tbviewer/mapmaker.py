@@ -9,31 +9,74 @@
 
 """Function for creating Trekbuddy maps."""
 
+import io
 import os
 import os.path
 import logging
 import tarfile
+import time
 
 from PIL import Image
 
 _LOG = logging.getLogger(__name__)
 
 
-def _create_img_saver(options):
+def _create_global_palette(img, sample_size=512):
+    """Compute one adaptive palette for whole `img`.
+
+    Palette is calculated from downscaled copy of image so it cover all
+    colours used on map and cost only one quantization.
+
+    :param img: source image
+    :param sample_size: max size (width and height) of sample image
+    :return: palette image ('P' mode) usable in `Image.quantize`
+    """
+    # downscale before conversion; don't create full size copy of image
+    scale = min(sample_size / max(img.size), 1.0)
+    size = (max(int(img.width * scale), 1), max(int(img.height * scale), 1))
+    sample = img.resize(size, Image.BOX).convert('RGB')
+    palette = sample.quantize(256)
+    _LOG.debug("_create_global_palette: sample=%r", sample.size)
+    return palette
+
+
+def _create_img_saver(options, img=None):
     if options.get('format') == 'PNG':
         compr = options.get('png_compression')
 
         opts = {
             'optimize': compr == 'optimized',
-            'compress_level': (int(compress_level)
-                               if compr != 'optimized' else 7),
+            'compress_level': (int(compr) if compr != 'optimized' else 7),
         }
 
-        if options.get('png_palette') == 'RGB':
+        png_palette = options.get('png_palette')
+        if png_palette == 'RGB':
             _LOG.info("_create_img_saver png rgb, opts=%r", opts)
             imgsavef = lambda img, fname: img.save(fname, 'PNG', **opts)
             return imgsavef, 'png'
 
+        if png_palette == '256c global' and img is not None:
+            _LOG.info("_create_img_saver png global palette, opts=%r", opts)
+            palette = _create_global_palette(img)
+            imgsavef = lambda img, fname: img.convert('RGB')\
+                .quantize(palette=palette, dither=Image.NONE)\
+                .save(fname, 'PNG', **opts)
+            return imgsavef, 'png'
+
+        if png_palette == '256c adaptive':
+            _LOG.info("_create_img_saver png adaptive palette, opts=%r",
+                      opts)
+
+            def imgsavef(img, fname):
+                # palette optimized for each image
+                if img.mode == 'RGBA':
+                    img = img.quantize(256, method=Image.FASTOCTREE)
+                else:
+                    img = img.convert('RGB').quantize(256)
+                img.save(fname, 'PNG', **opts)
+
+            return imgsavef, 'png'
+
         _LOG.info("_create_img_saver png palette, opts=%r", opts)
         imgsavef = lambda img, fname: img.convert(mode='P')\
             .save(fname, 'PNG', **opts)
@@ -52,13 +95,14 @@ def cut_map(filename, dst_dir, dst_name, options):
     :param filename: image filename
     :param dst_dir: destination directory
     :param tile_size: (tile width, tile_height), default=(256, 256)
+    :return: (number of created tiles, size of created tiles in bytes)
     """
     img = Image.open(filename)
     img_width = img.width
     img_height = img.height
     tile_width, tile_height = options.get('tile_size') or (256, 256)
     force = bool(options.get('force'))
-    imgsavef, imgext = _create_img_saver(options)
+    imgsavef, imgext = _create_img_saver(options, img)
     dst_name = os.path.splitext(dst_name)[0]
 
     img_dst_dir = os.path.join(dst_dir, "set")
@@ -67,6 +111,7 @@ def cut_map(filename, dst_dir, dst_name, options):
     existing_files = set() if force else set(os.listdir(img_dst_dir))
 
     img_names = []
+    tiles = size = 0
     for x in range(0, img_width, tile_width):
         for y in range(0, img_height, tile_height):
             fname = f"{dst_name}_{x}_{y}.{imgext}"
@@ -81,11 +126,15 @@ def cut_map(filename, dst_dir, dst_name, options):
             img_filepath = os.path.join(img_dst_dir, fname)
             imgsavef(simg, img_filepath)
             simg = None
+            tiles += 1
+            size += os.path.getsize(img_filepath)
 
     set_fname = dst_name + ".set"
     with open(os.path.join(dst_dir, set_fname), "tw") as fset:
         fset.write("\n".join(img_names))
 
+    return tiles, size
+
 
 def create_map(img_filename, map_content, dst_file, options=None):
     """Create trekbuddy map file.
@@ -94,6 +143,7 @@ def create_map(img_filename, map_content, dst_file, options=None):
     :param map_content: content of .map file
     :param dst_file: destination .map file name
     :param options: map options
+    :return: (number of created tiles, size of created tiles in bytes)
     """
     opt = {
         'tile_size': (256, 256),
@@ -103,7 +153,7 @@ def create_map(img_filename, map_content, dst_file, options=None):
     opt.update(options or {})
     dst_dir = os.path.dirname(dst_file)
     name = os.path.basename(dst_file)
-    cut_map(img_filename, dst_dir, name, options)
+    stats = cut_map(img_filename, dst_dir, name, opt)
     if map_content:
         with open(dst_file, "wt") as fmap:
             fmap.write(map_content)
@@ -121,3 +171,77 @@ def create_map(img_filename, map_content, dst_file, options=None):
             for img_name in os.listdir(os.path.join(dst_dir, 'set')):
                 tar.add(os.path.join(dst_dir, 'set', img_name),
                         os.path.join('set', img_name))
+
+    return stats
+
+
+class TarMapWriter:
+    """Write trekbuddy map directly to tar file, tile by tile.
+
+    Tiles are not stored in temporary files. .map file is written first
+    (file type can be detected reading only first header), .set file - on
+    close. Tar is created under temporary name and renamed on close.
+    """
+
+    def __init__(self, tar_fname, map_content, options=None):
+        """Create writer.
+
+        :param tar_fname: destination tar file name
+        :param map_content: content of .map file
+        :param options: options for tiles encoding (format, jpeg_quality,
+            png_compression, png_palette) used by `add_tile_image`
+        """
+        self.tar_fname = tar_fname
+        self.name = os.path.splitext(os.path.basename(tar_fname))[0]
+        self.bytes_written = 0
+        self._tmp_fname = tar_fname + ".tmp"
+        self._names = []
+        self._mtime = time.time()
+        self._imgsavef, self._imgext = _create_img_saver(options or {})
+        self._tar = tarfile.open(self._tmp_fname, "w")
+        self._add(self.name + ".map",
+                  map_content.encode('cp1250', errors='replace'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self._mtime
+        self._tar.addfile(info, io.BytesIO(data))
+        self.bytes_written += len(data)
+
+    def add_tile(self, x, y, data, ext):
+        """Add encoded tile.
+
+        :param x, y: position of tile top-left corner in map pixels
+        :param data: tile file content
+        :param ext: tile file extension (jpg, png)
+        """
+        fname = f"{self.name}_{x}_{y}.{ext}"
+        self._add("set/" + fname, data)
+        self._names.append(fname)
+
+    def add_tile_image(self, x, y, img):
+        """Encode PIL image according to options and add it as tile."""
+        with io.BytesIO() as bfile:
+            self._imgsavef(img, bfile)
+            self.add_tile(x, y, bfile.getvalue(), self._imgext)
+
+    def close(self):
+        """Write .set file and finish tar."""
+        self._add(self.name + ".set", "\n".join(self._names).encode())
+        self._tar.close()
+        os.replace(self._tmp_fname, self.tar_fname)
+
+    def abort(self):
+        """Close and remove unfinished tar file."""
+        self._tar.close()
+        os.unlink(self._tmp_fname)
@@ -0,0 +1,271 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Conversion of Trekbuddy maps and atlases to MBTiles files.
+
+Maps are stored without reprojection, so files created by `export_map` are
+private tbviewer container using MBTiles layout, not standard MBTiles:
+tiles are in map pixels grid, tile_column and tile_row are indexes of tiles
+counted from top-left corner of map and all tiles are on zoom level 0.
+Such files are marked by `META_GRID` metadata key and don't declare
+tiles scheme. Content of .map file and size of tiles are stored in
+metadata, so file can be opened by `map_loader` like tar map.
+
+Standard MBTiles files (Web Mercator, tms scheme) are created by
+reprojection of map (`xyz.reproject_map`) and `MBTilesWriter`.
+"""
+
+import optparse
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+from . import version
+from . import map_loader
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX metadata_name ON metadata (name);
+CREATE TABLE tiles (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_data BLOB
+);
+CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+"""
+
+# metadata keys used by map_loader
+META_MAP = 'tbviewer_map'
+META_TILE_SIZE = 'tbviewer_tile_size'
+# marker of files with tiles in map pixels grid (value: 'pixel')
+META_GRID = 'tbviewer_grid'
+
+_FORMATS = {'.jpg': 'jpg', '.jpeg': 'jpg', '.png': 'png'}
+
+
+def _bounds(map_data):
+    """Bounds of map (left, bottom, right, top) from map corners."""
+    if not map_data or not map_data.mmpll:
+        return None
+    lons = [lon for lon, _lat in map_data.mmpll]
+    lats = [lat for _lon, lat in map_data.mmpll]
+    return f"{min(lons)},{min(lats)},{max(lons)},{max(lats)}"
+
+
+def _tile_format(tbmap):
+    for name in tbmap.set_data.values():
+        return _FORMATS.get(os.path.splitext(name)[1].lower(), 'jpg')
+    return 'jpg'
+
+
+class MBTilesWriter:
+    """Write tiles to new MBTiles file.
+
+    File is created under temporary name and renamed on close.
+    """
+
+    def __init__(self, dst_file, metadata):
+        """Create writer.
+
+        :param dst_file: destination file name
+        :param metadata: dict of metadata
+        """
+        self.dst_file = dst_file
+        self.tiles = 0
+        self._tmp_file = dst_file + ".tmp"
+        if os.path.exists(self._tmp_file):
+            os.unlink(self._tmp_file)
+        self._conn = sqlite3.connect(self._tmp_file)
+        try:
+            # file is renamed only when completed; journal is not needed
+            self._conn.execute("PRAGMA journal_mode=OFF")
+            self._conn.execute("PRAGMA synchronous=OFF")
+            self._conn.executescript(_SCHEMA)
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                    metadata.items())
+        except BaseException:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_tiles(self, tiles):
+        """Insert tiles in one transaction.
+
+        :param tiles: list of (zoom level, tile column, tile row, data)
+        """
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO tiles (zoom_level, tile_column, tile_row, "
+                "tile_data) VALUES (?, ?, ?, ?)", tiles)
+        self.tiles += len(tiles)
+
+    def close(self):
+        """Finish file."""
+        self._conn.close()
+        os.replace(self._tmp_file, self.dst_file)
+
+    def abort(self):
+        """Close and remove unfinished file."""
+        self._conn.close()
+        os.unlink(self._tmp_file)
+
+
+def export_map(tbmap, dst_file, name=None, batch_size=256, progress=None):
+    """Write map to MBTiles file (in map pixels grid, see module doc).
+
+    File is created under temporary name and renamed when finished; tiles
+    are inserted in transactions of `batch_size` tiles.
+
+    :param tbmap: opened `map_loader.Map`
+    :param dst_file: destination file name
+    :param name: name of map; default: name of destination file
+    :param progress: function(done tiles, all tiles) called after each batch
+    :return: dict with statistics
+    """
+    tstart = time.time()
+    map_content = tbmap.get_map_file_content()
+    if not map_content:
+        raise InvalidFileException("missing .map file")
+    name = name or os.path.splitext(os.path.basename(dst_file))[0]
+    metadata = {
+        'name': name,
+        'type': 'baselayer',
+        'version': '1.1',
+        'description': 'Trekbuddy map (tbviewer pixel grid, not Web '
+                       'Mercator)',
+        'format': _tile_format(tbmap),
+        META_GRID: 'pixel',
+        META_MAP: map_content,
+        META_TILE_SIZE: f"{tbmap.tile_width},{tbmap.tile_height}",
+    }
+    bounds = _bounds(tbmap.map_data)
+    if bounds:
+        metadata['bounds'] = bounds
+
+    # tiles are read in order of rows; this is order of tiles in tar files
+    positions = sorted(tbmap.set_data, key=lambda pos: (pos[1], pos[0]))
+    tile_width, tile_height = tbmap.tile_width, tbmap.tile_height
+    bytes_read = tbmap.bytes_read
+
+    with MBTilesWriter(dst_file, metadata) as writer:
+        for idx in range(0, len(positions), batch_size):
+            writer.add_tiles([(0, x // tile_width, y // tile_height,
+                               tbmap.get_tile_bytes(x, y))
+                              for x, y in positions[idx:idx + batch_size]])
+            if progress:
+                progress(min(idx + batch_size, len(positions)),
+                         len(positions))
+
+    return {
+        'tiles': len(positions),
+        'bytes_read': tbmap.bytes_read - bytes_read,
+        'bytes_written': os.path.getsize(dst_file),
+        'time': time.time() - tstart,
+    }
+
+
+def export_atlas(atlas, dst_dir, batch_size=256):
+    """Write each map of atlas to MBTiles file.
+
+    Destination directory get structure of atlas (`atlas.tba`,
+    layer/map/map.mbtiles) so it can be opened like .tba atlas.
+
+    :param atlas: opened `map_loader.Atlas` or `map_loader.FakeAlbum`
+    :return: list of (layer, map name, statistics or error message)
+    """
+    os.makedirs(dst_dir, exist_ok=True)
+    with open(os.path.join(dst_dir, "atlas.tba"), "wt") as tba:
+        tba.write("Atlas 1.0\n")
+
+    results = []
+    for layer, maps in atlas.layers:
+        for name, path in maps:
+            map_dir = os.path.join(dst_dir, layer, name)
+            os.makedirs(map_dir, exist_ok=True)
+            dst_file = os.path.join(map_dir, name + ".mbtiles")
+            try:
+                with atlas.open_map(path) as tbmap:
+                    stats = export_map(tbmap, dst_file, name, batch_size)
+            except (IOError, OSError, InvalidFileException) as err:
+                _LOG.error("export %s/%s error: %s", layer, name, err)
+                results.append((layer, name, str(err)))
+                continue
+            _LOG.info("%s/%s: %s", layer, name, format_stats(stats))
+            results.append((layer, name, stats))
+    return results
+
+
+def format_stats(stats):
+    return ("tiles: {tiles}; read {mb_read:0.1f} MB; written "
+            "{mb_written:0.1f} MB; time: {time:0.2f}s".format(
+                mb_read=stats['bytes_read'] / 1048576,
+                mb_written=stats['bytes_written'] / 1048576, **stats))
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <map or atlas file> <output>\n\n"
+        "Single map is written to <output> file; atlas - to <output> "
+        "directory.")
+    optp.add_option("--batch-size", type="int", default=256,
+                    help="number of tiles inserted in one transaction")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run conversion for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("map/atlas file and output required")
+        return 1
+
+    src, dst = args
+    try:
+        file_type, fs = map_loader.sniff_file_type(src)
+        if file_type in ('atlas', 'tar-atlas'):
+            with map_loader.Atlas(src, fs) as atlas:
+                results = export_atlas(atlas, dst, options.batch_size)
+            return 1 if any(isinstance(res, str) for _, _, res in results) \
+                else 0
+        if file_type in ('map', 'tar-map', 'mbtiles-map'):
+            with map_loader.Map(src, fs) as tbmap:
+                stats = export_map(tbmap, dst,
+                                   batch_size=options.batch_size)
+            _LOG.info("finished; %s", format_stats(stats))
+            return 0
+    except (IOError, OSError, InvalidFileException) as err:
+        _LOG.error("export error: %s", err)
+        return 1
+
+    _LOG.error("invalid file - should be .map or .tar or .tba")
+    return 1
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Lightweight timers for hot paths; active only when profiling."""
+
+import time
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+_ENABLED = False
+# name -> [calls, total time, max time]
+_STATS = {}
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('_name', '_start')
+
+    def __init__(self, name):
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        stat = _STATS.get(self._name)
+        if stat is None:
+            _STATS[self._name] = [1, elapsed, elapsed]
+        else:
+            stat[0] += 1
+            stat[1] += elapsed
+            if elapsed > stat[2]:
+                stat[2] = elapsed
+        return False
+
+
+def enable(enabled=True):
+    """Enable/disable collecting timers."""
+    global _ENABLED
+    _ENABLED = enabled
+
+
+def is_enabled():
+    return _ENABLED
+
+
+def timer(name):
+    """Create context manager that measure time of block.
+
+    When profiling is disabled return shared no-op context manager.
+    """
+    if _ENABLED:
+        return _Timer(name)
+    return _NULL_TIMER
+
+
+def get_stats():
+    """Get collected stats as dict name -> (calls, total time, max time)."""
+    return {name: tuple(stat) for name, stat in _STATS.items()}
+
+
+def reset():
+    _STATS.clear()
+
+
+def format_stats():
+    """Format collected stats as text table."""
+    lines = ["{:<32} {:>8} {:>12} {:>12} {:>12}".format(
+        "name", "calls", "total [ms]", "avg [ms]", "max [ms]")]
+    for name, (calls, total, tmax) in sorted(
+            _STATS.items(), key=lambda x: -x[1][1]):
+        lines.append("{:<32} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            name, calls, total * 1000, total * 1000 / calls, tmax * 1000))
+    return "\n".join(lines)
+
+
+def run_profiled(func, stats_filename):
+    """Run `func` under cProfile and save results.
+
+    Create `stats_filename` (pstats binary format), `stats_filename`.txt
+    with text report and timers stats.
+    """
+    import cProfile
+    import pstats
+
+    enable()
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(func)
+    finally:
+        prof.dump_stats(stats_filename)
+        with open(stats_filename + ".txt", "w") as out:
+            stat = pstats.Stats(prof, stream=out)
+            stat.sort_stats('cumulative').print_stats('tbviewer', 50)
+            out.write('\n\n----------------------------\n\n')
+            stat.sort_stats('time').print_stats(50)
+            out.write('\n\n============================\n\n')
+            out.write(format_stats())
+            out.write('\n')
+        _LOG.debug("profile stats saved to %s", stats_filename)
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Re-tiling existing maps to different tile size.
+
+New map is created row by row of new tiles; only source tiles overlapping
+current row are decoded and kept in memory. Tiles are written directly to
+tar file.
+"""
+
+import logging
+import optparse
+import os.path
+import time
+
+from . import export
+from . import map_loader
+from . import mapmaker
+from . import version
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+
+def _tile_format(tbmap):
+    for name in tbmap.set_data.values():
+        if os.path.splitext(name)[1].lower() == '.png':
+            return 'PNG'
+        break
+    return 'JPEG'
+
+
+def retile_map(tbmap, dst_file, tile_size, options=None, progress=None):
+    """Create copy of map with different tile size.
+
+    :param tbmap: opened `map_loader.Map`
+    :param dst_file: destination tar file
+    :param tile_size: (tile width, tile height)
+    :param options: tiles encoding options (see `mapmaker`); default
+        format: format of source tiles
+    :param progress: function(done rows, all rows)
+    :return: dict with statistics
+    """
+    tstart = time.time()
+    map_content = tbmap.get_map_file_content()
+    if not map_content:
+        raise InvalidFileException("missing .map file")
+    opt = {'format': _tile_format(tbmap), 'png_palette': 'RGB',
+           'png_compression': '6'}
+    opt.update(options or {})
+    tile_width, tile_height = tile_size
+    width, height = tbmap.width, tbmap.height
+    src_width, src_height = tbmap.tile_width, tbmap.tile_height
+    # pylint: disable=protected-access
+    reader = export._BandReader(tbmap, 'RGB')
+    rows = -(-height // tile_height)
+    tiles = 0
+    _LOG.info("retiling %dx%d map; tiles %dx%d -> %dx%d", width, height,
+              src_width, src_height, tile_width, tile_height)
+    with mapmaker.TarMapWriter(dst_file, map_content, opt) as writer:
+        for row, y in enumerate(range(0, height, tile_height)):
+            y1 = min(y + tile_height, height)
+            band = reader.read(0, y, width, y1)
+            # source tile rows overlapping band
+            src_rows = range(y - y % src_height, y1, src_height)
+            for x in range(0, width, tile_width):
+                x1 = min(x + tile_width, width)
+                # skip tiles without any source tile
+                if not any((sx, sy) in tbmap.set_data for sy in src_rows
+                           for sx in range(x - x % src_width, x1,
+                                           src_width)):
+                    continue
+                writer.add_tile_image(x, y, band.crop((x, 0, x1, y1 - y)))
+                tiles += 1
+            if progress:
+                progress(row + 1, rows)
+
+    return {
+        'tiles': tiles,
+        'tiles_read': reader.tiles_read,
+        'bytes_written': writer.bytes_written,
+        'time': time.time() - tstart,
+    }
+
+
+def format_stats(stats):
+    return ("tiles: {tiles} (read: {tiles_read}); written "
+            "{mb_written:0.1f} MB; time: {time:0.2f}s".format(
+                mb_written=stats['bytes_written'] / 1048576, **stats))
+
+
+def _parse_size(value):
+    width, _, height = value.lower().partition('x')
+    width = int(width)
+    height = int(height) if height else width
+    if width < 1 or height < 1:
+        raise ValueError("invalid size")
+    return width, height
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <map file> <output .tar>")
+    optp.add_option("--tile-size", "-s", default="512",
+                    help="new tile size: WIDTH[xHEIGHT] (default: 512)")
+    optp.add_option("--format", choices=("PNG", "JPEG"),
+                    help="tiles format; default: format of source tiles")
+    optp.add_option("--jpeg-quality", type="int", default=90)
+    optp.add_option("--png-compression", default="6",
+                    help="0-9 or 'optimized'")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run re-tiling for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("map file and output file required")
+        return 1
+
+    try:
+        tile_size = _parse_size(options.tile_size)
+    except ValueError as err:
+        _LOG.error("invalid tile size: %s", err)
+        return 1
+
+    map_options = {
+        'jpeg_quality': options.jpeg_quality,
+        'png_compression': options.png_compression,
+    }
+    if options.format:
+        map_options['format'] = options.format
+    try:
+        with map_loader.Map(args[0]) as tbmap:
+            stats = retile_map(tbmap, args[1], tile_size, map_options)
+    except (IOError, InvalidFileException) as err:
+        _LOG.error("retile error: %s", err)
+        return 1
+
+    _LOG.info("finished; %s", format_stats(stats))
+    return 0
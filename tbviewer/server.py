@@ -0,0 +1,482 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Asyncio HTTP server for tiles, maps metadata and layers of atlas.
+
+Urls:
+
+* ``/layers`` - json list of layers & maps
+* ``/maps/<layer>/<map>/info`` - json with map size, tiles size etc.
+* ``/maps/<layer>/<map>/map`` - .map file
+* ``/maps/<layer>/<map>/tiles/<x>/<y>`` - tile; x, y - position of tile
+  (top-left corner) in map pixels
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import optparse
+import os
+import time
+import urllib.parse
+
+from . import map_loader
+from . import version
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# tile is put into cache after this number of requests
+_HOT_THRESHOLD = 2
+# max number of tracked not-cached tiles
+_MAX_COUNTERS = 100000
+# max size of request head
+_MAX_HEAD = 16384
+# max number of remembered files versions (used in ETag)
+_MAX_VERSIONS = 100000
+
+_CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+_STATUS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or _STATUS.get(status, ''))
+        self.status = status
+
+
+class _Response:
+    __slots__ = ('status', 'headers', 'body', 'location')
+
+    def __init__(self, status=200, headers=None, body=b'', location=None):
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        # (file name, offset, size) - body sent by sendfile
+        self.location = location
+
+
+class TileCache:
+    """LRU cache of hot tiles limited by size of data."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._counters = {}
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item
+
+    def is_hot(self, key):
+        """Count request for not cached item; return True if should be
+        cached."""
+        if self.max_size <= 0:
+            return False
+        counters = self._counters
+        cnt = counters.get(key, 0) + 1
+        if cnt >= _HOT_THRESHOLD:
+            counters.pop(key, None)
+            return True
+        if len(counters) >= _MAX_COUNTERS:
+            counters.clear()
+        counters[key] = cnt
+        return False
+
+    def put(self, key, data, etag, content_type):
+        if len(data) > self.max_size:
+            return
+        old = self._items.pop(key, None)
+        if old:
+            self.size -= len(old[0])
+        self._items[key] = (data, etag, content_type)
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, item = self._items.popitem(last=False)
+            self.size -= len(item[0])
+
+
+class TileServer:
+    """Serve atlas or map over HTTP."""
+
+    def __init__(self, path, cache_size=64 * 1024 * 1024,
+                 max_age=86400):
+        """Create server.
+
+        :param path: atlas/map file (as accepted by viewer)
+        :param cache_size: max size of hot tiles cache in bytes
+        :param max_age: Cache-Control max-age for tiles
+        """
+        file_type, fs = map_loader.sniff_file_type(path)
+        if file_type in ('atlas', 'tar-atlas'):
+            self.atlas = map_loader.Atlas(path, fs)
+        elif file_type in ('map', 'tar-map', 'mbtiles-map'):
+            self.atlas = map_loader.FakeAlbum(path, fs)
+        else:
+            raise InvalidFileException("Invalid file - should be .map or "
+                                       ".tar or .tba")
+        self.max_age = max_age
+        self.cache = TileCache(cache_size)
+        self.requests = 0
+        # (layer, name) -> map path
+        self._paths = {(layer, name): mpath
+                       for layer, maps in self.atlas.layers
+                       for name, mpath in maps}
+        # (layer, name) -> future of opened map
+        self._maps = {}
+        # file name -> file version; files are checked once
+        self._versions = {}
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        self._server = await asyncio.start_server(
+            self._handle_connection, host, port)
+        return self._server
+
+    def close(self):
+        if self._server:
+            self._server.close()
+        for fut in self._maps.values():
+            if fut.done() and not fut.exception():
+                fut.result().close()
+        self._maps.clear()
+        self.atlas.close()
+
+    @property
+    def sockets(self):
+        return self._server.sockets if self._server else []
+
+    async def _get_map(self, layer, name):
+        """Get opened map; maps are opened (in executor) on first use."""
+        key = (layer, name)
+        fut = self._maps.get(key)
+        if fut is None:
+            path = self._paths.get(key)
+            if path is None:
+                raise HttpError(404, "map not found")
+            loop = asyncio.get_running_loop()
+            fut = loop.run_in_executor(None, self.atlas.open_map, path)
+            self._maps[key] = fut
+        try:
+            return await asyncio.shield(fut)
+        except (IOError, InvalidFileException) as err:
+            _LOG.warning("open map %s/%s error: %s", layer, name, err)
+            self._maps.pop(key, None)
+            raise HttpError(404, f"can't open map: {err}")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send(writer, 'GET', _error_response(400),
+                                     False)
+                    break
+                keep_alive = await self._handle_request(head, writer)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, head, writer):
+        tstart = time.perf_counter()
+        self.requests += 1
+        try:
+            method, path, keep_alive, headers = _parse_head(head)
+        except HttpError as err:
+            await self._send(writer, 'GET', _error_response(err.status),
+                             False)
+            return False
+
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise HttpError(405)
+            resp = await self._dispatch(path, headers)
+        except HttpError as err:
+            resp = _error_response(err.status, str(err))
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception("request %s error", path)
+            resp = _error_response(500)
+
+        etag = resp.headers.get('ETag')
+        if etag and resp.status == 200 and \
+                _etag_matches(etag, headers.get('if-none-match')):
+            resp = _Response(304, {key: val for key, val
+                                   in resp.headers.items()
+                                   if key in ('ETag', 'Cache-Control')})
+
+        await self._send(writer, method, resp, keep_alive)
+        _LOG.debug("%s %s %d %0.2fms", method, path, resp.status,
+                   (time.perf_counter() - tstart) * 1000)
+        return keep_alive
+
+    async def _send(self, writer, method, resp, keep_alive):
+        location = resp.location
+        length = location[2] if location else len(resp.body)
+        lines = [f"HTTP/1.1 {resp.status} {_STATUS.get(resp.status, '')}",
+                 f"Content-Length: {length}",
+                 "Connection: " + ("keep-alive" if keep_alive else "close"),
+                 "Server: " + version.NAME]
+        lines.extend(f"{key}: {val}" for key, val in resp.headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin1'))
+        if method == 'HEAD' or resp.status == 304:
+            await writer.drain()
+            return
+
+        if location:
+            fname, offset, size = location
+            await writer.drain()
+            with open(fname, 'rb') as ifile:
+                # zero-copy when possible; asyncio fall back to read/write
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, ifile, offset, size)
+        else:
+            writer.write(resp.body)
+            await writer.drain()
+
+    async def _dispatch(self, path, _headers):
+        parts = [urllib.parse.unquote(part)
+                 for part in path.strip('/').split('/')]
+        if parts == ['layers']:
+            return self._layers()
+        if len(parts) >= 4 and parts[0] == 'maps':
+            layer, name, what = parts[1:4]
+            if what == 'tiles' and len(parts) == 6:
+                try:
+                    x, y = int(parts[4]), int(parts[5])
+                except ValueError:
+                    raise HttpError(400, "invalid tile position")
+                return await self._tile(layer, name, x, y)
+            if len(parts) == 4:
+                if what == 'map':
+                    return await self._map_file(layer, name)
+                if what == 'info':
+                    return await self._map_info(layer, name)
+        raise HttpError(404)
+
+    def _layers(self):
+        layers = [{
+            'name': layer,
+            'maps': [{'name': name,
+                      'url': '/maps/' + urllib.parse.quote(layer) + '/' +
+                             urllib.parse.quote(name)}
+                     for name, _ in maps]
+        } for layer, maps in self.atlas.layers]
+        return _json_response(layers, "no-cache")
+
+    async def _map_file(self, layer, name):
+        tbmap = await self._get_map(layer, name)
+        if not tbmap.map_data:
+            raise HttpError(404, "map file not found")
+        body = tbmap.map_data.to_str().encode('cp1250')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        return _Response(200, {
+            'Content-Type': 'text/plain; charset=cp1250',
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+        }, body)
+
+    async def _map_info(self, layer, name):
+        tbmap = await self._get_map(layer, name)
+        return _json_response({
+            'layer': layer,
+            'name': name,
+            'width': tbmap.width,
+            'height': tbmap.height,
+            'tile_width': tbmap.tile_width,
+            'tile_height': tbmap.tile_height,
+            'tiles': len(tbmap.set_data),
+        }, "no-cache")
+
+    async def _tile(self, layer, name, x, y):
+        key = (layer, name, x, y)
+        headers = {'Cache-Control': f'public, max-age={self.max_age}'}
+        cached = self.cache.get(key)
+        if cached:
+            data, headers['ETag'], headers['Content-Type'] = cached
+            return _Response(200, headers, data)
+
+        tbmap = await self._get_map(layer, name)
+        tname = tbmap.set_data.get((x, y))
+        if not tname:
+            raise HttpError(404, "tile not found")
+        headers['Content-Type'] = _content_type(tname)
+        location = tbmap.get_tile_location(x, y)
+        if location:
+            fname, offset, size = location
+            fversion = await self._file_version(fname)
+            etag = f'"{fversion}-{offset:x}-{size:x}"'
+        else:
+            etag = None
+        hot = self.cache.is_hot(key)
+        if location and not hot:
+            headers['ETag'] = etag
+            return _Response(200, headers, location=location)
+
+        # concurrent requests for the same tile share one read
+        data = await tbmap.aget_tile_bytes(x, y)
+        if etag is None:
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+        headers['ETag'] = etag
+        if hot:
+            self.cache.put(key, data, etag, headers['Content-Type'])
+        return _Response(200, headers, data)
+
+    async def _file_version(self, fname):
+        """Get version of file; stat is run in executor on first use."""
+        fversion = self._versions.get(fname)
+        if fversion is None:
+            loop = asyncio.get_running_loop()
+            fversion = await loop.run_in_executor(None, _file_version, fname)
+            if len(self._versions) >= _MAX_VERSIONS:
+                self._versions.clear()
+            self._versions[fname] = fversion
+        return fversion
+
+
+def _etag_matches(etag, if_none_match):
+    """Check is `etag` listed in If-None-Match header (weak comparison)."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return True
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _file_version(fname):
+    stat = os.stat(fname)
+    return f"{stat.st_mtime_ns:x}"
+
+
+def _content_type(name):
+    ext = os.path.splitext(name)[1].lower()
+    return _CONTENT_TYPES.get(ext, 'application/octet-stream')
+
+
+def _json_response(data, cache_control):
+    body = json.dumps(data).encode()
+    return _Response(200, {
+        'Content-Type': 'application/json',
+        'Cache-Control': cache_control,
+    }, body)
+
+
+def _error_response(status, message=None):
+    body = (message or _STATUS.get(status, '')).encode()
+    return _Response(status, {'Content-Type': 'text/plain'}, body)
+
+
+def _parse_head(head):
+    """Parse request line and headers.
+
+    :return: (method, path, keep alive, headers dict with lower-case keys)
+    """
+    if len(head) > _MAX_HEAD:
+        raise HttpError(400)
+    try:
+        lines = head.decode('latin1').split("\r\n")
+        method, target, proto = lines[0].split(' ')
+    except ValueError:
+        raise HttpError(400)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        key, _, val = line.partition(':')
+        headers[key.strip().lower()] = val.strip()
+    connection = headers.get('connection', '').lower()
+    if proto == 'HTTP/1.0':
+        keep_alive = connection == 'keep-alive'
+    else:
+        keep_alive = connection != 'close'
+    path = urllib.parse.urlsplit(target).path
+    return method, path, keep_alive, headers
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <atlas or map file>")
+    optp.add_option("--host", default="127.0.0.1",
+                    help="address to listen on (default: 127.0.0.1)")
+    optp.add_option("--port", "-p", type="int", default=8080)
+    optp.add_option("--cache-size", type="int", default=64,
+                    help="size of hot tiles cache in MB (default: 64)")
+    optp.add_option("--max-age", type="int", default=86400,
+                    help="tiles max-age in seconds")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run server for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 1:
+        _LOG.error("missing atlas or map file name")
+        return 1
+
+    try:
+        server = TileServer(args[0], options.cache_size * 1024 * 1024,
+                            options.max_age)
+    except (IOError, InvalidFileException) as err:
+        _LOG.error("load %s error: %s", args[0], err)
+        return 1
+
+    async def serve():
+        await server.start(options.host, options.port)
+        for sock in server.sockets:
+            _LOG.info("listening on http://%s:%d/", *sock.getsockname()[:2])
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
@@ -0,0 +1,366 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Import Web Mercator tiles (XYZ directory or MBTiles) to Trekbuddy map.
+
+Map is created from tiles of one zoom level directly into tar file. When
+map tiles have the same size and are aligned to source tiles, source files
+are copied without decoding; otherwise map is composed row by row of map
+tiles and only source tiles overlapping current row are kept in memory.
+
+Map is calibrated by its corners; Mercator projection is approximated
+linear between corners, so big maps (many degrees of latitude) are less
+accurate.
+"""
+
+import io
+import logging
+import math
+import optparse
+import os
+import os.path
+import sqlite3
+import time
+
+from PIL import Image
+
+from . import map_loader
+from . import mapfile
+from . import mapmaker
+from . import version
+from . import xyz
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+_EXTS = {'jpg': 'jpg', 'jpeg': 'jpg', 'png': 'png'}
+
+
+class _XYZSource:
+    """Tiles in <path>/<zoom>/<x>/<y>.<ext> files."""
+
+    def __init__(self, path, zoom):
+        if zoom is None:
+            raise InvalidFileException("zoom is required for xyz directory")
+        self.zoom = zoom
+        self._path = os.path.join(path, str(zoom))
+        if not os.path.isdir(self._path):
+            raise InvalidFileException(f"no tiles for zoom {zoom}")
+        self.ext = None
+
+    def close(self):
+        pass
+
+    def tiles_range(self):
+        """Get (x0, y0, x1, y1) range of existing tiles."""
+        xs = [int(name) for name in os.listdir(self._path)
+              if name.isdigit()]
+        ys = []
+        for x in xs:
+            for name in os.listdir(os.path.join(self._path, str(x))):
+                y, ext = os.path.splitext(name)
+                if y.isdigit() and ext[1:].lower() in _EXTS:
+                    ys.append(int(y))
+                    self.ext = self.ext or ext[1:]
+        if not ys:
+            raise InvalidFileException("no tiles found")
+        return min(xs), min(ys), max(xs) + 1, max(ys) + 1
+
+    def get_tile_bytes(self, x, y):
+        """Get tile file content; None when tile not exists."""
+        try:
+            with open(os.path.join(self._path, str(x),
+                                   f"{y}.{self.ext}"), "rb") as tfile:
+                return tfile.read()
+        except FileNotFoundError:
+            return None
+
+
+class _MBTilesSource:
+    """Tiles stored in MBTiles file (tms or xyz scheme)."""
+
+    def __init__(self, path, zoom):
+        try:
+            self._conn = sqlite3.connect(
+                map_loader.sqlite_ro_uri(path), uri=True)
+            meta = dict(self._conn.execute(
+                "SELECT name, value FROM metadata"))
+            if zoom is None:
+                zoom = self._conn.execute(
+                    "SELECT MAX(zoom_level) FROM tiles").fetchone()[0]
+        except sqlite3.Error as err:
+            raise InvalidFileException(f"invalid mbtiles file: {err}")
+        if meta.get('tbviewer_map'):
+            self._conn.close()
+            raise InvalidFileException(
+                "file contains trekbuddy map; can be opened directly")
+        if zoom is None:
+            self._conn.close()
+            raise InvalidFileException("no tiles found")
+        self.zoom = zoom
+        self.ext = _EXTS.get(meta.get('format'), 'png')
+        self._tms = meta.get('scheme', 'tms') != 'xyz'
+
+    def close(self):
+        self._conn.close()
+
+    def _row(self, y):
+        return (1 << self.zoom) - 1 - y if self._tms else y
+
+    def tiles_range(self):
+        x0, x1, row0, row1 = self._conn.execute(
+            "SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), "
+            "MAX(tile_row) FROM tiles WHERE zoom_level=?",
+            (self.zoom, )).fetchone()
+        if x0 is None:
+            raise InvalidFileException("no tiles found")
+        y0, y1 = sorted((self._row(row0), self._row(row1)))
+        return x0, y0, x1 + 1, y1 + 1
+
+    def get_tile_bytes(self, x, y):
+        row = self._conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND "
+            "tile_column=? AND tile_row=?",
+            (self.zoom, x, self._row(y))).fetchone()
+        return row[0] if row else None
+
+
+def open_source(path, zoom=None):
+    """Open tiles source - XYZ directory or .mbtiles file.
+
+    :param zoom: zoom level; for mbtiles default: max zoom in file
+    """
+    if os.path.isdir(path):
+        return _XYZSource(path, zoom)
+    return _MBTilesSource(path, zoom)
+
+
+def _source_tile_size(source, x0, y0, x1, y1):
+    for y in range(y0, y1):
+        for x in range(x0, x1):
+            data = source.get_tile_bytes(x, y)
+            if data:
+                with Image.open(io.BytesIO(data)) as img:
+                    if img.width != img.height:
+                        raise InvalidFileException("tiles are not square")
+                    return img.width
+    raise InvalidFileException("no tiles found")
+
+
+def create_map_content(name, zoom, tile_size, bbox, ext):
+    """Create .map file content for region of Mercator tiles.
+
+    :param bbox: (x0, y0, x1, y1) in pixels of whole world on `zoom`
+    """
+    x0, y0, x1, y1 = bbox
+    width, height = x1 - x0, y1 - y0
+    mfile = mapfile.MapFile()
+    mfile.img_filename = f"{name}.{ext}"
+    mfile.image_width = width
+    mfile.image_height = height
+    points = []
+    for idx, (px, py) in enumerate(((0, 0), (width, 0), (width, height),
+                                    (0, height))):
+        lon, lat = xyz.tile2lonlat((x0 + px) / tile_size,
+                                   (y0 + py) / tile_size, zoom)
+        points.append(mapfile.Point(px, py, lon, lat, idx))
+    mfile.set_points(points)
+    mfile.calibrate()
+    return mfile.to_str()
+
+
+def _copy_tiles(source, writer, bbox, tile_size):
+    """Copy source tiles aligned to map; return number of tiles."""
+    x0, y0, x1, y1 = bbox
+    tiles = 0
+    for ty in range(y0 // tile_size, y1 // tile_size):
+        for tx in range(x0 // tile_size, x1 // tile_size):
+            data = source.get_tile_bytes(tx, ty)
+            if data:
+                writer.add_tile(tx * tile_size - x0, ty * tile_size - y0,
+                                data, source.ext)
+                tiles += 1
+    return tiles
+
+
+def _retile(source, writer, bbox, src_size, tile_width, tile_height):
+    """Compose map tiles row by row; return number of tiles."""
+    x0, y0, x1, y1 = bbox
+    width = x1 - x0
+    # (x, y) -> decoded source tile; only tiles overlapping current row
+    cache = {}
+    tiles = 0
+    for my in range(0, y1 - y0, tile_height):
+        row_y0 = y0 + my
+        row_y1 = min(row_y0 + tile_height, y1)
+        for key in [key for key in cache
+                    if (key[1] + 1) * src_size <= row_y0]:
+            del cache[key]
+
+        row = Image.new('RGB', (width, row_y1 - row_y0))
+        # map tiles (columns) covered by any source tile
+        covered = set()
+        for sy in range(row_y0 // src_size, -(-row_y1 // src_size)):
+            for sx in range(x0 // src_size, -(-x1 // src_size)):
+                tile = cache.get((sx, sy), False)
+                if tile is False:
+                    data = source.get_tile_bytes(sx, sy)
+                    tile = None
+                    if data:
+                        tile = Image.open(io.BytesIO(data))
+                        tile = tile.convert('RGB')
+                    cache[(sx, sy)] = tile
+                if tile is None:
+                    continue
+                px = sx * src_size - x0
+                row.paste(tile, (px, sy * src_size - row_y0))
+                covered.update(range(max(px, 0) // tile_width,
+                                     (px + src_size - 1) // tile_width + 1))
+
+        for col in sorted(covered):
+            mx = col * tile_width
+            if mx >= width:
+                continue
+            writer.add_tile_image(
+                mx, my, row.crop((mx, 0, min(mx + tile_width, width),
+                                  row.height)))
+            tiles += 1
+    return tiles
+
+
+def import_tiles(src, dst_file, zoom=None, geo_bbox=None, options=None):
+    """Create trekbuddy tar map from Mercator tiles.
+
+    :param src: XYZ directory or .mbtiles file
+    :param dst_file: destination .tar file
+    :param zoom: zoom level; required for XYZ directory
+    :param geo_bbox: (lon0, lat0, lon1, lat1) area of map; default: all
+        source tiles
+    :param options: map options (tile_size, format, jpeg_quality...; see
+        `mapmaker`)
+    :return: dict with statistics
+    """
+    tstart = time.time()
+    options = options or {}
+    source = open_source(src, zoom)
+    try:
+        zoom = source.zoom
+        trange = source.tiles_range()
+        src_size = _source_tile_size(source, *trange)
+        if geo_bbox:
+            lon0, lat0, lon1, lat1 = geo_bbox
+            px0, py0 = xyz.lonlat2tile(min(lon0, lon1), max(lat0, lat1),
+                                       zoom)
+            px1, py1 = xyz.lonlat2tile(max(lon0, lon1), min(lat0, lat1),
+                                       zoom)
+            bbox = (int(math.floor(px0 * src_size)),
+                    int(math.floor(py0 * src_size)),
+                    int(math.ceil(px1 * src_size)),
+                    int(math.ceil(py1 * src_size)))
+        else:
+            bbox = tuple(val * src_size for val in trange)
+        if bbox[2] <= bbox[0] or bbox[3] <= bbox[1]:
+            raise ValueError("empty area")
+
+        tile_width, tile_height = options.get('tile_size') or \
+            (src_size, src_size)
+        name = os.path.splitext(os.path.basename(dst_file))[0]
+        map_content = create_map_content(name, zoom, src_size, bbox,
+                                         source.ext)
+        aligned = tile_width == tile_height == src_size and \
+            all(val % src_size == 0 for val in bbox)
+        _LOG.info("importing zoom %d, area %r px to %s; %s", zoom, bbox,
+                  dst_file, "copying tiles" if aligned else "re-tiling")
+        with mapmaker.TarMapWriter(dst_file, map_content,
+                                   options) as writer:
+            if aligned:
+                tiles = _copy_tiles(source, writer, bbox, src_size)
+            else:
+                tiles = _retile(source, writer, bbox, src_size, tile_width,
+                                tile_height)
+    finally:
+        source.close()
+
+    return {
+        'width': bbox[2] - bbox[0],
+        'height': bbox[3] - bbox[1],
+        'tiles': tiles,
+        'bytes_written': writer.bytes_written,
+        'time': time.time() - tstart,
+    }
+
+
+def format_stats(stats):
+    return ("{width}x{height} px; tiles: {tiles}; written {mb_written:0.1f} "
+            "MB; time: {time:0.2f}s".format(
+                mb_written=stats['bytes_written'] / 1048576, **stats))
+
+
+def _parse_bbox(value):
+    vals = [float(val) for val in value.split(',')]
+    if len(vals) != 4:
+        raise ValueError("bbox require 4 values")
+    return vals
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <xyz directory or .mbtiles> <output .tar>")
+    optp.add_option("--zoom", "-z", type="int",
+                    help="zoom level; default for mbtiles: max zoom")
+    optp.add_option("--geo-bbox",
+                    help="area of map in degrees: LON0,LAT0,LON1,LAT1; "
+                    "default: all tiles")
+    optp.add_option("--tile-size", type="int",
+                    help="size of map tiles; default: size of source tiles")
+    optp.add_option("--format", choices=("PNG", "JPEG"), default="JPEG",
+                    help="format of re-tiled map tiles (default: JPEG)")
+    optp.add_option("--jpeg-quality", type="int", default=90)
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run import for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("source and output file required")
+        return 1
+
+    try:
+        geo_bbox = _parse_bbox(options.geo_bbox) if options.geo_bbox \
+            else None
+    except ValueError as err:
+        _LOG.error("invalid bbox: %s", err)
+        return 1
+
+    map_options = {
+        'format': options.format,
+        'jpeg_quality': options.jpeg_quality,
+        'png_compression': 6,
+        'png_palette': 'RGB',
+    }
+    if options.tile_size:
+        map_options['tile_size'] = (options.tile_size, options.tile_size)
+    try:
+        stats = import_tiles(args[0], args[1], options.zoom, geo_bbox,
+                             map_options)
+    except (IOError, ValueError, InvalidFileException) as err:
+        _LOG.error("import error: %s", err)
+        return 1
+
+    _LOG.info("finished; %s", format_stats(stats))
+    return 0
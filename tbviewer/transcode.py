@@ -0,0 +1,414 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Re-encoding tiles of tarred maps and atlases.
+
+Source tar is read by `map_loader` and new tar is written member by member
+in the same order; tiles are re-encoded in process pool (only limited
+number of tiles wait for writing) and other files are copied. Metadata of
+tiles (exif, icc profiles) is not copied. Maps tarred inside atlas tar are
+transcoded in memory.
+"""
+
+import collections
+import io
+import logging
+import optparse
+import os
+import os.path
+import posixpath
+import tarfile
+import time
+from concurrent import futures
+
+from PIL import Image
+
+from . import map_loader
+from . import mapmaker
+from . import version
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# tile file extension -> format extension
+_TILE_EXTS = {'.jpg': 'jpg', '.jpeg': 'jpg', '.png': 'png'}
+
+# tiles encoder in worker process: (save function, extension)
+_ENCODER = None
+
+
+def _init_worker(options):
+    global _ENCODER  # pylint: disable=global-statement
+    # pylint: disable=protected-access
+    _ENCODER = mapmaker._create_img_saver(options)
+
+
+def _encode_tile(data, keep_smaller):
+    """Re-encode tile; run in worker.
+
+    :param keep_smaller: return original data when result is not smaller
+    """
+    imgsavef, ext = _ENCODER
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+        if ext == 'jpg' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        with io.BytesIO() as bfile:
+            imgsavef(img, bfile)
+            result = bfile.getvalue()
+    if keep_smaller and len(result) >= len(data):
+        return data
+    return result
+
+
+class _SyncExecutor:
+    """Executor running tasks in current process."""
+
+    def __init__(self, initializer, initargs):
+        initializer(*initargs)
+
+    def submit(self, func, *args):
+        fut = futures.Future()
+        try:
+            fut.set_result(func(*args))
+        except Exception as err:  # pylint: disable=broad-except
+            fut.set_exception(err)
+        return fut
+
+    def shutdown(self):
+        pass
+
+
+class LayerStats:
+    """Statistics of transcoding one layer."""
+
+    __slots__ = ('tiles', 'errors', 'bytes_in', 'bytes_out', 'time')
+
+    def __init__(self):
+        self.tiles = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.time = 0.0
+
+    def __str__(self):
+        ratio = self.bytes_out / self.bytes_in * 100 if self.bytes_in \
+            else 100
+        return (f"tiles: {self.tiles} (errors: {self.errors}); "
+                f"{self.bytes_in / 1048576:0.1f} MB -> "
+                f"{self.bytes_out / 1048576:0.1f} MB ({ratio:0.0f}%); "
+                f"time: {self.time:0.2f}s")
+
+
+class _OrderedWriter:
+    """Add members to tar in order of `add` calls; tiles data may be not
+    ready yet (future)."""
+
+    def __init__(self, tar, stats, window):
+        self._tar = tar
+        self._stats = stats
+        self._window = window
+        self._queue = collections.deque()
+        self._last_time = time.time()
+        # names of tiles written with original data (encoding failed)
+        self.failed = set()
+
+    def add(self, info, data, layer, future=None, orig_name=None):
+        """Add member; when `future` is given its result is written and
+        `data` is used on error (under `orig_name` if given)."""
+        self._queue.append((info, data, layer, future, orig_name, True))
+        self._write_ready()
+
+    def add_nested(self, info, data):
+        """Add transcoded tar; its content is already counted in stats."""
+        self._queue.append((info, data, None, None, None, False))
+        self._write_ready()
+
+    def _write_ready(self):
+        queue = self._queue
+        while queue and (len(queue) > self._window or
+                         queue[0][3] is None or queue[0][3].done()):
+            self._write_first()
+
+    def flush(self):
+        while self._queue:
+            self._write_first()
+
+    def _write_first(self):
+        info, data, layer, future, orig_name, count = self._queue.popleft()
+        if not count:
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+            self._last_time = time.time()
+            return
+
+        stats = self._stats.get(layer)
+        if stats is None:
+            stats = self._stats[layer] = LayerStats()
+        if data is not None:
+            stats.bytes_in += len(data)
+        if future is not None:
+            stats.tiles += 1
+            try:
+                data = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                # original data must be kept with original extension
+                info.name = orig_name or info.name
+                _LOG.warning("encoding %s error: %s; original copied",
+                             info.name, err)
+                stats.errors += 1
+                self.failed.add(info.name)
+        if data is None:
+            self._tar.addfile(info)
+        else:
+            stats.bytes_out += len(data)
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+        now = time.time()
+        stats.time += now - self._last_time
+        self._last_time = now
+
+
+def _is_tile(name):
+    dirname, fname = os.path.split(name)
+    return os.path.basename(dirname) == 'set' and \
+        os.path.splitext(fname)[1].lower() in _TILE_EXTS
+
+
+def _member_layer(name, layer):
+    if layer is not None:
+        return layer
+    parts = name.strip('/').split('/')
+    # top-level files and map files in map tar
+    if len(parts) == 1 or parts[0] == 'set':
+        return ''
+    return parts[0]
+
+
+class _Transcoder:
+    def __init__(self, executor, ext, keep_smaller, window):
+        self._executor = executor
+        self._ext = ext
+        self._keep_smaller = keep_smaller
+        self._window = window
+        self.stats = collections.OrderedDict()
+
+    def _rename(self, name):
+        """Change extension of tile file when format is changed."""
+        base, ext = os.path.splitext(name)
+        if _TILE_EXTS.get(ext.lower(), self._ext) != self._ext:
+            return f"{base}.{self._ext}"
+        return name
+
+    def _rename_set(self, name, data, failed):
+        """Rename tiles listed in .set file; not transcoded tiles keep
+        original names."""
+        set_dir = posixpath.join(posixpath.dirname(name), 'set')
+        return "\n".join(
+            line if posixpath.join(set_dir, line) in failed
+            else self._rename(line)
+            for line in data.decode('cp1250').split('\n')).encode('cp1250')
+
+    def transcode(self, fs, dst_tar, layer=None):
+        """Transcode all members of `fs` (_TarredFS) to `dst_tar`.
+
+        .set files are written after all tiles, when names of tiles that
+        can't be transcoded are known.
+        """
+        writer = _OrderedWriter(dst_tar, self.stats, self._window)
+        set_files = []
+        for member in fs.members():
+            info = tarfile.TarInfo(member.name)
+            info.mode, info.mtime = member.mode, member.mtime
+            info.type = member.type
+            info.linkname = member.linkname
+            mlayer = _member_layer(member.name, layer)
+            if not member.isfile():
+                writer.add(info, None, mlayer)
+                continue
+
+            data = fs.get_file_binary(member.name)
+            if _is_tile(member.name):
+                info.name = self._rename(member.name)
+                # original data can be kept only in the same format
+                keep_smaller = self._keep_smaller and \
+                    info.name == member.name
+                future = self._executor.submit(_encode_tile, data,
+                                               keep_smaller)
+                writer.add(info, data, mlayer, future, member.name)
+            elif member.name.endswith('.set'):
+                # names of tiles may be changed
+                set_files.append((info, data, mlayer))
+            elif member.name.endswith('.tar'):
+                # map tarred in atlas tar; write waiting members before
+                writer.flush()
+                writer.add_nested(info,
+                                  self._transcode_nested(data, mlayer))
+            else:
+                writer.add(info, data, mlayer)
+        writer.flush()
+        for info, data, mlayer in set_files:
+            writer.add(info, self._rename_set(info.name, data,
+                                              writer.failed), mlayer)
+        writer.flush()
+
+    def _transcode_nested(self, data, layer):
+        # pylint: disable=protected-access
+        src_fs = map_loader._TarredFS(
+            "", tarfile.open(fileobj=io.BytesIO(data)))
+        with io.BytesIO() as dst:
+            with tarfile.open(fileobj=dst, mode="w") as dst_tar:
+                self.transcode(src_fs, dst_tar, layer)
+            src_fs.close()
+            return dst.getvalue()
+
+
+def _transcode_tar(transcoder, src, dst, layer=None):
+    tmp_file = dst + ".tmp"
+    # pylint: disable=protected-access
+    src_fs = map_loader._TarredFS(src)
+    try:
+        with tarfile.open(tmp_file, "w") as dst_tar:
+            transcoder.transcode(src_fs, dst_tar, layer)
+    except BaseException:
+        # tmp file not exists when it can't be created
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        raise
+    finally:
+        src_fs.close()
+    os.replace(tmp_file, dst)
+
+
+def _transcode_atlas_dir(transcoder, tba_file, dst):
+    """Transcode tarred maps of .tba atlas to `dst` directory."""
+    os.makedirs(dst, exist_ok=True)
+    with open(tba_file, "rb") as src, \
+            open(os.path.join(dst, os.path.basename(tba_file)),
+                 "wb") as tba:
+        tba.write(src.read())
+    with map_loader.Atlas(tba_file) as atlas:
+        for layer, maps in atlas.layers:
+            for name, path in maps:
+                # pylint: disable=protected-access
+                tar_file = map_loader._find_file_in_dir(path, ".tar")
+                if not tar_file:
+                    _LOG.warning("%s/%s is not tarred; skipped", layer,
+                                 name)
+                    continue
+                map_dir = os.path.join(dst, layer, name)
+                os.makedirs(map_dir, exist_ok=True)
+                _transcode_tar(transcoder, tar_file,
+                               os.path.join(map_dir,
+                                            os.path.basename(tar_file)),
+                               layer)
+
+
+def transcode(src, dst, options=None, workers=None, keep_smaller=True):
+    """Re-encode tiles of tar map/atlas or .tba atlas with tarred maps.
+
+    :param src: source .tar or .tba file
+    :param dst: destination tar file (for .tba atlas - directory)
+    :param options: tiles encoding options (format, jpeg_quality,
+        png_compression, png_palette; see `mapmaker`)
+    :param workers: number of worker processes
+    :param keep_smaller: keep original tile when re-encoded one is not
+        smaller; only when format is not changed
+    :return: dict layer -> LayerStats
+    """
+    opt = {'format': 'JPEG', 'jpeg_quality': 75, 'png_compression': '6',
+           'png_palette': 'RGB'}
+    opt.update(options or {})
+    file_type = map_loader.check_file_type(src)
+    if file_type not in ('tar-map', 'tar-atlas', 'atlas'):
+        raise InvalidFileException("Invalid file - should be .tar or .tba")
+
+    # pylint: disable=protected-access
+    _imgsavef, ext = mapmaker._create_img_saver(opt)
+    if workers == 1:
+        executor = _SyncExecutor(_init_worker, (opt, ))
+    else:
+        executor = futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(opt, ))
+    # tiles submitted to workers and waiting for writing
+    window = (workers or os.cpu_count() or 1) * 8
+    transcoder = _Transcoder(executor, ext, keep_smaller, window)
+    try:
+        if file_type == 'atlas':
+            _transcode_atlas_dir(transcoder, src, dst)
+        else:
+            _transcode_tar(transcoder, src, dst)
+    finally:
+        executor.shutdown()
+    return transcoder.stats
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <map/atlas .tar or .tba> <output>\n\n"
+        "Tar file is transcoded to <output> tar file; tarred maps of .tba "
+        "atlas are written to <output> directory.")
+    optp.add_option("--workers", "-w", type="int",
+                    help="number of worker processes")
+    optp.add_option("--keep-larger", action="store_true", default=False,
+                    help="write re-encoded tile even if it is larger than "
+                    "original")
+
+    group = optparse.OptionGroup(optp, "Tiles options")
+    group.add_option("--format", choices=("JPEG", "PNG"), default="JPEG",
+                     help="tiles format (JPEG, PNG)")
+    group.add_option("--jpeg-quality", type="int", default=75)
+    group.add_option("--png-compression", default="optimized",
+                     help="0-9 or optimized")
+    group.add_option("--png-palette", default="256c adaptive",
+                     choices=("RGB", "256c", "256c adaptive"),
+                     help="RGB, 256c (web palette) or 256c adaptive "
+                     "(palette for each tile; default)")
+    optp.add_option_group(group)
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run transcoding for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("source and output file required")
+        return 1
+
+    tile_options = {
+        'format': options.format,
+        'jpeg_quality': options.jpeg_quality,
+        'png_compression': options.png_compression,
+        'png_palette': options.png_palette,
+    }
+    tstart = time.time()
+    try:
+        stats = transcode(args[0], args[1], tile_options, options.workers,
+                          not options.keep_larger)
+    except (IOError, InvalidFileException) as err:
+        _LOG.error("transcode error: %s", err)
+        return 1
+
+    total = LayerStats()
+    for layer, lstats in stats.items():
+        if lstats.tiles:
+            _LOG.info("%s: %s", layer or "(map)", lstats)
+        for key in LayerStats.__slots__:
+            setattr(total, key, getattr(total, key) + getattr(lstats, key))
+    total.time = time.time() - tstart
+    _LOG.info("finished; %s", total)
+    return 0
@@ -0,0 +1,345 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Verification of atlases and maps integrity.
+
+For each map checked are: .map file (parsing and calibration), .set file
+against files in set/ directory, completeness of tiles grid and every tile
+is fully decoded. Decoding is done in process pool; each worker open map
+once for many tiles. Result is dict that can be saved as JSON.
+"""
+
+import io
+import json
+import logging
+import optparse
+import os.path
+import sys
+import tarfile
+import time
+from concurrent import futures
+
+from PIL import Image
+
+from . import map_loader
+from . import mapfile
+from . import version
+from .errors import InvalidFileException
+
+_LOG = logging.getLogger(__name__)
+
+# tiles decoded by one task in worker
+_CHUNK_SIZE = 64
+# decode in process pool only when there are more tiles
+_MIN_TILES_FOR_POOL = 256
+# max number of reported missing tiles for one map
+_MAX_REPORTED = 1000
+
+# opened maps fs in worker process: path -> fs
+_WORKER_FS = {}
+# errors of reading corrupted maps
+_MAP_ERRORS = (tarfile.TarError, KeyError, OSError, ValueError,
+               InvalidFileException)
+
+
+def _open_fs(path):
+    fs = _WORKER_FS.get(path)
+    if fs is None:
+        # tiles are verified map by map; keep only last opened map
+        for old_fs in _WORKER_FS.values():
+            old_fs.close()
+        _WORKER_FS.clear()
+        # pylint: disable=protected-access
+        fs = _WORKER_FS[path] = map_loader._open_map_fs(path)
+    return fs
+
+
+def _close_worker_fs():
+    for fs in _WORKER_FS.values():
+        fs.close()
+    _WORKER_FS.clear()
+
+
+def decode_tiles(path, tiles):
+    """Read and decode tiles; run in worker.
+
+    :param path: map path
+    :param tiles: list of (file name, expected size or None)
+    :return: (number of bytes read, list of (file name, error message))
+    """
+    try:
+        fs = _open_fs(path)
+    except _MAP_ERRORS as err:
+        error = f"can't open map: {err}"
+        return 0, [(name, error) for name, _ in tiles]
+    nbytes = 0
+    errors = []
+    for name, size in tiles:
+        try:
+            data = fs.get_file_binary(name)
+            nbytes += len(data)
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+                if size and img.size != size:
+                    errors.append((name, f"invalid size {img.size}; "
+                                   f"expected {size}"))
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append((name, f"{type(err).__name__}: {err}"))
+    return nbytes, errors
+
+
+def _check_map_file(fs, report):
+    """Check .map file; return MapFile or None."""
+    # pylint: disable=protected-access
+    map_filename = map_loader._find_map_file(fs)
+    if not map_filename:
+        report['errors'].append("missing .map file")
+        return None
+    map_file = mapfile.MapFile()
+    try:
+        map_file.parse_map(fs.get_file_content(map_filename))
+    except (InvalidFileException, ValueError, IndexError) as err:
+        report['errors'].append(f"invalid .map file: {err}")
+        return None
+    if not map_file.image_width or not map_file.image_height:
+        report['errors'].append(".map file: missing image size")
+        return None
+    report['image_size'] = [map_file.image_width, map_file.image_height]
+    if not map_file.validate():
+        report['warnings'].append(".map file: map is not calibrated")
+    return map_file
+
+
+def _check_set_file(fs, files, report):
+    # pylint: disable=protected-access
+    set_files = [name for name in fs.list_files("") if name.endswith(".set")]
+    if not set_files:
+        # maps in MBTiles files don't have .set file
+        if not isinstance(fs, map_loader._MBTilesFS):
+            report['warnings'].append("missing .set file")
+        return
+    listed = set(filter(None, (
+        line.strip()
+        for line in fs.get_file_content(set_files[0]).splitlines())))
+    report['set_missing'] = sorted(listed - files)[:_MAX_REPORTED]
+    report['set_unlisted'] = sorted(files - listed)[:_MAX_REPORTED]
+    if report['set_missing']:
+        report['errors'].append(".set lists not existing tiles")
+    if report['set_unlisted']:
+        report['warnings'].append("tiles not listed in .set")
+
+
+def check_map(path):
+    """Check structure of map (without decoding tiles).
+
+    :return: (report dict, list of (tile file name, expected size))
+    """
+    report = {
+        'path': path, 'errors': [], 'warnings': [], 'tiles': 0,
+        'image_size': None, 'tile_size': None, 'missing_tiles': [],
+        'unexpected_tiles': [], 'set_missing': [], 'set_unlisted': [],
+        'bad_tiles': [],
+    }
+    # pylint: disable=protected-access
+    try:
+        fs = map_loader._open_map_fs(path)
+    except _MAP_ERRORS as err:
+        report['errors'].append(f"can't open map: {err}")
+        return report, []
+    if fs is None:
+        report['errors'].append("map not found")
+        return report, []
+
+    try:
+        map_file = _check_map_file(fs, report)
+        files = set(fs.list_files("set/"))
+        positions = dict(map_loader._load_set(fs))
+        report['tiles'] = len(positions)
+        # files skipped by loader (wrong names)
+        report['unexpected_tiles'] = sorted(
+            files - {os.path.basename(name) for name in positions.values()})
+        _check_set_file(fs, files, report)
+        try:
+            tile_width, tile_height = map_loader._find_tile_size(positions)
+        except InvalidFileException as err:
+            report['errors'].append(str(err))
+            return report, [(name, None) for name in positions.values()]
+    except _MAP_ERRORS as err:
+        # i.e. truncated tar
+        report['errors'].append(f"invalid map: {err}")
+        return report, []
+    finally:
+        fs.close()
+
+    report['tile_size'] = [tile_width, tile_height]
+    if map_file is None:
+        return report, [(name, None) for name in positions.values()]
+
+    width, height = map_file.image_width, map_file.image_height
+    expected = {(x, y) for x in range(0, width, tile_width)
+                for y in range(0, height, tile_height)}
+    report['missing_tiles'] = sorted(
+        expected - positions.keys())[:_MAX_REPORTED]
+    report['unexpected_tiles'].extend(sorted(
+        os.path.basename(positions[pos])
+        for pos in positions.keys() - expected))
+    if report['missing_tiles']:
+        report['errors'].append("missing tiles")
+    if report['unexpected_tiles']:
+        report['warnings'].append("unexpected files in set/")
+    tiles = [(name, (min(tile_width, width - x),
+                     min(tile_height, height - y))
+              if (x, y) in expected else None)
+             for (x, y), name in positions.items()]
+    return report, tiles
+
+
+def verify(path, workers=None, progress=None):
+    """Verify all maps in atlas (or single map).
+
+    :param path: atlas or map file (as accepted by viewer)
+    :param workers: number of worker processes
+    :param progress: function(done tiles, all tiles)
+    :return: report dict
+    """
+    tstart = time.time()
+    # atlas build paths of maps from directory of path
+    path = os.path.abspath(path)
+    file_type, fs = map_loader.sniff_file_type(path)
+    if file_type in ('atlas', 'tar-atlas'):
+        atlas = map_loader.Atlas(path, fs)
+    elif file_type in ('map', 'tar-map', 'mbtiles-map'):
+        atlas = map_loader.FakeAlbum(path, fs)
+    else:
+        raise InvalidFileException("Invalid file - should be .map or .tar "
+                                   "or .tba")
+    with atlas:
+        layers = atlas.layers
+
+    reports = []
+    tasks = []
+    for layer, maps in layers:
+        for name, mpath in maps:
+            report, tiles = check_map(mpath)
+            report['layer'] = layer
+            report['name'] = name
+            reports.append(report)
+            tasks.extend((report, mpath, tiles[idx:idx + _CHUNK_SIZE])
+                         for idx in range(0, len(tiles), _CHUNK_SIZE))
+
+    total = sum(len(chunk) for _, _, chunk in tasks)
+    _LOG.info("verifying %d maps, %d tiles", len(reports), total)
+    args = ([mpath for _, mpath, _ in tasks],
+            [chunk for _, _, chunk in tasks])
+    if total < _MIN_TILES_FOR_POOL or workers == 1:
+        results = map(decode_tiles, *args)
+        executor = None
+    else:
+        executor = futures.ProcessPoolExecutor(workers)
+        results = executor.map(decode_tiles, *args)
+
+    nbytes = done = 0
+    try:
+        for (report, _, chunk), (cbytes, errors) in zip(tasks, results):
+            nbytes += cbytes
+            report['bad_tiles'].extend({'name': name, 'error': error}
+                                       for name, error in errors)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+    finally:
+        if executor:
+            executor.shutdown()
+        else:
+            _close_worker_fs()
+
+    for report in reports:
+        if report['bad_tiles']:
+            report['errors'].append("invalid tiles")
+        report['ok'] = not report['errors']
+
+    elapsed = time.time() - tstart
+    return {
+        'path': path,
+        'ok': all(report['ok'] for report in reports),
+        'maps': reports,
+        'summary': {
+            'maps': len(reports),
+            'maps_ok': sum(1 for report in reports if report['ok']),
+            'tiles': total,
+            'bad_tiles': sum(len(report['bad_tiles'])
+                             for report in reports),
+            'missing_tiles': sum(len(report['missing_tiles'])
+                                 for report in reports),
+            'bytes_read': nbytes,
+            'time': elapsed,
+            'tiles_per_s': total / elapsed if elapsed else 0,
+        },
+    }
+
+
+def format_summary(summary):
+    return ("maps: {maps} (ok: {maps_ok}); tiles: {tiles} (invalid: "
+            "{bad_tiles}, missing: {missing_tiles}); read {mb:0.1f} MB; "
+            "time: {time:0.2f}s; {tiles_per_s:0.1f} tiles/s".format(
+                mb=summary['bytes_read'] / 1048576, **summary))
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <atlas or map file>")
+    optp.add_option("--output", "-o",
+                    help="write JSON report to file ('-' - stdout)")
+    optp.add_option("--workers", "-w", type="int",
+                    help="number of worker processes")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run verification for parsed cli options.
+
+    :return: 0 when atlas is valid, 1 - on errors, 2 - when atlas is
+        invalid
+    """
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 1:
+        _LOG.error("atlas or map file required")
+        return 1
+
+    try:
+        result = verify(args[0], options.workers)
+    except (IOError, tarfile.TarError, InvalidFileException) as err:
+        _LOG.error("verify error: %s", err)
+        return 1
+
+    for report in result['maps']:
+        if not report['ok']:
+            _LOG.warning("%s/%s: %s", report['layer'], report['name'],
+                         "; ".join(report['errors']))
+        elif report['warnings']:
+            _LOG.info("%s/%s: %s", report['layer'], report['name'],
+                      "; ".join(report['warnings']))
+
+    if options.output == '-':
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif options.output:
+        with open(options.output, "w") as ofile:
+            json.dump(result, ofile, indent=2)
+
+    _LOG.info("finished; %s", format_summary(result['summary']))
+    return 0 if result['ok'] else 2
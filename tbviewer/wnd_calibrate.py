@@ -19,11 +19,13 @@ from tkinter import messagebox
 from tkinter import ttk
 from tkinter import tix
 
-from PIL import ImageTk, Image
+from PIL import ImageTk
 
 from . import mapfile
 from . import formatting
 from . import dialogs
+from . import imgpyramid
+from . import layout
 from . import tkutils
 from . import mapmaker
 from . import wnd_mapoptions
@@ -31,6 +33,13 @@ from .errors import InvalidFileException
 
 _LOG = logging.getLogger(__name__)
 
+# margin around image on canvas
+_MARGIN = 20
+# magnifier size in pixels
+_LOUPE_SIZE = 200
+# min interval between magnifier refresh in ms
+_LOUPE_INTERVAL = 40
+
 
 def _check_variable_val(variable, min_value, max_value):
     try:
@@ -135,10 +144,23 @@ class WndCalibrate(tk.Tk):
         self._sel_point.set(0)
         self._positions_data = [FormPosition(self) for _ in range(4)]
         self._click_pos = None
+        # source image (imgpyramid.ImagePyramid)
         self._img = None
         self._img_filename = None
         self._map_file = mapfile.MapFile()
         self._scale = 0
+        # layout of visible image tiles for current scale
+        self._layout = None
+        # displayed tiles: position -> (canvas item id, photo image)
+        self._tiles = {}
+        self._var_loupe_zoom = tk.IntVar(self, 8)
+        # magnifier state: position in image, pending refresh job, time of
+        # last refresh, (x0, y0, zoom) of displayed fragment, photo image
+        self._loupe_pos = None
+        self._loupe_job = None
+        self._loupe_time = 0
+        self._loupe_view = None
+        self._loupe_photo = None
 
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -232,8 +254,26 @@ class WndCalibrate(tk.Tk):
                   command=self._save_cut_map)\
             .grid(column=1, row=1)
 
+        self._create_loupe_frame(forms_frame).grid(pady=5)
         return forms_frame
 
+    def _create_loupe_frame(self, master):
+        loupe_frame = tk.Frame(master)
+        tk.Label(loupe_frame, text="Zoom").grid(column=0, row=0, sticky=tk.E)
+        tk.OptionMenu(loupe_frame, self._var_loupe_zoom, 4, 8, 16,
+                      command=lambda _: self._update_loupe())\
+            .grid(column=1, row=0, sticky=tk.W)
+        self._loupe = tk.Canvas(loupe_frame, width=_LOUPE_SIZE,
+                                height=_LOUPE_SIZE, background="gray",
+                                borderwidth=1, relief=tk.SUNKEN)
+        self._loupe.grid(column=0, row=1, columnspan=2)
+        center = _LOUPE_SIZE // 2
+        self._loupe_img = self._loupe.create_image(center, center)
+        self._loupe.create_line(center, 0, center, _LOUPE_SIZE, fill="red")
+        self._loupe.create_line(0, center, _LOUPE_SIZE, center, fill="red")
+        self._loupe.bind("<Double-Button-1>", self._loupe_dclick)
+        return loupe_frame
+
     def _create_latlon_form(self, idx, forms_frame):
         pos = self._positions_data[idx]
         form_frame = tk.Frame(forms_frame, borderwidth=5)
@@ -298,39 +338,24 @@ class WndCalibrate(tk.Tk):
             self._load(fname)
             self._last_dir = os.path.dirname(fname)
 
-    def _load_img(self, fname):
-        if self._scale == 0:
-            return ImageTk.PhotoImage(file=fname)
-
-        img = Image.open(fname)
-        scale = 2 ** self._scale
-        img = img.resize((int(img.width * scale), int(img.height * scale)),
-                         Image.ANTIALIAS)
-        img = ImageTk.PhotoImage(img)
-        return img
-
     def _load(self, fname):
         if not fname:
             return
         self._busy_manager.busy()
         self.update()
-        self._canvas.delete('img')
+        self._clear_tiles()
         self._img = None
         try:
-            self._img = img = self._load_img(fname)
+            self._img = img = imgpyramid.ImagePyramid.open(fname)
         except IOError as err:
             messagebox.showerror(
                 "Error loading file", f"Invalid file: {err}")
         else:
-            self._canvas.create_image(20, 20, image=img, anchor=tk.NW)
-            self._canvas.config(
-                width=img.width() + 40,
-                height=img.height() + 40,
-                scrollregion=(0, 0, img.width() + 40, img.height() + 40))
-            self.update_idletasks()
             self._img_filename = fname
-            if self._map_file.image_width != img.width() or \
-                    self._map_file.image_height != img.height():
+            self._scale = 0
+            self._update_scale()
+            if self._map_file.image_width != img.width or \
+                    self._map_file.image_height != img.height:
                 self._map_file.clear()
                 for p in self._positions_data:
                     p.reset()
@@ -338,6 +363,47 @@ class WndCalibrate(tk.Tk):
 
         self._busy_manager.notbusy()
 
+    def _update_scale(self):
+        """Prepare canvas & tiles layout for current scale."""
+        self._clear_tiles()
+        width, height = self._img.size(self._scale)
+        self._layout = layout.TileLayout(
+            width, height, self._img.tile_size, self._img.tile_size)
+        self._canvas.config(
+            scrollregion=(0, 0, width + 2 * _MARGIN, height + 2 * _MARGIN))
+        self.update_idletasks()
+
+    def _clear_tiles(self):
+        for iid, _ in self._tiles.values():
+            self._canvas.delete(iid)
+        self._tiles.clear()
+        if self._layout:
+            self._layout.clear()
+
+    def _draw_image(self):
+        """Draw visible tiles of image; only changed tiles are created."""
+        if not self._img:
+            return
+        canvas = self._canvas
+        tiles = self._tiles
+        add, _keep, drop = self._layout.update(
+            1, max(canvas.canvasx(0) - _MARGIN, 0),
+            max(canvas.canvasy(0) - _MARGIN, 0),
+            canvas.winfo_width(), canvas.winfo_height())
+        for pos in drop:
+            iid, _ = tiles.pop(pos)
+            canvas.delete(iid)
+
+        get_tile = self._img.get_tile
+        for pos in add:
+            x, y = pos
+            photo = ImageTk.PhotoImage(get_tile(self._scale, x, y))
+            iid = canvas.create_image(x + _MARGIN, y + _MARGIN, image=photo,
+                                      anchor=tk.NW, tag='img')
+            tiles[pos] = iid, photo
+        # markers must be over image
+        canvas.tag_raise('marker')
+
     def _open_map_file(self):
         if not self._img:
             messagebox.showerror(
@@ -440,29 +506,71 @@ class WndCalibrate(tk.Tk):
         y = self._canvas.canvasy(event.y)
         selected = self._sel_point.get()
         scale = 2 ** self._scale
-        self._positions_data[selected].x = (x - 20) / scale
-        self._positions_data[selected].y = (y - 20) / scale
+        self._positions_data[selected].x = (x - _MARGIN) / scale
+        self._positions_data[selected].y = (y - _MARGIN) / scale
         self._draw()
 
     def _canvas_mouse_motion(self, event):
         if not self._img:
             return
 
-        x = self._canvas.canvasx(event.x) - 20
-        y = self._canvas.canvasy(event.y) - 20
+        x = self._canvas.canvasx(event.x) - _MARGIN
+        y = self._canvas.canvasy(event.y) - _MARGIN
         scale = 2 ** self._scale
         x //= scale
         y //= scale
-        pos = self._map_file.xy2latlon(x, y)
+        pos = self._map_file.xy2lonlat(x, y)
         self._status_x.config(text=f"x: {x}")
         self._status_y.config(text=f"y: {y}")
-        lat = formatting.format_pos_lat(pos[0]) if pos else ""
-        lon = formatting.format_pos_lon(pos[1]) if pos else ""
+        lat = formatting.format_pos_lat(pos[1]) if pos else ""
+        lon = formatting.format_pos_lon(pos[0]) if pos else ""
         self._status_lat.config(text=lat)
         self._status_lon.config(text=lon)
         self._status_zoom.config(text=f"{scale:0.2f}x")
 
+        self._loupe_pos = ((self._canvas.canvasx(event.x) - _MARGIN) / scale,
+                           (self._canvas.canvasy(event.y) - _MARGIN) / scale)
+        self._schedule_loupe()
+
+    def _schedule_loupe(self):
+        """Refresh magnifier; no more often than _LOUPE_INTERVAL."""
+        if self._loupe_job:
+            return
+        wait = _LOUPE_INTERVAL - int((time.time() - self._loupe_time) * 1000)
+        if wait <= 0:
+            self._update_loupe()
+        else:
+            self._loupe_job = self.after(wait, self._update_loupe)
+
+    def _update_loupe(self):
+        self._loupe_job = None
+        if not self._img or not self._loupe_pos:
+            return
+        self._loupe_time = time.time()
+        x, y = self._loupe_pos
+        zoom = self._var_loupe_zoom.get()
+        img, (x0, y0) = self._img.magnify(x, y, zoom, _LOUPE_SIZE)
+        self._loupe_photo = ImageTk.PhotoImage(img)
+        self._loupe.itemconfigure(self._loupe_img, image=self._loupe_photo)
+        self._loupe_view = (x0, y0, zoom, (_LOUPE_SIZE - img.width) // 2)
+
+    def _loupe_dclick(self, event):
+        """Set selected point on clicked pixel of magnified image."""
+        if not self._loupe_view:
+            return
+        x0, y0, zoom, offset = self._loupe_view
+        x = x0 + (self._loupe.canvasx(event.x) - offset) // zoom
+        y = y0 + (self._loupe.canvasy(event.y) - offset) // zoom
+        if not (0 <= x < self._img.width and 0 <= y < self._img.height):
+            return
+        selected = self._sel_point.get()
+        self._positions_data[selected].x = int(x)
+        self._positions_data[selected].y = int(y)
+        self._draw()
+
     def _canvas_mouse_wheel(self, event):
+        if not self._img:
+            return
         if (event.num == 5 or event.delta == -120) and self._scale > -5:
             self._scale -= 1
         elif (event.num == 4 or event.delta == 120) and self._scale < 1:
@@ -470,7 +578,7 @@ class WndCalibrate(tk.Tk):
         else:
             return
 
-        self._load(self._img_filename)
+        self._update_scale()
         self._draw(True)
         self._canvas_mouse_motion(event)
 
@@ -479,11 +587,11 @@ class WndCalibrate(tk.Tk):
         x = self._positions_data[selected].x
         y = self._positions_data[selected].y
         if x is not None and y is not None:
-            dx = float(x) / self._img.width()
-            dy = float(y) / self._img.height()
+            dx = float(x) / self._img.width
+            dy = float(y) / self._img.height
             # center point on screen
-            ddx = self._canvas.winfo_width() / 2.0 / self._img.width()
-            ddy = self._canvas.winfo_height() / 2.0 / self._img.height()
+            ddx = self._canvas.winfo_width() / 2.0 / self._img.width
+            ddy = self._canvas.winfo_height() / 2.0 / self._img.height
             dx += -ddx if dx < 0.5 else ddx
             dy += -ddy if dy < 0.5 else ddy
             self._canvas.xview_moveto(max(min(dx, 1.0), 0.0))
@@ -497,10 +605,12 @@ class WndCalibrate(tk.Tk):
         if clear:
             canvas.delete("marker")
 
+        self._draw_image()
         scale = 2 ** self._scale
         for idx, point in enumerate(self._positions_data):
             if point.x is not None and point.y is not None:
-                x, y = point.x * scale + 20, point.y * scale + 20
+                x = point.x * scale + _MARGIN
+                y = point.y * scale + _MARGIN
 
                 p = self._positions_data[idx].marker
                 if p and not clear:
@@ -524,7 +634,7 @@ class WndCalibrate(tk.Tk):
                                             outline="red",
                                             tag="marker")
                     tb = canvas.create_oval(x + 3, y + 3, x + 20, y + 20,
-                                            fill="white")
+                                            fill="white", tag="marker")
                     t = canvas.create_text(x + 12, y + 12, fill="red",
                                            text=str(idx + 1),
                                            tag="marker")
@@ -546,8 +656,8 @@ class WndCalibrate(tk.Tk):
                                  "Please load image and calibrate map")
             return
 
-        self._map_file.image_width = self._img.width()
-        self._map_file.image_height = self._img.height()
+        self._map_file.image_width = self._img.width
+        self._map_file.image_height = self._img.height
         self._map_file.img_filename = self._img_filename
         self._map_file.img_filepath = os.path.dirname(self._img_filename)
         points = [mapfile.Point(x=p.x, y=p.y, lon=p.lon, lat=p.lat, idx=idx)
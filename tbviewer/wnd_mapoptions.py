@@ -84,7 +84,8 @@ class MapOptionsDialog(tk.Toplevel):
                                                 sticky=tk.W)
         self._var_png_palette = tk.StringVar()
         self._var_png_palette.set(self.options['png_palette'])
-        tk.OptionMenu(self, self._var_png_palette, 'RGB', '256c')\
+        tk.OptionMenu(self, self._var_png_palette, 'RGB', '256c',
+                      '256c global')\
             .grid(row=5, column=1, sticky=tk.W)
 
         self._var_tar = tk.BooleanVar()
@@ -16,12 +16,16 @@ import math
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
+from tkinter import simpledialog
 from tkinter import ttk
 from tkinter import tix
 
 from . import map_loader
 from . import formatting
+from . import gpx
+from . import layout
 from . import tkutils
+from . import profiling
 from .errors import InvalidFileException
 
 
@@ -31,12 +35,18 @@ _LOG = logging.getLogger(__name__)
 class WndViewer(tk.Tk):
     """Main viewer window."""
 
+    # refresh interval of performance panel in ms
+    _PERF_PANEL_INTERVAL = 1000
+
     def __init__(self, fname):
         tk.Tk.__init__(self)
 
         style = ttk.Style()
         style.theme_use("clam")
 
+        self._var_perf_panel = tk.BooleanVar()
+        self._perf_panel_job = None
+        self._var_auto_switch = tk.BooleanVar()
         self._build_menu()
         self.title("TBViewer")
 
@@ -44,10 +54,24 @@ class WndViewer(tk.Tk):
         self._tb_atlas = None
         # current map image
         self._map_image = None
+        self._map_path = None
         self._tiles = {}
+        # visible tiles layout for current map
+        self._layout = None
+        # loaded gpx track (lon, lat) and overlay for current map
+        self._track_segments = None
+        self._track = None
+        # track chunk id -> canvas item id
+        self._track_items = {}
         self._last_dir = "."
         # map zoom; scale = 2^zoom
         self._zoom = 0
+        # performance stats for perf panel
+        self._perf = {
+            'frame_time': 0.0, 'frame_tiles': 0, 'frame_loaded': 0,
+            'hits': 0, 'requests': 0, 'bytes_read': 0,
+            'time': time.time(),
+        }
 
         self.grid_columnconfigure(2, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -102,6 +126,10 @@ class WndViewer(tk.Tk):
         self._status_scale.grid(column=2, row=0, ipadx=3)
         self._status_text = tk.Label(frame, text="", bd=1, anchor=tk.E)
         self._status_text.grid(column=3, row=0, ipadx=3, sticky=tk.W)
+        self._status_perf = tk.Label(frame, text="", bd=1, relief=tk.SUNKEN,
+                                     font="TkFixedFont")
+        self._status_perf.grid(column=4, row=0, ipadx=3, sticky=tk.E)
+        self._status_perf.grid_remove()
         return frame
 
     def _build_menu(self):
@@ -109,14 +137,27 @@ class WndViewer(tk.Tk):
         self.config(menu=menubar)
         file_menu = tk.Menu(menubar, tearoff=False)
         file_menu.add_command(label="Open...", command=self._open_file)
+        file_menu.add_command(label="Open track...",
+                              command=self._open_track)
+        file_menu.add_command(label="Close track", command=self._close_track)
         file_menu.add_separator()
         file_menu.add_command(label="Exit", command=self.quit)
         menubar.add_cascade(label="File", menu=file_menu)
+        view_menu = tk.Menu(menubar, tearoff=False)
+        view_menu.add_command(label="Go to position...",
+                              command=self._go_to_position)
+        view_menu.add_checkbutton(label="Auto switch maps",
+                                  variable=self._var_auto_switch)
+        view_menu.add_separator()
+        view_menu.add_checkbutton(label="Performance panel",
+                                  variable=self._var_perf_panel,
+                                  command=self._toggle_perf_panel)
+        menubar.add_cascade(label="View", menu=view_menu)
 
     def _open_file(self):
         fname = filedialog.askopenfilename(
             parent=self,
-            filetypes=[("Supported files", ".tba .tar .map"),
+            filetypes=[("Supported files", ".tba .tar .map .mbtiles"),
                        ("All files", "*.*")],
             initialdir=self._last_dir)
         if fname:
@@ -124,6 +165,45 @@ class WndViewer(tk.Tk):
             self._last_dir = os.path.dirname(fname)
         self.focus_set()
 
+    def _open_track(self):
+        fname = filedialog.askopenfilename(
+            parent=self,
+            filetypes=[("GPX files", ".gpx"), ("All files", "*.*")],
+            initialdir=self._last_dir)
+        self.focus_set()
+        if not fname:
+            return
+
+        self._busy_manager.busy()
+        self.update()
+        try:
+            self._track_segments = gpx.load_gpx(fname)
+        except InvalidFileException as err:
+            messagebox.showerror("Error loading file", str(err))
+        except IOError as err:
+            messagebox.showerror("Error loading file",
+                                 f"Open file error: {err}")
+        else:
+            self._last_dir = os.path.dirname(fname)
+            self._create_track_overlay()
+            self._draw_tiles()
+        self._busy_manager.notbusy()
+
+    def _close_track(self):
+        self._track_segments = None
+        self._track = None
+        self._clear_track()
+
+    def _create_track_overlay(self):
+        self._clear_track()
+        self._track = None
+        if not self._track_segments or not self._map_image or \
+                not self._map_image.map_data or \
+                not self._map_image.map_data.transform:
+            return
+        self._track = gpx.TrackOverlay(self._track_segments,
+                                       self._map_image.map_data)
+
     def _load(self, fname):
         self._status_text.config(text=f"Loading {fname}...")
         self._status_text.update_idletasks()
@@ -143,7 +223,7 @@ class WndViewer(tk.Tk):
         self.update()
 
         try:
-            file_type = map_loader.check_file_type(fname)
+            file_type, fs = map_loader.sniff_file_type(fname)
         except IOError as err:
             self._busy_manager.notbusy()
             messagebox.showerror("Error loading file", f"Read file {err}")
@@ -152,9 +232,9 @@ class WndViewer(tk.Tk):
 
         _LOG.info('Loading %s, %r', fname, file_type)
         if file_type in ('atlas', 'tar-atlas'):
-            self._tb_atlas = map_loader.Atlas(fname)
-        elif file_type in ('map', 'tar-map'):
-            self._tb_atlas = map_loader.FakeAlbum(fname)
+            self._tb_atlas = map_loader.Atlas(fname, fs)
+        elif file_type in ('map', 'tar-map', 'mbtiles-map'):
+            self._tb_atlas = map_loader.FakeAlbum(fname, fs)
         else:
             self._busy_manager.notbusy()
             messagebox.showerror(
@@ -184,14 +264,25 @@ class WndViewer(tk.Tk):
         self._busy_manager.notbusy()
 
     def _load_map(self, filename):
+        with profiling.timer("viewer.load_map"):
+            self._load_map_file(filename)
+
+    def _load_map_file(self, filename):
         self._busy_manager.busy()
         self.update()
         _LOG.info("_load_map %s", filename)
         if self._map_image:
+            self._map_image.close()
             self._map_image = None
+            self._map_path = None
+        self._perf['bytes_read'] = 0
 
         try:
-            self._map_image = map_loader.Map(filename)
+            self._map_image = self._tb_atlas.open_map(filename)
+            self._map_path = filename
+            self._layout = layout.TileLayout(
+                self._map_image.width, self._map_image.height,
+                self._map_image.tile_width, self._map_image.tile_height)
             self._zoom = 0
             self._canvas.config(scrollregion=(0, 0, self._map_image.width,
                                               self._map_image.height))
@@ -202,6 +293,7 @@ class WndViewer(tk.Tk):
             messagebox.showerror("Error loading file",
                                  f"Open file error: {err}")
         self._clear_tile_cache()
+        self._create_track_overlay()
         self._draw_tiles(True)
         self._busy_manager.notbusy()
 
@@ -233,9 +325,10 @@ class WndViewer(tk.Tk):
         if self._map_image:
             x = self._canvas.canvasx(event.x) / scale
             y = self._canvas.canvasy(event.y) / scale
-            lat, lon = self._map_image.map_data.xy2latlon(x, y)
-            lat_txt = formatting.format_pos(lat)
-            lon_txt = formatting.format_pos(lon, True)
+            pos = self._map_image.map_data.xy2lonlat(x, y)
+            if pos:
+                lat_txt = formatting.format_pos_lat(pos[1])
+                lon_txt = formatting.format_pos_lon(pos[0])
         self._status_lat.config(text=lat_txt)
         self._status_lon.config(text=lon_txt)
         self._status_lat.update_idletasks()
@@ -243,10 +336,19 @@ class WndViewer(tk.Tk):
         self._status_scale.config(text=f"{scale:0.2f}x")
 
     def _canvas_mouse_wheel(self, event):
+        if not self._map_image:
+            return
+        old_zoom = self._zoom
         if (event.num == 5 or event.delta == -120) and self._zoom > -5:
             self._zoom -= 1
         elif (event.num == 4 or event.delta == 120) and self._zoom < 5:
             self._zoom += 1
+
+        if self._zoom != old_zoom and self._var_auto_switch.get() and \
+                self._auto_switch_map(old_zoom):
+            self._canvas_mouse_motion(event)
+            return
+
         self._clear_tile_cache()
 
         scale = 2.0 ** self._zoom
@@ -257,50 +359,218 @@ class WndViewer(tk.Tk):
         # refresh status
         self._canvas_mouse_motion(event)
 
+    def _view_center_position(self, zoom):
+        """Get geo position (lon, lat) of center of visible area."""
+        map_data = self._map_image.map_data
+        if not map_data or not map_data.transform:
+            return None
+        canvas = self._canvas
+        scale = 2.0 ** zoom
+        x = (canvas.canvasx(0) + canvas.winfo_width() / 2) / scale
+        y = (canvas.canvasy(0) + canvas.winfo_height() / 2) / scale
+        return map_data.xy2lonlat(x, y)
+
+    def _center_on(self, lon, lat):
+        """Scroll view to given geo position."""
+        x, y = self._map_image.map_data.lonlat2xy(lon, lat)
+        scale = 2.0 ** self._zoom
+        canvas = self._canvas
+        canvas.xview_moveto((x * scale - canvas.winfo_width() / 2) /
+                            (self._map_image.width * scale))
+        canvas.yview_moveto((y * scale - canvas.winfo_height() / 2) /
+                            (self._map_image.height * scale))
+        self._draw_tiles()
+
+    def _select_map(self, map_path):
+        """Select map in tree and load it."""
+        for layer in self._tree.get_children():
+            for item in self._tree.get_children(layer):
+                if self._tree.item(item, "tags")[0] == map_path:
+                    self._tree.selection_set(item)
+                    self._tree.see(item)
+                    break
+        self._load_map(map_path)
+
+    def _go_to_position(self):
+        if not self._tb_atlas:
+            return
+        text = simpledialog.askstring(
+            "Go to position", "Latitude and longitude (degrees):",
+            parent=self)
+        if not text:
+            return
+        try:
+            lat, lon = map(float, text.replace(',', ' ').split())
+        except ValueError:
+            messagebox.showerror("Go to position", "Invalid position")
+            return
+
+        self._busy_manager.busy()
+        self.update()
+        maps = self._tb_atlas.coverage().maps_at(lon, lat)
+        self._busy_manager.notbusy()
+        if not maps:
+            messagebox.showinfo("Go to position",
+                                "No map cover this position")
+            return
+
+        if maps[0].path != self._map_path:
+            self._select_map(maps[0].path)
+        if self._map_image:
+            self._center_on(lon, lat)
+
+    def _auto_switch_map(self, old_zoom):
+        """Switch to map with better/worse resolution when zooming.
+
+        :return: True when map was switched
+        """
+        pos = self._view_center_position(old_zoom)
+        if not pos:
+            return False
+        lon, lat = pos
+        maps = self._tb_atlas.coverage().maps_at(lon, lat)
+        current = next((cov for cov in maps if cov.path == self._map_path),
+                       None)
+        if not current:
+            return False
+
+        if self._zoom > 0:
+            # zoom in - nearest map with better resolution
+            maps = [cov for cov in maps
+                    if cov.resolution < current.resolution * 0.75]
+            target = max(maps, key=lambda cov: cov.resolution, default=None)
+        elif self._zoom < 0:
+            # zoom out - nearest map with worse resolution
+            maps = [cov for cov in maps
+                    if cov.resolution > current.resolution * 1.33]
+            target = min(maps, key=lambda cov: cov.resolution, default=None)
+        else:
+            return False
+
+        if not target:
+            return False
+
+        _LOG.info("auto switch map to %s", target.path)
+        self._select_map(target.path)
+        if self._map_image:
+            self._center_on(lon, lat)
+        return True
+
     def _draw_tiles(self, clear=False):
         if not self._map_image:
             return
+        tstart = time.perf_counter()
+        with profiling.timer("viewer.draw_tiles"):
+            hits, loaded = self._draw_visible_tiles()
+        if self._track:
+            with profiling.timer("viewer.draw_track"):
+                self._draw_track()
+        perf = self._perf
+        perf['frame_time'] = time.perf_counter() - tstart
+        perf['frame_tiles'] = hits + loaded
+        perf['frame_loaded'] = loaded
+        perf['hits'] += hits
+        perf['requests'] += hits + loaded
+
+    def _draw_visible_tiles(self):
         canvas = self._canvas
         scale = 2.0 ** self._zoom
-        mapset_get_tile = self._map_image.get_tile
-        tile_width = self._map_image.tile_width
-        tile_height = self._map_image.tile_height
-        scaled_tile_width = int(tile_width * scale)
-        scaled_tile_height = int(tile_height * scale)
+        tiles = self._tiles
         # canvas visible area
-        visible_x0 = max(canvas.canvasx(0), 0)
-        visible_y0 = max(canvas.canvasy(0), 0)
-        visible_x1 = canvas.winfo_width()
-        visible_y1 = canvas.winfo_height()
-
-        tile_start_x = int(max(visible_x0 // scaled_tile_width, 0))
-        tile_start_y = int(max(visible_y0 // scaled_tile_height, 0))
-        tiles_x = int(visible_x1 // scaled_tile_width) + 2
-        tiles_y = int(visible_y1 // scaled_tile_height) + 2
-
-        new_tile_list = {}
-        for txi in range(tile_start_x, tile_start_x + tiles_x):
-            tx = tile_width * txi
-            for tyi in range(tile_start_y, tile_start_y + tiles_y):
-                ty = tile_height * tyi
-                iidimg = self._tiles.get((tx, ty))
-                if iidimg:
-                    new_tile_list[(tx, ty)] = iidimg
-                    continue
-
-                img = mapset_get_tile(tx, ty, scale)
-                if img:
-                    iid = canvas.create_image(tx * scale, ty * scale,
-                                              image=img, anchor=tk.NW)
-                    new_tile_list[(tx, ty)] = iid, img
+        add, keep, drop = self._layout.update(
+            scale, max(canvas.canvasx(0), 0), max(canvas.canvasy(0), 0),
+            canvas.winfo_width(), canvas.winfo_height())
 
         # remove unused tiles
-        for txty, (iid, _) in self._tiles.items():
-            if txty not in new_tile_list:
+        for txty in drop:
+            iid, _ = tiles.pop(txty)
+            canvas.delete(iid)
+
+        mapset_get_tile = self._map_image.get_tile
+        loaded = 0
+        for txty in add:
+            tx, ty = txty
+            img = mapset_get_tile(tx, ty, scale)
+            if not img:
+                self._layout.forget(txty)
+                continue
+            iid = canvas.create_image(tx * scale, ty * scale,
+                                      image=img, anchor=tk.NW)
+            tiles[txty] = iid, img
+            loaded += 1
+        return len(keep), loaded
+
+    def _draw_track(self):
+        canvas = self._canvas
+        scale = 2.0 ** self._zoom
+        x0 = canvas.canvasx(0) / scale
+        y0 = canvas.canvasy(0) / scale
+        x1 = x0 + canvas.winfo_width() / scale
+        y1 = y0 + canvas.winfo_height() / scale
+
+        items = self._track_items
+        visible = {}
+        for idx, points in self._track.visible(self._zoom, x0, y0, x1, y1):
+            iid = items.get(idx)
+            if iid is None:
+                coords = [coord * scale for point in points
+                          for coord in point]
+                iid = canvas.create_line(*coords, fill="red", width=2,
+                                         tag="track")
+            visible[idx] = iid
+
+        for idx, iid in items.items():
+            if idx not in visible:
                 canvas.delete(iid)
-        self._tiles = new_tile_list
+        self._track_items = visible
+        # track must be over tiles
+        canvas.tag_raise("track")
+
+    def _clear_track(self):
+        self._canvas.delete("track")
+        self._track_items.clear()
+
+    def _toggle_perf_panel(self):
+        if self._perf_panel_job:
+            self.after_cancel(self._perf_panel_job)
+            self._perf_panel_job = None
+        if self._var_perf_panel.get():
+            self._status_perf.grid()
+            self._update_perf_panel()
+        else:
+            self._status_perf.grid_remove()
+
+    def _update_perf_panel(self):
+        self._perf_panel_job = None
+        if not self._var_perf_panel.get():
+            return
+
+        perf = self._perf
+        now = time.time()
+        bytes_read = self._map_image.bytes_read if self._map_image else 0
+        read_speed = (bytes_read - perf['bytes_read']) / \
+            max(now - perf['time'], 0.001)
+        hit_rate = perf['hits'] * 100.0 / perf['requests'] \
+            if perf['requests'] else 0.0
+        # PhotoImage keep decoded RGBA data
+        memory = sum(img.width() * img.height() * 4
+                     for _, img in self._tiles.values())
+        self._status_perf.config(
+            text=f"frame: {perf['frame_time'] * 1000:6.1f}ms  "
+            f"tiles: {perf['frame_loaded']:3d}/{perf['frame_tiles']:3d}  "
+            f"hits: {hit_rate:5.1f}%  "
+            f"read: {read_speed / 1024:7.1f}kB/s  "
+            f"mem: {memory / 1048576:6.1f}MB")
+        perf['bytes_read'] = bytes_read
+        perf['hits'] = perf['requests'] = 0
+        perf['time'] = now
+        self._perf_panel_job = self.after(self._PERF_PANEL_INTERVAL,
+                                          self._update_perf_panel)
 
     def _clear_tile_cache(self):
         for (iid, _) in self._tiles.values():
             self._canvas.delete(iid)
         self._tiles.clear()
+        if self._layout:
+            self._layout.clear()
+        self._clear_track()
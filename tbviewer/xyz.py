@@ -0,0 +1,431 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# Copyright © Karol Będkowski, 2020
+#
+# This file is part of tbviewer
+# Distributed under terms of the GPLv3 license.
+
+"""Reprojection of calibrated maps to Web Mercator (XYZ) tiles.
+
+Each output tile is rendered independently: geo coordinates of all tile
+pixels are mapped to map pixels by `MapFile.lonlat2xy_many` and source is
+sampled bilinear. For zoom levels lower than map resolution source tiles
+are first reduced by power of 2. Tiles are rendered in process pool; tiles
+outside map are skipped. Require NumPy.
+
+Tiles are written as <dst dir>/<zoom>/<x>/<y>.<ext> or to standard MBTiles
+file (tms scheme) when destination is .mbtiles file; tiles for MBTiles are
+encoded in workers and inserted by main process.
+"""
+
+import collections
+import io
+import logging
+import math
+import optparse
+import os
+import os.path
+import time
+from concurrent import futures
+
+from PIL import Image
+
+from . import map_loader
+from . import mbtiles
+from . import profiling
+from . import version
+from .errors import InvalidFileException
+from .mapfile import get_numpy
+
+_LOG = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+# max latitude of Web Mercator
+MAX_LAT = 85.0511287798
+# tiles rendered by one task in worker
+_CHUNK_SIZE = 32
+# render in process pool only when there are more tiles
+_MIN_TILES_FOR_POOL = 64
+
+
+def lonlat2tile(lon, lat, zoom):
+    """Get (fractional) tile coordinates for geo location."""
+    lat = max(min(lat, MAX_LAT), -MAX_LAT)
+    num = 1 << zoom
+    lat_rad = math.radians(lat)
+    return ((lon + 180.0) / 360.0 * num,
+            (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * num)
+
+
+def tile2lonlat(x, y, zoom):
+    """Get geo location of tile (fractional) coordinates."""
+    num = 1 << zoom
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / num))))
+    return x / num * 360.0 - 180.0, lat
+
+
+def native_zoom(map_data, tile_size=TILE_SIZE):
+    """Zoom level with resolution nearest to map resolution."""
+    (lon0, _), (lon1, _) = map_data.mmpll[:2]
+    deg_per_px = abs(lon1 - lon0) / map_data.image_width
+    return max(int(round(math.log2(360.0 / deg_per_px / tile_size))), 0)
+
+
+def map_tiles(map_data, zoom):
+    """Get range of tiles covering map on given zoom.
+
+    :return: (x0, y0, x1, y1) - tiles x0 <= x < x1, y0 <= y < y1
+    """
+    corners = [lonlat2tile(lon, lat, zoom) for lon, lat in map_data.mmpll]
+    num = 1 << zoom
+    x0 = max(int(min(x for x, _ in corners)), 0)
+    y0 = max(int(min(y for _, y in corners)), 0)
+    x1 = min(int(max(x for x, _ in corners)) + 1, num)
+    y1 = min(int(max(y for _, y in corners)) + 1, num)
+    return x0, y0, x1, y1
+
+
+class _SourceReader:
+    """Read map regions reduced by power of 2; keep recently used tiles."""
+
+    def __init__(self, tbmap, cache_size=256):
+        self._map = tbmap
+        # (x, y, factor) -> reduced tile
+        self._tiles = collections.OrderedDict()
+        self._cache_size = cache_size
+        self.tiles_read = 0
+
+    def max_factor(self, factor):
+        """Find max power of 2 <= factor that divide tile size."""
+        tbmap = self._map
+        result = 1
+        while result * 2 <= factor and tbmap.tile_width % (result * 2) == 0 \
+                and tbmap.tile_height % (result * 2) == 0:
+            result *= 2
+        return result
+
+    def _get_tile(self, tx, ty, factor):
+        key = (tx, ty, factor)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+        tile = self._map.get_tile_image(tx, ty)
+        self.tiles_read += 1
+        if tile.mode != 'RGB':
+            tile = tile.convert('RGB')
+        if factor > 1:
+            tile = tile.reduce(factor)
+        self._tiles[key] = tile
+        if len(self._tiles) > self._cache_size:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def read(self, x0, y0, x1, y1, factor):
+        """Read region; x0 and y0 must be multiple of factor."""
+        tbmap = self._map
+        tile_width, tile_height = tbmap.tile_width, tbmap.tile_height
+        region = Image.new('RGB', (-(-(x1 - x0) // factor),
+                                   -(-(y1 - y0) // factor)))
+        for ty in range(y0 - y0 % tile_height, y1, tile_height):
+            for tx in range(x0 - x0 % tile_width, x1, tile_width):
+                if (tx, ty) not in tbmap.set_data:
+                    continue
+                region.paste(self._get_tile(tx, ty, factor),
+                             ((tx - x0) // factor, (ty - y0) // factor))
+        return region
+
+
+def _bilinear(numpy, src, us, vs):
+    """Sample image array `src` in (us, vs) positions (pixel centers are in
+    integer positions)."""
+    height, width, bands = src.shape
+    us = numpy.clip(us, 0, width - 1)
+    vs = numpy.clip(vs, 0, height - 1)
+    u0 = numpy.minimum(us.astype(numpy.intp), max(width - 2, 0))
+    v0 = numpy.minimum(vs.astype(numpy.intp), max(height - 2, 0))
+    fu = (us - u0).astype(numpy.float32)[..., None]
+    fv = (vs - v0).astype(numpy.float32)[..., None]
+    # gather neighbours from flattened image; faster than 2d indexing
+    flat = src.reshape(-1, bands)
+    idx = v0 * width + u0
+    dx = 1 if width > 1 else 0
+    dy = width if height > 1 else 0
+    p00 = flat.take(idx, axis=0)
+    p01 = flat.take(idx + dx, axis=0)
+    p10 = flat.take(idx + dy, axis=0)
+    p11 = flat.take(idx + dy + dx, axis=0)
+    top = p00 + (p01 - p00) * fu
+    bottom = p10 + (p11 - p10) * fu
+    return top + (bottom - top) * fv
+
+
+def render_tile(tbmap, reader, zoom, x, y, tile_size=TILE_SIZE):
+    """Render one Web Mercator tile from map.
+
+    :param reader: `_SourceReader` for tbmap
+    :return: RGBA image or None when tile is outside map
+    """
+    numpy = get_numpy()
+    num = tile_size << zoom
+    pixels = numpy.arange(tile_size) + 0.5
+    lons = (x * tile_size + pixels) / num * 360.0 - 180.0
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(
+        numpy.pi * (1 - 2 * (y * tile_size + pixels) / num))))
+    lons, lats = numpy.meshgrid(lons, lats)
+    with profiling.timer("xyz.inverse"):
+        xs, ys = tbmap.map_data.lonlat2xy_many(lons, lats)
+    inside = (xs >= 0) & (xs < tbmap.width) & (ys >= 0) & \
+        (ys < tbmap.height)
+    if not inside.any():
+        return None
+
+    # source region with 1px margin for interpolation
+    ixs, iys = xs[inside], ys[inside]
+    sx0 = max(int(ixs.min()) - 1, 0)
+    sy0 = max(int(iys.min()) - 1, 0)
+    sx1 = min(int(ixs.max()) + 2, tbmap.width)
+    sy1 = min(int(iys.max()) + 2, tbmap.height)
+    factor = reader.max_factor(
+        max(sx1 - sx0, sy1 - sy0) / tile_size)
+    sx0 -= sx0 % factor
+    sy0 -= sy0 % factor
+    with profiling.timer("xyz.read"):
+        src = reader.read(sx0, sy0, sx1, sy1, factor)
+
+    with profiling.timer("xyz.resample"):
+        src = numpy.asarray(src, dtype=numpy.float32)
+        rgb = _bilinear(
+            numpy, src,
+            ((xs - sx0) / factor - 0.5).astype(numpy.float32),
+            ((ys - sy0) / factor - 0.5).astype(numpy.float32))
+        tile = numpy.empty((tile_size, tile_size, 4), dtype=numpy.uint8)
+        tile[..., :3] = rgb + 0.5
+        tile[..., 3] = inside * 255
+    return Image.fromarray(tile)
+
+
+# state of worker process: (map, reader, options)
+_WORKER = None
+
+
+def _init_worker(path, options):
+    global _WORKER  # pylint: disable=global-statement
+    tbmap = map_loader.Map(path)
+    _WORKER = (tbmap, _SourceReader(tbmap), options)
+
+
+def _close_worker():
+    global _WORKER  # pylint: disable=global-statement
+    if _WORKER:
+        _WORKER[0].close()
+        _WORKER = None
+
+
+def _save_tile(tile, ofile, fmt):
+    with profiling.timer("xyz.save"):
+        if fmt == 'JPEG':
+            # area outside map is black
+            tile.convert('RGB').save(ofile, 'JPEG', quality=90)
+        elif tile.getextrema()[3][0] == 255:
+            # fully covered tile don't need alpha channel
+            tile.convert('RGB').save(ofile, 'PNG')
+        else:
+            tile.save(ofile, 'PNG')
+
+
+def _render_tiles(tiles):
+    """Render and save tiles; run in worker.
+
+    When destination directory is None tiles are not saved but returned.
+
+    :return: (tiles written, empty tiles, bytes written, list of (zoom, x,
+        y, encoded tile))
+    """
+    tbmap, reader, options = _WORKER
+    dst_dir, tile_size, fmt = options
+    ext = 'jpg' if fmt == 'JPEG' else 'png'
+    written = empty = nbytes = 0
+    encoded = []
+    for zoom, x, y in tiles:
+        tile = render_tile(tbmap, reader, zoom, x, y, tile_size)
+        if tile is None:
+            empty += 1
+            continue
+        written += 1
+        if dst_dir is None:
+            with io.BytesIO() as bfile:
+                _save_tile(tile, bfile, fmt)
+                data = bfile.getvalue()
+            encoded.append((zoom, x, y, data))
+            nbytes += len(data)
+            continue
+        tile_dir = os.path.join(dst_dir, str(zoom), str(x))
+        os.makedirs(tile_dir, exist_ok=True)
+        filename = os.path.join(tile_dir, f"{y}.{ext}")
+        _save_tile(tile, filename, fmt)
+        nbytes += os.path.getsize(filename)
+    return written, empty, nbytes, encoded
+
+
+def _create_mbtiles(dst_file, map_data, zooms, fmt):
+    """Create writer of standard MBTiles file."""
+    metadata = {
+        'name': os.path.splitext(os.path.basename(dst_file))[0],
+        'type': 'baselayer',
+        'version': '1.1',
+        'description': 'Trekbuddy map reprojected to Web Mercator',
+        'format': 'jpg' if fmt == 'JPEG' else 'png',
+        'scheme': 'tms',
+        'minzoom': str(zooms[0]),
+        'maxzoom': str(zooms[1]),
+    }
+    # pylint: disable=protected-access
+    bounds = mbtiles._bounds(map_data)
+    if bounds:
+        metadata['bounds'] = bounds
+    return mbtiles.MBTilesWriter(dst_file, metadata)
+
+
+def reproject_map(path, dst, zooms=None, tile_size=TILE_SIZE,
+                  fmt='PNG', workers=None, progress=None):
+    """Render map as Web Mercator tiles.
+
+    :param path: map file (.map, .tar, .mbtiles)
+    :param dst: destination directory or .mbtiles file
+    :param zooms: (min zoom, max zoom); default: 3 levels below native zoom
+        of map up to native zoom
+    :param fmt: PNG or JPEG
+    :param workers: number of worker processes
+    :param progress: function(done tiles, all tiles)
+    :return: dict with statistics
+    """
+    if get_numpy() is None:
+        raise ImportError("NumPy is required for reprojection")
+    tstart = time.time()
+    with map_loader.Map(path) as tbmap:
+        map_data = tbmap.map_data
+        if not map_data or not map_data.transform:
+            raise InvalidFileException("Map is not calibrated")
+        if not zooms:
+            max_zoom = native_zoom(map_data, tile_size)
+            zooms = (max(max_zoom - 3, 0), max_zoom)
+
+    tiles = []
+    for zoom in range(zooms[0], zooms[1] + 1):
+        x0, y0, x1, y1 = map_tiles(map_data, zoom)
+        tiles.extend((zoom, x, y) for y in range(y0, y1)
+                     for x in range(x0, x1))
+    _LOG.info("rendering %d tiles; zoom %d-%d", len(tiles), *zooms)
+
+    chunks = [tiles[idx:idx + _CHUNK_SIZE]
+              for idx in range(0, len(tiles), _CHUNK_SIZE)]
+    writer = None
+    if dst.endswith(".mbtiles"):
+        writer = _create_mbtiles(dst, map_data, zooms, fmt)
+    options = (None if writer else dst, tile_size, fmt)
+    written = empty = nbytes = done = 0
+    if len(tiles) < _MIN_TILES_FOR_POOL or workers == 1:
+        _init_worker(path, options)
+        results = map(_render_tiles, chunks)
+        executor = None
+    else:
+        executor = futures.ProcessPoolExecutor(
+            workers, initializer=_init_worker, initargs=(path, options))
+        results = executor.map(_render_tiles, chunks)
+    try:
+        for chunk, (cwritten, cempty, cbytes, encoded) in zip(chunks,
+                                                               results):
+            if writer:
+                # mbtiles use tms scheme - rows counted from bottom
+                writer.add_tiles([(zoom, x, (1 << zoom) - 1 - y, data)
+                                  for zoom, x, y, data in encoded])
+            written += cwritten
+            empty += cempty
+            nbytes += cbytes
+            done += len(chunk)
+            if progress:
+                progress(done, len(tiles))
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    finally:
+        if executor:
+            executor.shutdown()
+        else:
+            _close_worker()
+    if writer:
+        writer.close()
+
+    elapsed = time.time() - tstart
+    return {
+        'tiles': written,
+        'empty': empty,
+        'bytes_written': nbytes,
+        'time': elapsed,
+        'tiles_per_s': written / elapsed if elapsed else 0,
+    }
+
+
+def format_stats(stats):
+    return ("tiles: {tiles} (empty skipped: {empty}); written "
+            "{mb_written:0.1f} MB; time: {time:0.2f}s; "
+            "{tiles_per_s:0.1f} tiles/s".format(
+                mb_written=stats['bytes_written'] / 1048576, **stats))
+
+
+def _parse_zooms(value):
+    zmin, _, zmax = value.partition('-')
+    zmin = int(zmin)
+    zmax = int(zmax) if zmax else zmin
+    if not 0 <= zmin <= zmax <= 30:
+        raise ValueError("invalid zoom range")
+    return zmin, zmax
+
+
+def parse_opt():
+    """Parse cli options."""
+    optp = optparse.OptionParser(
+        version=version.NAME + version.VERSION,
+        usage="%prog [options] <map file> <output directory or .mbtiles>")
+    optp.add_option("--zoom", "-z",
+                    help="zoom level or range (MIN-MAX); default: 3 levels "
+                    "below map resolution up to map resolution")
+    optp.add_option("--format", choices=("PNG", "JPEG"), default="PNG",
+                    help="tiles format (default: PNG)")
+    optp.add_option("--workers", "-w", type="int",
+                    help="number of worker processes")
+
+    group = optparse.OptionGroup(optp, "Debug options")
+    group.add_option("--debug", "-d", action="store_true", default=False,
+                     help="enable debug messages")
+    optp.add_option_group(group)
+    return optp.parse_args()
+
+
+def run(options, args):
+    """Run reprojection for parsed cli options."""
+    if not options.debug:
+        _LOG.setLevel(logging.INFO)
+    if len(args) != 2:
+        _LOG.error("map file and output directory or file required")
+        return 1
+
+    try:
+        zooms = _parse_zooms(options.zoom) if options.zoom else None
+    except ValueError as err:
+        _LOG.error("invalid zoom: %s", err)
+        return 1
+
+    try:
+        stats = reproject_map(args[0], args[1], zooms,
+                              fmt=options.format, workers=options.workers)
+    except (IOError, ImportError, InvalidFileException) as err:
+        _LOG.error("reprojection error: %s", err)
+        return 1
+
+    _LOG.info("finished; %s", format_stats(stats))
+    return 0